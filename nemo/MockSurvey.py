@@ -9,12 +9,12 @@ import os
 import sys
 import numpy as np
 import astropy.table as atpy
-import pylab as plt
 import subprocess
-from astropy.cosmology import FlatLambdaCDM
+from ._lazy import lazyImport
+plt=lazyImport('pylab')
 on_rtd=os.environ.get('READTHEDOCS', None)
 if on_rtd is None:
-    import pyccl as ccl
+    ccl=lazyImport('pyccl')
 from . import signals
 from . import catalogs
 from . import maps
@@ -25,14 +25,10 @@ from scipy.interpolate import InterpolatedUnivariateSpline as _spline
 from scipy import stats
 from astLib import *
 import time
+import collections
 
-# CLASS-SZ is quite a big import (tensorflow) if we don't need it
+# CLASS-SZ is quite a big import (tensorflow) - so we only import it when theoryCode = 'CLASS-SZ' is used
 noCLASS=os.environ.get('NEMO_NOCLASSSZ', None)
-if noCLASS is None:
-    try:
-        from classy_sz import Class
-    except:
-        pass
 
 #------------------------------------------------------------------------------------------------------------
 # Global settings for CLASS-SZ, if used
@@ -63,6 +59,59 @@ CLASS_SZ_SETTINGS={# 'mass function' : 'T08M200c',
                    'y_m_relation' : 1,
                    'output': 'dndlnM,m500c_to_m200c,m200c_to_m500c'}
 
+#------------------------------------------------------------------------------------------------------------
+def _sampleLinearDensity(u, a, b):
+    """Inverse transform sampling on [0, 1] for a density that varies linearly from `a` (at 0) to `b`
+    (at 1), for uniform random numbers `u`.
+
+    """
+    # Rationalised form of the quadratic root, which is stable when a ~ b
+    denom=a+np.sqrt(a**2*(1-u)+b**2*u)
+    frac=np.divide(u*(a+b), denom, out = u.copy(), where = denom > 0)
+
+    return np.clip(frac, 0, 1)
+
+#------------------------------------------------------------------------------------------------------------
+class _LRUCache(object):
+    """A small least-recently-used cache, which keeps count of hits and misses.
+
+    """
+
+    def __init__(self, maxSize = 16):
+        self.maxSize=maxSize
+        self.hits=0
+        self.misses=0
+        self._store=collections.OrderedDict()
+
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None if not found.
+
+        """
+        if key in self._store:
+            self.hits=self.hits+1
+            self._store.move_to_end(key)
+            return self._store[key]
+        self.misses=self.misses+1
+        return None
+
+
+    def put(self, key, value):
+        self._store[key]=value
+        self._store.move_to_end(key)
+        while len(self._store) > self.maxSize:
+            self._store.popitem(last = False)
+
+
+    def clear(self):
+        self._store.clear()
+        self.hits=0
+        self.misses=0
+
+
+    def getStats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._store), 'maxSize': self.maxSize}
+
 #------------------------------------------------------------------------------------------------------------
 class MockSurvey(object):
     """An object that provides routines calculating cluster counts (using `CCL <https://ccl.readthedocs.io/en/latest/>`_) 
@@ -98,10 +147,14 @@ class MockSurvey(object):
             minimum mass limit, as a function of redshift.
     
     """
+    # Attributes set by update() that are restored from the cache when returning to the same parameters
+    _UPDATE_CACHE_ATTRS=['fsky', 'dndmdz', 'HMFRange', 'dndmdzInterpolator', 'numClusters', 'theta500Splines',
+                         'fRelSplines', 'Ez', 'Ez2', 'DAz', 'criticalDensity']
+
     def __init__(self, minMass, areaDeg2, zMin, zMax, H0, Om0, Ob0, sigma8, ns,
                  maxMass = 1e16, zStep = 0.01, numMassBins = 200, delta = 500, rhoType = 'critical',
                  transferFunction = 'boltzmann_camb', massFunction = 'Tinker08',
-                 c_m_relation = 'Bhattacharya13', theoryCode = 'CCL'):
+                 c_m_relation = 'Bhattacharya13', theoryCode = 'CCL', cacheSize = 16):
         """Create a MockSurvey object, for performing calculations of cluster counts or generating mock
         catalogs.
         
@@ -129,6 +182,10 @@ class MockSurvey(object):
             c_m_relation (:'obj:`str`, optional): Name of the concentration -- mass relation to assume, as understood by
                 CCL (this may be used internally for conversion between mass definitions, as needed).
             theoryCode (:obj:`str`, optional): Either 'CCL' or 'CLASS-SZ'.
+            cacheSize (:obj:`int`, optional): Number of sets of cosmological parameters for which the
+                cosmology objects, mass function grids and derived splines are kept in memory, so that
+                returning to previously used parameters does not require recalculation (see
+                :meth:`getCacheStats`).
 
         """
         
@@ -158,6 +215,11 @@ class MockSurvey(object):
         # Just for convenience when used elsewhere
         self.mdefLabel="M%d%s" % (self.delta, self.rhoType[0])
         
+        # Least-recently-used caches, keyed by cosmological parameters (see getCacheStats)
+        self._cosmoCache=_LRUCache(cacheSize)
+        self._updateCache=_LRUCache(cacheSize)
+        self._numberDensityCache=_LRUCache(cacheSize*64)
+
         self.H0=-1
         self.Om0=-1
         self.Ob0=-1
@@ -199,10 +261,41 @@ class MockSurvey(object):
             self._doClusterCount()
 
 
+    def _cosmoKey(self):
+        """Returns a key identifying the current cosmology, for use with the caches.
+
+        """
+        return (self.H0, self.Om0, self.Ob0, self.sigma8, self.ns)
+
+
+    def getCacheStats(self):
+        """Returns hit/miss statistics for the caches of cosmology objects (`cosmo`), mass function grids
+        and derived splines (`update`), and cumulative number densities (`numberDensity`), which are keyed
+        by cosmological parameters.
+
+        Returns:
+            Dictionary, with a dictionary of `hits`, `misses`, `size` and `maxSize` for each cache.
+
+        """
+        return {'cosmo': self._cosmoCache.getStats(),
+                'update': self._updateCache.getStats(),
+                'numberDensity': self._numberDensityCache.getStats()}
+
+
+    def clearCaches(self):
+        """Empties the caches of cosmology objects, mass function grids and derived splines, and resets
+        their statistics.
+
+        """
+        self._cosmoCache.clear()
+        self._updateCache.clear()
+        self._numberDensityCache.clear()
+
+
     def _get_new_cosmo(self, H0, Om0, Ob0, sigma8, ns):
         self._cosmoUpdated=False
         if ((self.H0 != H0) or (self.Om0 != Om0) or
-            (self.Ob0 != Ob0) or (self.sigma8 != sigma8)):
+            (self.Ob0 != Ob0) or (self.sigma8 != sigma8) or (self.ns != ns)):
 
             self.H0=H0
             self.Om0=Om0
@@ -211,6 +304,12 @@ class MockSurvey(object):
             self.ns=ns
             self._cosmoUpdated=True
 
+            cached=self._cosmoCache.get(self._cosmoKey())
+            if cached is not None:
+                for key in cached.keys():
+                    setattr(self, key, cached[key])
+                return
+
             # CCL cosmology - we may not want to entirely use CLASS-SZ, at least to start
             self.cosmoModel=ccl.Cosmology(Omega_c=Om0-Ob0,
                                           Omega_b=Ob0,
@@ -218,21 +317,29 @@ class MockSurvey(object):
                                           sigma8=sigma8,
                                           n_s=ns,
                                           transfer_function=self.transferFunction)
+            cached={'cosmoModel': self.cosmoModel}
 
             if self.theoryCode == 'CCL':
                 if self.massFuncName == 'Tinker10':
                     self.mfunc=ccl.halos.MassFuncTinker10(mass_def = self.mdef)
                 elif self.massFuncName == 'Tinker08':
                     self.mfunc=ccl.halos.MassFuncTinker08(mass_def = self.mdef)
+                cached['mfunc']=self.mfunc
 
             elif self.theoryCode == 'CLASS-SZ':
                 classDict={'Omega_b': Ob0, 'Omega_cdm':  Om0-Ob0, 'H0': H0, 'sigma8': sigma8,
                            'tau_reio':  0.0561, 'n_s': ns} # tau_reio not important but needs to be set
+                if noCLASS is not None:
+                    raise Exception("theoryCode = 'CLASS-SZ' cannot be used when NEMO_NOCLASSSZ is set")
+                from classy_sz import Class
                 self.cosmoCLASS=Class()
                 self.cosmoCLASS.set(CLASS_SZ_SETTINGS) # Not sure if we want to update every time?
                 self.cosmoCLASS.set(classDict)
                 # self.cosmo.set(class_sz_ym_params)
                 self.cosmoCLASS.compute_class_szfast()
+                cached['cosmoCLASS']=self.cosmoCLASS
+
+            self._cosmoCache.put(self._cosmoKey(), cached)
 
             
     def update(self, H0, Om0, Ob0, sigma8, ns):
@@ -248,7 +355,15 @@ class MockSurvey(object):
         """
 
         self._get_new_cosmo(H0, Om0, Ob0, sigma8, ns)
-        
+
+        # Everything calculated below depends only on the cosmology and the survey area
+        updateKey=(self._cosmoKey(), self.areaSr)
+        cached=self._updateCache.get(updateKey)
+        if cached is not None:
+            for key in cached.keys():
+                setattr(self, key, cached[key])
+            return
+
         self._doClusterCount()
         
         # For quick Q, fRel calc (these are in MockSurvey rather than SelFn as used by drawSample)
@@ -283,12 +398,19 @@ class MockSurvey(object):
             self.theta500Splines.append(tckLog10MToTheta500)
             self.fRelSplines.append(tckLog10MToFRel)
 
+        self._updateCache.put(updateKey, {key: getattr(self, key) for key in self._UPDATE_CACHE_ATTRS})
+
 
     def _cumulativeNumberDensity(self, z):
         """Returns N > M (per cubic Mpc).
         
         """
 
+        cacheKey=(self._cosmoKey(), float(z))
+        ngtm=self._numberDensityCache.get(cacheKey)
+        if ngtm is not None:
+            return ngtm
+
         h=self.cosmoModel['h']
         dndlnM=self.mfunc(self.cosmoModel, self.M, 1/(1+z)) / np.log(10)
         dndM=dndlnM/self.M
@@ -299,6 +421,7 @@ class MockSurvey(object):
         MF_extr=extrapolator(MUpper)
         intUpper=integrate.simpson(np.exp(MF_extr), dx=MUpper[2] - MUpper[1])#, even='first')
         ngtm=ngtm+intUpper
+        self._numberDensityCache.put(cacheKey, ngtm)
     
         return ngtm
     
@@ -326,6 +449,7 @@ class MockSurvey(object):
                 dndlnM=self.mfunc(self.cosmoModel, self.M, self.a[i]) * norm_mfunc
                 dndmdz[i]=4.*np.pi*self.fsky*dVdzdOmega[i]*dndlnM
             dndmdz=dndmdz.transpose()
+            self.dndmdz=dndmdz
             self.HMFRange=np.array([np.min(dndmdz),np.max(dndmdz)])
             self.dndmdzInterpolator=interpolate.RectBivariateSpline(np.log(self.M),
                                                                     self.z,
@@ -339,6 +463,7 @@ class MockSurvey(object):
             dndmdz = np.zeros((self.log10M.shape[0], self.z.shape[0]))
             for (im,mm) in enumerate(lnms):
                 dndmdz[im,:]=4.*np.pi*self.fsky*np.vectorize(self.cosmoCLASS.get_volume_dVdzdOmega_at_z)(self.z)*np.vectorize(self.cosmoCLASS.get_dndlnM_at_z_and_M)(self.z,np.exp(mm))
+            self.dndmdz=dndmdz
             self.HMFRange=np.array([np.min(dndmdz),np.max(dndmdz)])
             dndz=np.trapz(dndmdz,x = lnms,axis = 0)
             self.numClusters=np.trapz(dndz, x = self.z)
@@ -371,7 +496,8 @@ class MockSurvey(object):
                    tileName = None, tileCoordsDict = None, SNRLimit = None, makeNames = False, z = None,\
                    numDraws = None, areaDeg2 = None, applyPoissonScatter = True,\
                    applyIntrinsicScatter = True, applyNoiseScatter = True,\
-                   applyRelativisticCorrection = True, verbose = False, biasModel = None):
+                   applyRelativisticCorrection = True, verbose = False, biasModel = None,\
+                   sampler = 'inverseCDF'):
         """Draw a cluster sample from the mass function, generating mock y0~ values (called `fixed_y_c` in
         Nemo catalogs) by applying the given scaling relation parameters, and then (optionally) applying
         a survey selection function.
@@ -419,6 +545,10 @@ class MockSurvey(object):
                 (`fixed_y_c`).
             applyRelativisticCorrection (:obj:`bool`, optional): If True, apply the relativistic
                 correction.
+            sampler (:obj:`str`, optional): Method used to draw (z, mass) pairs from the mass function.
+                Either 'inverseCDF' (all clusters are drawn at once from the cumulative distribution of
+                the (z, log10M) grid, see :meth:`drawZLog10MSample`) or 'rejection' (the slower,
+                per-object rejection sampling method used by earlier versions of Nemo).
                 
         Returns:
             A catalog as an :obj:`astropy.table.Table` object, in the same format as produced by
@@ -528,18 +658,26 @@ class MockSurvey(object):
                 if tileMask.sum() > 0:
                     tileNamesCol[tileMask]=tileName
 
-        # Draw zs and masses using rejection sampling (from Inigo Zubeldia)
-        # NOTE: We can't parallelize this with e.g. multiprocessing because we can't pickle swig objects from pyccl
-        zs=np.zeros(y0Noise.shape)
-        zErrs=np.zeros(y0Noise.shape)
-        log10Ms=np.zeros(y0Noise.shape)
-        log10M500cs=np.zeros(y0Noise.shape)
-        Qs=np.zeros(y0Noise.shape)
-        fRels=np.zeros(y0Noise.shape)
-        t0=time.time()
-        for clusterIndex in range(numClusters):
-            log10Ms[clusterIndex], zs[clusterIndex], log10M500cs[clusterIndex], Qs[clusterIndex], fRels[clusterIndex]=self._drawSampleRow(QFit = QFit, tileName = tileNamesCol[clusterIndex])
-        t1=time.time()
+        if sampler == 'inverseCDF':
+            if z is not None:
+                log10Ms, zs=self.drawZLog10MSample(numClusters, zIndex = zIndex)
+            else:
+                log10Ms, zs=self.drawZLog10MSample(numClusters)
+            log10M500cs, Qs, fRels=self._calcSampleQuantities(log10Ms, zs, QFit = QFit, tileNames = tileNamesCol)
+            zErrs=np.zeros(numClusters)
+        elif sampler == 'rejection':
+            # Draw zs and masses using rejection sampling (from Inigo Zubeldia)
+            # NOTE: We can't parallelize this with e.g. multiprocessing because we can't pickle swig objects from pyccl
+            zs=np.zeros(y0Noise.shape)
+            zErrs=np.zeros(y0Noise.shape)
+            log10Ms=np.zeros(y0Noise.shape)
+            log10M500cs=np.zeros(y0Noise.shape)
+            Qs=np.zeros(y0Noise.shape)
+            fRels=np.zeros(y0Noise.shape)
+            for clusterIndex in range(numClusters):
+                log10Ms[clusterIndex], zs[clusterIndex], log10M500cs[clusterIndex], Qs[clusterIndex], fRels[clusterIndex]=self._drawSampleRow(QFit = QFit, tileName = tileNamesCol[clusterIndex])
+        else:
+            raise Exception("sampler must be either 'inverseCDF' or 'rejection' - given %s" % (sampler))
 
         # For some cosmo parameters, fRel can wander outside its range for crazy masses
         fRels[fRels <= 0]=0.1
@@ -577,9 +715,8 @@ class MockSurvey(object):
         tab['fixed_err_y_c']=y0Noise/1e-4
         tab['fixed_SNR']=np.zeros(len(tab))
         tab['true_fixed_SNR']=tab['fixed_y_c']/tab['fixed_err_y_c'] # Int. scatter but no noise scatter
-        for row in tab:
-            if applyNoiseScatter == True:
-                row['fixed_y_c']=row['fixed_y_c'] + np.random.normal(0, row['fixed_err_y_c'])
+        if applyNoiseScatter == True:
+            tab['fixed_y_c']=tab['fixed_y_c'] + np.random.normal(0, tab['fixed_err_y_c'])
         tab['tileName']=tileNamesCol
 
         # Apply optimization bias first, then it'll feed through to SNR automatically
@@ -596,6 +733,101 @@ class MockSurvey(object):
         return tab
 
 
+    def drawZLog10MSample(self, numClusters, zIndex = None):
+        """Draws (z, log10M) pairs from the mass function, in one step, by inverse transform sampling of the
+        cumulative distribution of the (z, log10M) grid computed by :meth:`update`. The number density is
+        treated as bilinear within each grid cell.
+
+        Args:
+            numClusters (:obj:`int`): Number of (z, log10M) pairs to draw.
+            zIndex (:obj:`int`, optional): If given, all clusters are drawn at this index in the z grid
+                (`self.z`), rather than across the whole redshift range.
+
+        Returns:
+            Arrays of log10(mass) and redshift.
+
+        """
+
+        numClusters=int(numClusters)
+        dens=np.maximum(self.dndmdz, 0) # mass x z
+        if zIndex is not None:
+            # 1d case - cells along the mass axis only
+            colDens=dens[:, zIndex]
+            cellWeights=colDens[:-1]+colDens[1:]
+            cellIndices=np.searchsorted(np.cumsum(cellWeights), np.random.uniform(0, cellWeights.sum(), numClusters),
+                                        side = 'right')
+            cellIndices=np.minimum(cellIndices, len(cellWeights)-1)
+            fracM=_sampleLinearDensity(np.random.uniform(0, 1, numClusters), colDens[cellIndices], colDens[cellIndices+1])
+            log10Ms=self.log10M[cellIndices]+fracM*(self.log10M[cellIndices+1]-self.log10M[cellIndices])
+            zs=np.ones(numClusters)*self.z[zIndex]
+            return log10Ms, zs
+
+        # Cell corners: d00 = (M_j, z_i), d10 = (M_j, z_i+1), d01 = (M_j+1, z_i), d11 = (M_j+1, z_i+1)
+        d00=dens[:-1, :-1]
+        d10=dens[:-1, 1:]
+        d01=dens[1:, :-1]
+        d11=dens[1:, 1:]
+        # Grid spacing is uniform in both directions, so cell weights are just the corner sums
+        cellWeights=(d00+d10+d01+d11).ravel()
+        cellIndices=np.searchsorted(np.cumsum(cellWeights), np.random.uniform(0, cellWeights.sum(), numClusters),
+                                    side = 'right')
+        cellIndices=np.minimum(cellIndices, len(cellWeights)-1)
+        MIndices, zIndices=np.unravel_index(cellIndices, d00.shape)
+        c00=d00[MIndices, zIndices]
+        c10=d10[MIndices, zIndices]
+        c01=d01[MIndices, zIndices]
+        c11=d11[MIndices, zIndices]
+        # Marginal in z is linear, then the conditional in mass at that z is linear
+        fracZ=_sampleLinearDensity(np.random.uniform(0, 1, numClusters), c00+c01, c10+c11)
+        fracM=_sampleLinearDensity(np.random.uniform(0, 1, numClusters), c00*(1-fracZ)+c10*fracZ,
+                                   c01*(1-fracZ)+c11*fracZ)
+        zs=self.z[zIndices]+fracZ*(self.z[zIndices+1]-self.z[zIndices])
+        log10Ms=self.log10M[MIndices]+fracM*(self.log10M[MIndices+1]-self.log10M[MIndices])
+
+        return log10Ms, zs
+
+
+    def _calcSampleQuantities(self, log10Ms, zs, QFit = None, tileNames = None):
+        """Vectorized equivalent of the last part of :meth:`_drawSampleRow`: returns log10M500c, Q, and fRel
+        for arrays of log10M, z. Quantities interpolated on the z grid are evaluated in groups of objects
+        that share the same nearest z grid point (and tile, for Q).
+
+        """
+
+        numClusters=len(log10Ms)
+        log10M500cs=np.zeros(numClusters)
+        Qs=np.ones(numClusters)
+        fRels=np.zeros(numClusters)
+        if numClusters == 0:
+            return log10M500cs, Qs, fRels
+        # Nearest point in the z grid (lower one on ties, as np.argmin would give)
+        zIndices=np.clip(np.searchsorted(self.z, zs), 1, len(self.z)-1)
+        zIndices=zIndices-(abs(zs-self.z[zIndices-1]) <= abs(zs-self.z[zIndices]))
+        for zIndex in np.unique(zIndices):
+            zMask=zIndices == zIndex
+            zk=self.z[zIndex]
+            if self.delta == 500 and self.rhoType == "critical":
+                log10M500cs[zMask]=log10Ms[zMask]
+            else:
+                log10M500cs[zMask]=np.log10(self._transToM500c(self.cosmoModel, np.power(10, log10Ms[zMask]), 1/(1+zk)))
+            fRels[zMask]=interpolate.splev(log10M500cs[zMask], self.fRelSplines[zIndex], ext = 3)
+            if QFit is None:
+                continue
+            theta500s=interpolate.splev(log10M500cs[zMask], self.theta500Splines[zIndex], ext = 3)
+            zTileNames=tileNames[zMask] if tileNames is not None else np.array([None]*zMask.sum())
+            zQs=np.ones(zMask.sum())
+            for tileName in np.unique(zTileNames):
+                tileMask=zTileNames == tileName
+                # Sorted, as 2d interpolators used for z-dependent Q need increasing inputs
+                order=np.argsort(theta500s[tileMask])
+                tileQs=np.zeros(tileMask.sum())
+                tileQs[order]=QFit.getQ(theta500s[tileMask][order], z = zk, tileName = tileName)
+                zQs[tileMask]=tileQs
+            Qs[zMask]=zQs
+
+        return log10M500cs, Qs, fRels
+
+
     def _drawSampleRow(self, QFit = None, tileName = None):
         hmfEval=0.
         hmfSample=1.
@@ -2,21 +2,23 @@
 
 nemo - SZ cluster and source detection package
 
+Submodules are imported on first access (e.g., ``nemo.maps``), so that ``import nemo`` is quick.
+
 """
 
-from . import catalogs 
-from . import photometry
-from . import plotSettings
-from . import startUp
-from . import filters
-from . import signals
-from . import completeness
-from . import maps
-from . import pipelines
+import importlib
 
-__all__ = ['startUp', 'catalogs', 'maps', 'filters', 'photometry', 
-           'signals', 'completeness', 'pipelines', 'plotSettings']
+__all__ = ['startUp', 'catalogs', 'maps', 'filters', 'photometry',
+           'signals', 'completeness', 'pipelines', 'plotSettings', 'profiling']
 
 from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
+
+def __getattr__(name):
+    if name in __all__ or name in ['MockSurvey', 'gnfw']:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+def __dir__():
+    return sorted(list(globals().keys())+__all__)
@@ -0,0 +1,40 @@
+"""
+
+This module contains a helper for deferring the import of heavy dependencies (e.g., pylab, pyccl) until they
+are actually used.
+
+"""
+
+import sys
+import importlib.util
+
+#------------------------------------------------------------------------------------------------------------
+def lazyImport(name):
+    """Returns the named module, without executing it until one of its attributes is first accessed. This
+    can be used in place of a module-level import statement, e.g., ``plt=lazyImport('pylab')`` instead of
+    ``import pylab as plt``, for modules that take a long time to import but are only needed by some
+    routines.
+
+    Args:
+        name (:obj:`str`): Name of the module to import (e.g., 'pyccl').
+
+    Returns:
+        The module.
+
+    Raises:
+        ImportError: If the module cannot be found.
+
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+    spec=importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '%s'" % (name), name = name)
+    loader=importlib.util.LazyLoader(spec.loader)
+    spec.loader=loader
+    module=importlib.util.module_from_spec(spec)
+    sys.modules[name]=module
+    loader.exec_module(module)
+
+    return module
@@ -16,7 +16,11 @@ from astropy.coordinates import match_coordinates_sky
 import astropy.io.fits as pyfits
 from scipy import ndimage
 from scipy import stats as sstats
+from scipy.spatial import cKDTree
+from scipy import sparse
+import scipy.sparse.csgraph
 from . import maps
+from . import profiling
 
 # For adding meta data to output
 import datetime
@@ -97,6 +101,111 @@ COLUMN_FORMATS=COLUMN_FORMATS+formatsToAdd
 if len(COLUMN_NAMES) != len(COLUMN_FORMATS):
     raise Exception("COLUMN_NAMES and COLUMN_FORMATS lists should be same length")
 
+#------------------------------------------------------------------------------------------------------------
+class SkyIndex(object):
+    """A spatial index for fast radius queries on the celestial sphere, built on a KD-tree of unit vectors.
+
+    Separations are computed using :meth:`astCoords.calcAngSepDeg` for candidates found using the tree, so
+    queries return the same objects as a brute force search over the whole catalog.
+
+    Args:
+        RADeg (:obj:`np.ndarray`): R.A. coordinates (decimal degrees) to index.
+        decDeg (:obj:`np.ndarray`): Declination coordinates (decimal degrees) to index.
+
+    Attributes:
+        RADeg (:obj:`np.ndarray`): R.A. coordinates of all indexed positions (indices returned by queries
+            refer to these arrays).
+        decDeg (:obj:`np.ndarray`): Declination coordinates of all indexed positions.
+
+    """
+
+    def __init__(self, RADeg, decDeg):
+        self.RADeg=np.atleast_1d(np.asarray(RADeg, dtype = np.float64))
+        self.decDeg=np.atleast_1d(np.asarray(decDeg, dtype = np.float64))
+        if self.RADeg.shape != self.decDeg.shape:
+            raise Exception("RADeg and decDeg must have the same shape.")
+        self._tree=cKDTree(self._unitVectors(self.RADeg, self.decDeg).reshape(-1, 3))
+
+
+    def __len__(self):
+        return len(self.RADeg)
+
+
+    @staticmethod
+    def _unitVectors(RADeg, decDeg):
+        RARad=np.radians(RADeg)
+        decRad=np.radians(decDeg)
+        cosDec=np.cos(decRad)
+        return np.stack([cosDec*np.cos(RARad), cosDec*np.sin(RARad), np.sin(decRad)], axis = -1)
+
+
+    @staticmethod
+    def _chordLength(radiusDeg):
+        # Slightly generous, so that candidates on the boundary are not lost to rounding
+        radiusRad=np.radians(min(radiusDeg, 180.0))
+        return 2*np.sin(radiusRad/2)*(1+1e-9)+1e-12
+
+
+    def queryRadius(self, RADeg, decDeg, radiusDeg, inclusive = False):
+        """Finds all indexed positions within the given radius of the given position(s).
+
+        Args:
+            RADeg (:obj:`float` or :obj:`np.ndarray`): R.A. coordinate(s) in decimal degrees.
+            decDeg (:obj:`float` or :obj:`np.ndarray`): Declination coordinate(s) in decimal degrees.
+            radiusDeg (:obj:`float`): Search radius in decimal degrees.
+            inclusive (:obj:`bool`, optional): If True, positions exactly at `radiusDeg` are included.
+
+        Returns:
+            Sorted array of indices of matching positions if a single position is given, otherwise a list
+            of such arrays, one per position.
+
+        """
+
+        scalarInput=np.ndim(RADeg) == 0
+        RADeg=np.atleast_1d(np.asarray(RADeg, dtype = np.float64))
+        decDeg=np.atleast_1d(np.asarray(decDeg, dtype = np.float64))
+        treeCandidates=self._tree.query_ball_point(self._unitVectors(RADeg, decDeg), self._chordLength(radiusDeg))
+        results=[]
+        for i in range(len(RADeg)):
+            candidates=np.array(treeCandidates[i], dtype = int)
+            if len(candidates) > 0:
+                rDeg=astCoords.calcAngSepDeg(RADeg[i], decDeg[i], self.RADeg[candidates], self.decDeg[candidates])
+                if inclusive == True:
+                    candidates=candidates[rDeg <= radiusDeg]
+                else:
+                    candidates=candidates[rDeg < radiusDeg]
+            results.append(np.sort(candidates))
+        if scalarInput == True:
+            return results[0]
+
+        return results
+
+
+    def queryPairs(self, radiusDeg, inclusive = False):
+        """Finds all pairs of indexed positions separated by less than the given radius.
+
+        Args:
+            radiusDeg (:obj:`float`): Matching radius in decimal degrees.
+            inclusive (:obj:`bool`, optional): If True, pairs separated by exactly `radiusDeg` are included.
+
+        Returns:
+            Two arrays of indices (i, j), with i < j, giving the positions in each pair.
+
+        """
+
+        pairs=self._tree.query_pairs(self._chordLength(radiusDeg), output_type = 'ndarray')
+        if len(pairs) == 0:
+            return np.zeros(0, dtype = int), np.zeros(0, dtype = int)
+        i, j=pairs[:, 0], pairs[:, 1]
+        rDeg=astCoords.calcAngSepDeg(self.RADeg[i], self.decDeg[i], self.RADeg[j], self.decDeg[j])
+        if inclusive == True:
+            keep=rDeg <= radiusDeg
+        else:
+            keep=rDeg < radiusDeg
+        i, j=np.minimum(i[keep], j[keep]), np.maximum(i[keep], j[keep])
+
+        return i, j
+
 #------------------------------------------------------------------------------------------------------------
 def _posRecFitFunc(snr, snrFold, pedestal, norm):
     """Fitting function used for position recovery offset (') in terms of fixed_SNR - see
@@ -201,6 +310,7 @@ def checkCrossMatch(distArcmin, fixedSNR, z = None, addRMpc = 0.5, fitSNRFold =
         return False
 
 #------------------------------------------------------------------------------------------------------------
+@profiling.stage('makeOptimalCatalog')
 def makeOptimalCatalog(catalogDict, constraintsList = [], photFilter = None, method = 'ref-first'):
     """Identifies common objects between every catalog in the input dictionary of catalogs, and creates a
     master catalog with one entry per object, keeping only the details of the highest signal-to-noise
@@ -280,10 +390,10 @@ def _makeOptimalCatalogRefFirst(catalogDict, constraintsList = [], photFilter =
     # Add in optimal SNR columns info
     colsToRewrite=['SNR', 'template', 'y_c', 'err_y_c', 'deltaT_c', 'err_deltaT_c']
     if len(refScaleCatalog) > 0 and len(mergedCatalog) > 0:
-        for row in refScaleCatalog:
-            rDeg=astCoords.calcAngSepDeg(row['RADeg'], row['decDeg'], mergedCatalog['RADeg'].data,
-                                         mergedCatalog['decDeg'].data)
-            xIndices=np.where(rDeg < XMATCH_RADIUS_DEG)[0]
+        mergedIndex=SkyIndex(mergedCatalog['RADeg'].data, mergedCatalog['decDeg'].data)
+        xIndicesList=mergedIndex.queryRadius(refScaleCatalog['RADeg'].data, refScaleCatalog['decDeg'].data,
+                                             XMATCH_RADIUS_DEG)
+        for row, xIndices in zip(refScaleCatalog, xIndicesList):
             if len(xIndices) > 1:
                 bestSNRIndex=xIndices[np.argmax(mergedCatalog[xIndices]['SNR'])]
                 if mergedCatalog['SNR'][bestSNRIndex] > row['SNR']:
@@ -324,10 +434,9 @@ def _makeOptimalCatalogForcedRef(catalogDict, constraintsList = []):
         allCatalogs=atpy.vstack(allCatalogs)
         mergedCatalog=allCatalogs.copy()
         mergedCatalog.add_column(atpy.Column(np.zeros(len(mergedCatalog)), 'toRemove'))
-        for row in allCatalogs:
-            rDeg=astCoords.calcAngSepDeg(row['RADeg'], row['decDeg'], allCatalogs['RADeg'].data,
-                                         allCatalogs['decDeg'].data)
-            xIndices=np.where(rDeg < XMATCH_RADIUS_DEG)[0]
+        allIndex=SkyIndex(allCatalogs['RADeg'].data, allCatalogs['decDeg'].data)
+        xIndicesList=allIndex.queryRadius(allCatalogs['RADeg'].data, allCatalogs['decDeg'].data, XMATCH_RADIUS_DEG)
+        for xIndices in xIndicesList:
             if len(xIndices) > 1:
                 xMatches=allCatalogs[xIndices]
                 xMatchIndex=np.argmax(xMatches['SNR'])
@@ -671,10 +780,35 @@ def writeCatalog(catalog, outFileName, constraintsList = []):
     else:
         cutCatalog.write(outFileName, overwrite = True)
 
+#------------------------------------------------------------------------------------------------------------
+def _findMatchGroups(RADeg, decDeg, radiusDeg):
+    """Groups objects that are linked by chains of separations smaller than `radiusDeg`, using a single
+    :class:`SkyIndex` pair query followed by connected components labelling.
+
+    Returns:
+        Array of group labels (one per object), and a boolean array that is True for objects that have at
+        least one other object within `radiusDeg`.
+
+    """
+
+    index=SkyIndex(RADeg, decDeg)
+    i, j=index.queryPairs(radiusDeg)
+    numObjects=len(index)
+    graph=sparse.coo_matrix((np.ones(len(i), dtype = np.int8), (i, j)), shape = (numObjects, numObjects))
+    numGroups, labels=sparse.csgraph.connected_components(graph, directed = False)
+    hasMatch=np.zeros(numObjects, dtype = bool)
+    hasMatch[i]=True
+    hasMatch[j]=True
+
+    return labels, hasMatch
+
 #------------------------------------------------------------------------------------------------------------
 def removeDuplicates(tab):
     """Removes duplicate objects from the catalog - keeping the highest SNR detection for each duplicate. 
     This routine is used to clean up the output of MPI runs (where we have overlapping tiles).
+
+    Objects closer than `XMATCH_RADIUS_DEG` are linked into groups (including chains of matches), and only
+    the highest SNR object in each group is kept.
     
     Args:
         tab (:obj:`astropy.table.Table`): The object catalog to be checked for duplicates.
@@ -687,32 +821,24 @@ def removeDuplicates(tab):
 
     if len(tab) == 1:
         return tab, 1, []
+    if len(tab) == 0:
+        return tab, 0, []
     
     # Find all duplicates
-    cat=SkyCoord(ra = tab['RADeg'].data, dec = tab['decDeg'].data, unit = 'deg')
-    xIndices, rDeg, sep3d = match_coordinates_sky(cat, cat, nthneighbor = 2)
-    mask=np.less(rDeg.value, XMATCH_RADIUS_DEG)
-    noDupMask=np.greater_equal(rDeg.value, XMATCH_RADIUS_DEG)
-    dupTab=tab[mask]
-    noDupTab=tab[noDupMask]
+    labels, hasMatch=_findMatchGroups(tab['RADeg'].data, tab['decDeg'].data, XMATCH_RADIUS_DEG)
+    dupTab=tab[hasMatch]
+    noDupTab=tab[np.logical_not(hasMatch)]
     
     # All duplicates removed?
-    if mask.sum() == 0:
+    if hasMatch.sum() == 0:
         return tab, 0, []
     
-    # Much faster
-    keepMask=np.zeros(len(dupTab), dtype = bool)
-    for i in range(len(dupTab)):
-        # NOTE: astCoords does not like atpy.Columns sometimes...
-        rDeg=astCoords.calcAngSepDeg(dupTab['RADeg'][i], dupTab['decDeg'][i], dupTab['RADeg'].data, dupTab['decDeg'].data)
-        mask=np.less_equal(rDeg, XMATCH_RADIUS_DEG)
-        if mask.sum() == 0:	# This ought not to be possible but catch anyway
-            bestIndex=i
-        else:
-            indices=np.where(mask == True)[0]
-            bestIndex=indices[np.equal(dupTab['SNR'][mask], dupTab['SNR'][mask].max())][0]
-        keepMask[bestIndex]=True
-    keepTab=dupTab[keepMask]
+    # Keep the highest SNR object in each group (the first one in the table if there is a tie)
+    dupLabels=labels[hasMatch]
+    order=np.lexsort((np.arange(len(dupTab)), -np.array(dupTab['SNR']), dupLabels))
+    firstInGroup=np.ones(len(order), dtype = bool)
+    firstInGroup[1:]=dupLabels[order][1:] != dupLabels[order][:-1]
+    keepTab=dupTab[np.sort(order[firstInGroup])]
     
     keepTab=atpy.vstack([keepTab, noDupTab])
     keepTab.sort('RADeg')
@@ -737,40 +863,21 @@ def flagTileBoundarySplits(tab, xMatchRadiusArcmin = 2.5):
     
     """
     
-    if len(tab) == 1:
+    if len(tab) <= 1:
         return tab
     
     xMatchRadiusDeg=xMatchRadiusArcmin/60.
     
-    # Find all potential duplicates within a given matching radius
-    cat=SkyCoord(ra = tab['RADeg'].data, dec = tab['decDeg'].data, unit = 'deg')
-    xIndices, rDeg, sep3d = match_coordinates_sky(cat, cat, nthneighbor = 2)
-    mask=np.less(rDeg.value, xMatchRadiusDeg)
-    noDupMask=np.greater_equal(rDeg.value, xMatchRadiusDeg)
-    dupTab=tab[mask]
-    noDupTab=tab[noDupMask]
+    # Find all groups of potential duplicates within a given matching radius
+    labels, hasMatch=_findMatchGroups(tab['RADeg'].data, tab['decDeg'].data, xMatchRadiusDeg)
         
-    # Identify pairs split across tile boundaries
-    tileBoundarySplit=np.zeros(len(dupTab), dtype = bool)
-    for i in range(len(dupTab)):
-        # NOTE: astCoords does not like atpy.Columns sometimes...
-        rDeg=astCoords.calcAngSepDeg(dupTab['RADeg'][i], dupTab['decDeg'][i], dupTab['RADeg'].data, dupTab['decDeg'].data)
-        mask=np.less_equal(rDeg, xMatchRadiusDeg)
-        if mask.sum() == 0:	# This ought not to be possible but catch anyway
-            bestIndex=i
-        else:
-            indices=np.where(mask == True)[0]
-            bestIndex=indices[np.equal(dupTab['SNR'][mask], dupTab['SNR'][mask].max())][0]
-            if np.unique(dupTab['tileName'][indices]).shape[0] > 1:
-                tileBoundarySplit[indices]=True
-    dupTab['tileBoundarySplit']=tileBoundarySplit
-    dupTab=dupTab[tileBoundarySplit]
+    # Identify groups split across tile boundaries, by counting the distinct tiles in each group
+    tileNames, tileIndices=np.unique(np.array(tab['tileName']), return_inverse = True)
+    groupTiles=np.unique(labels.astype(np.int64)*len(tileNames)+tileIndices.ravel())
+    numTilesInGroup=np.bincount(groupTiles // len(tileNames), minlength = labels.max()+1)
     
     # Flag in the main table
-    tab['tileBoundarySplit']=np.zeros(len(tab), dtype = bool)
-    for row in dupTab:
-        mask=(tab['name'] == row['name'])
-        tab['tileBoundarySplit'][mask]=True
+    tab['tileBoundarySplit']=np.logical_and(hasMatch, numTilesInGroup[labels] > 1)
         
     return tab
 
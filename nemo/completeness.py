@@ -9,7 +9,6 @@ import sys
 import resource
 import glob
 import numpy as np
-import pylab as plt
 import astropy.table as atpy
 from astLib import *
 from scipy import stats
@@ -19,8 +18,8 @@ from scipy import ndimage
 from scipy import optimize
 from scipy import integrate
 from scipy import special
-import pyccl as ccl
 import nemo
+from ._lazy import lazyImport
 from . import signals
 from . import maps
 from . import MockSurvey
@@ -28,7 +27,6 @@ from . import plotSettings
 from . import startUp
 from . import catalogs
 from collections import OrderedDict
-import colorcet
 import types
 import pickle
 import astropy.io.fits as pyfits
@@ -36,6 +34,9 @@ import time
 import shutil
 import yaml
 from decimal import Decimal
+plt=lazyImport('pylab')
+ccl=lazyImport('pyccl')
+colorcet=lazyImport('colorcet')
 
 # If want to catch warnings as errors...
 #import warnings
@@ -263,6 +264,9 @@ class SelFn(object):
             self.tileAreas=np.array(tileAreas)
             self.fracArea=self.tileAreas/self.totalAreaDeg2
 
+            # Flat versions of the RMS tables, for calcFastCompletenessAllTiles
+            self._setUpFlatRMSArrays()
+
             # Check of area consistency
             #checkAreaDeg2=0
             #for tileName in self.tileNames:
@@ -525,12 +529,7 @@ class SelFn(object):
                                                                                   mode = mode, truncate = truncate)
 
         elif self.method == 'fast' or self.method == 'faster':
-            compMzCube=np.zeros([len(self.tileNames), self.clusterCount.shape[0], self.clusterCount.shape[1]])
-            t0=time.time()
-            for tileIndex in range(len(self.tileNames)):
-                tileName=self.tileNames[tileIndex]
-                compMzCube[tileIndex]=self.calcFastCompletenessInTile(tileName, return_y0Grid = False)
-            self.compMz=np.average(compMzCube, axis = 0, weights = self.fracArea)
+            self.compMz=self.calcFastCompletenessAllTiles()
 
         # Deals with corner at high S/N, high-z sometimes weirdly having lower than 1 completeness
         for i in range(self.compMz.shape[0]):
@@ -551,6 +550,114 @@ class SelFn(object):
         self._last_ns=self.mockSurvey.ns
 
 
+    def calcFastCompletenessAllTiles(self, maxChunkSize = 2**24):
+        """Calculate the survey-average completeness on the (M, z) grid using the fast method, evaluating
+        all tiles and all rows of their RMS tables together. This gives the same result as averaging the
+        output of :meth:`calcFastCompletenessInTile` over all tiles, weighted by tile area.
+
+        The RMS tables of all tiles are concatenated into flat arrays (see :meth:`_setUpFlatRMSArrays`),
+        and the completeness is evaluated in a few broadcast operations. When intrinsic scatter is included,
+        and no bias model is used, the noise integral only depends on the tile (through *Q*), so the
+        contributions of all RMS table rows in each tile are summed before the scatter integral is done.
+
+        Args:
+            maxChunkSize (:obj:`int`, optional): Maximum number of array elements to process at once,
+                used to bound memory usage.
+
+        Returns:
+            2d array (completeness on the M,z grid, with same dimensions as ``self.clusterCount``)
+
+        """
+
+        # One signal grid per tile, or just one if using average Q
+        if self.useAverageQ == False:
+            y0Grids=np.array([self._makeSignalGrid(tileName = tileName) for tileName in self.tileNames])
+            rowGrids=self._flatTileIndices
+        else:
+            y0Grids=np.array([self._makeSignalGrid(tileName = None)])
+            rowGrids=np.zeros(len(self._flatRMS), dtype = int)
+        gridSize=y0Grids[0].size
+        compMz=np.zeros(y0Grids.shape[1:])
+        scatter=self.scalingRelationDict['sigma_int']
+
+        if scatter > 0 and self.biasModel is None:
+            # Noise part of the integrand on each tile's ln(y0) grid, summed over RMS table rows
+            numPoints=44
+            lnyy=np.linspace(np.log(y0Grids).min(axis = (1, 2)), np.log(y0Grids).max(axis = (1, 2)), numPoints, axis = 1)
+            arg=self._get_erf_diff(np.exp(lnyy[rowGrids])/self._flatRMS[:, np.newaxis], self.SNRCut, 1e5, self.SNRCut)
+            noiseTerm=np.zeros(lnyy.shape)
+            np.add.at(noiseTerm, rowGrids, arg*self._flatWeights[:, np.newaxis])
+            # Trapezoid rule weights (uniform spacing in ln y0)
+            trapWeights=np.ones(lnyy.shape)*((lnyy[:, -1]-lnyy[:, 0])/(numPoints-1))[:, np.newaxis]
+            trapWeights[:, [0, -1]]=trapWeights[:, [0, -1]]/2
+            noiseTerm=noiseTerm*trapWeights
+            fac=1./np.sqrt(2.*np.pi*scatter**2)
+            chunkGrids=max(1, maxChunkSize // (numPoints*gridSize))
+            for start in range(0, len(y0Grids), chunkGrids):
+                end=start+chunkGrids
+                mu=np.log(y0Grids[start:end])
+                arg0=(lnyy[start:end, :, np.newaxis, np.newaxis]-mu[:, np.newaxis])/(np.sqrt(2.)*scatter)
+                compMz=compMz+np.einsum('gk,gkij->ij', noiseTerm[start:end], fac*np.exp(-arg0**2))
+        else:
+            # General case - every RMS table row contributes a different term, so chunk over rows
+            if scatter > 0:
+                numPoints=44
+                chunkRows=max(1, maxChunkSize // (numPoints*gridSize))
+            else:
+                chunkRows=max(1, maxChunkSize // gridSize)
+            for start in range(0, len(self._flatRMS), chunkRows):
+                end=start+chunkRows
+                y0=y0Grids[rowGrids[start:end]]
+                RMS=self._flatRMS[start:end, np.newaxis, np.newaxis]
+                weights=self._flatWeights[start:end]
+                if self.biasModel is not None:
+                    trueSNR=y0/RMS
+                    corrFactors=self.biasModel['func'](trueSNR, self.biasModel['params'])
+                    if self.truncateDeltaSNR is not None:
+                        corrFactors[trueSNR < self.SNRCut-self.truncateDeltaSNR]=1.0
+                else:
+                    corrFactors=1.0
+                if scatter == 0:
+                    erfDiff=self._get_erf_diff((y0*corrFactors)/RMS, self.SNRCut, 1e5, self.SNRCut)
+                    compMz=compMz+np.tensordot(weights, erfDiff, axes = 1)
+                else:
+                    logY0Grids=np.log(y0Grids)
+                    lnyy=np.linspace(logY0Grids.min(axis = (1, 2)), logY0Grids.max(axis = (1, 2)), numPoints, axis = 1)[rowGrids[start:end]]
+                    arg=self._get_erf_diff(np.exp(lnyy)/RMS[:, :, 0], self.SNRCut, 1e5, self.SNRCut)
+                    mu=np.log(y0*corrFactors)
+                    arg0=(lnyy[:, :, np.newaxis, np.newaxis]-mu[:, np.newaxis])/(np.sqrt(2.)*scatter)
+                    integrand=(1./np.sqrt(2.*np.pi*scatter**2))*np.exp(-arg0**2)*(arg*weights[:, np.newaxis])[:, :, np.newaxis, np.newaxis]
+                    compMz=compMz+integrate.trapezoid(integrand, x = lnyy[:, :, np.newaxis, np.newaxis], axis = 1).sum(axis = 0)
+
+        if self.maxTheta500Arcmin is not None:
+            compMz=compMz*np.array(self._theta500Grid < self.maxTheta500Arcmin, dtype = float)
+
+        return compMz
+
+
+    def _setUpFlatRMSArrays(self):
+        """Concatenates the RMS tables of all tiles into flat arrays of noise values, weights (the fraction
+        of the total survey area that each row represents), and tile indices, for use by
+        :meth:`calcFastCompletenessAllTiles`. This is done when the RMS tables are loaded, and must be
+        called again if `RMSDict`, `tileNames`, or `fracArea` are changed.
+
+        """
+
+        RMSValues=[]
+        weights=[]
+        tileIndices=[]
+        fracAreaSum=self.fracArea.sum()
+        for tileIndex in range(len(self.tileNames)):
+            RMSTab=self.RMSDict[self.tileNames[tileIndex]]
+            areaDeg2=np.array(RMSTab['areaDeg2'], dtype = np.float64)
+            RMSValues.append(np.array(RMSTab['y0RMS'], dtype = np.float64))
+            weights.append((self.fracArea[tileIndex]/fracAreaSum)*(areaDeg2/areaDeg2.sum()))
+            tileIndices.append(np.ones(len(RMSTab), dtype = int)*tileIndex)
+        self._flatRMS=np.concatenate(RMSValues)
+        self._flatWeights=np.concatenate(weights)
+        self._flatTileIndices=np.concatenate(tileIndices)
+
+
     def calcFastCompletenessInTile(self, tileName, return_y0Grid = False, RMSTab = None):
         """Calculate completeness on the (M, z) grid for the given tile using the fast method.
 
@@ -1041,14 +1148,12 @@ def loadIntersectionMask(tileName, selFnDir, footprint):
     return intersectMask, wcs
 
 #------------------------------------------------------------------------------------------------------------
-def _loadTile(tileName, baseDir, baseFileName, extension = 'fits'):
-    """Generic function to load a tile image from either a multi-extension FITS file, or a file with 
-    #tileName.fits type extension, whichever is found.
-        
-    Returns map array, wcs
-    
+def _getTileFileName(tileName, baseDir, baseFileName, extension = 'fits'):
+    """Returns the path to the file containing the given tile image - either a #tileName.fits type file,
+    or a multi-extension FITS file, whichever is found.
+
     """
-    
+
     # After tidyUp is run, this will be a MEF file... during first run, it won't be (written under MPI)
     if os.path.exists(baseDir+os.path.sep+"%s#%s.%s" % (baseFileName, tileName, extension)):
         fileName=baseDir+os.path.sep+"%s#%s.%s" % (baseFileName, tileName, extension)
@@ -1057,6 +1162,44 @@ def _loadTile(tileName, baseDir, baseFileName, extension = 'fits'):
         fileName=baseDir+os.path.sep+tileName+os.path.sep+"%s#%s.%s" % (baseFileName, tileName, extension)
     else:
         fileName=baseDir+os.path.sep+"%s.%s" % (baseFileName, extension)
+
+    return fileName
+
+#------------------------------------------------------------------------------------------------------------
+def _openTileHDU(tileName, baseDir, baseFileName, extension = 'fits'):
+    """Opens (memory mapped) the file containing the given tile image, without reading the image data, so
+    that it can be read in sections. The file must be closed by the caller.
+
+    Returns HDUList, HDU containing the tile image
+
+    """
+
+    img=pyfits.open(_getTileFileName(tileName, baseDir, baseFileName, extension = extension), memmap = True)
+    if tileName in img:
+        hdu=img[tileName]
+    else:
+        # Single tile files may be compressed - use the first extension with data
+        hdu=None
+        for h in img:
+            if h.is_image and h.header.get('NAXIS', 0) > 0:
+                hdu=h
+                break
+    if hdu is None:
+        img.close()
+        raise Exception("No image data found for tile '%s' in %s" % (tileName, baseFileName))
+
+    return img, hdu
+
+#------------------------------------------------------------------------------------------------------------
+def _loadTile(tileName, baseDir, baseFileName, extension = 'fits'):
+    """Generic function to load a tile image from either a multi-extension FITS file, or a file with 
+    #tileName.fits type extension, whichever is found.
+        
+    Returns map array, wcs
+    
+    """
+    
+    fileName=_getTileFileName(tileName, baseDir, baseFileName, extension = extension)
     with pyfits.open(fileName) as img:
         # If we find the tile - great. If not, we use first extension with data as it'll be compressed
         if tileName in img:
@@ -1193,11 +1336,15 @@ def makeIntersectionMask(tileName, selFnDir, label, masksList = []):
     return intersectMask
 
 #------------------------------------------------------------------------------------------------------------
-def getRMSTab(tileName, photFilterLabel, selFnDir, footprintLabel = None, maxFlags = None):
+def getRMSTab(tileName, photFilterLabel, selFnDir, footprintLabel = None, maxFlags = None,
+              quantizationStep = None, rowsPerChunk = 1024):
     """Makes a table containing map area in the tile refered to by `tileName` against RMS (noise level)
     values, compressing the information in the RMS maps. Results are cached under `selFnDir`, and read from
     disk if found.
-    
+
+    The table is built in a single pass over the tile, which is read from the RMS and area mask files in
+    chunks of `rowsPerChunk` rows at a time, so that the full tile need not be held in memory.
+
     Args:
         tileName (:obj:`str`): The name of the tile.
         photFilterLabel (:obj:`str`): Name of the reference filter, as specified in, e.g., a 
@@ -1208,7 +1355,12 @@ def getRMSTab(tileName, photFilterLabel, selFnDir, footprintLabel = None, maxFla
             modeling.
         footprintLabel (:obj:`str`, optional): The name of the footprint in which the calculation will be
             done, as defined in the :ref:`nemoCommand` config file (see :ref:`selFnFootprints`).
-    
+        maxFlags (:obj:`int`, optional): If given, exclude pixels in the flag mask with values greater than
+            this from the area calculation.
+        quantizationStep (:obj:`float`, optional): If given, round the RMS values to the nearest multiple
+            of this step before tabulating, reducing the number of rows in the table.
+        rowsPerChunk (:obj:`int`, optional): Number of map rows to read and process at a time.
+
     Returns:
         A table of RMS (noise level) values versus area in square degrees (:obj:`astropy.table.Table`).
     
@@ -1222,40 +1374,108 @@ def getRMSTab(tileName, photFilterLabel, selFnDir, footprintLabel = None, maxFla
         RMSTabFileName=RMSTabFileName.replace(".fits", "_maxFlags%d.fits" % (maxFlags))
     if os.path.exists(RMSTabFileName):
         tab=atpy.Table().read(RMSTabFileName)
-        return tab[np.where(tab['tileName'] == tileName)]
+        if checkRMSTabQuantizationStep(tab, quantizationStep) == True:
+            return tab[np.where(tab['tileName'] == tileName)]
+        print("... cached RMS table %s was made with a different quantizationStep - remaking" % (RMSTabFileName))
 
     # Table doesn't exist, so make it...
     print(("... making RMS table for tile = %s, footprint = %s, maxFlags = %s" % (tileName, footprintLabel, str(maxFlags))))
-    RMSMap, wcs=loadRMSMap(tileName, selFnDir, photFilterLabel)
-    areaMap, wcs=loadAreaMask(tileName, selFnDir)
-    if maxFlags is not None:
-        flagMask, wcs=loadFlagMask(tileName, selFnDir)
-        areaMap[flagMask > maxFlags]=0
-    areaMapSqDeg=(maps.getPixelAreaArcmin2Map(areaMap.shape, wcs)*areaMap)/(60**2)
-
-    if footprintLabel != None:  
+    if footprintLabel is not None:
         intersectMask=makeIntersectionMask(tileName, selFnDir, footprintLabel)
-        areaMapSqDeg=areaMapSqDeg*intersectMask        
-        RMSMap=RMSMap*intersectMask
-
-    RMSValues=np.unique(RMSMap[np.nonzero(RMSMap)])
-    totalAreaDeg2=areaMapSqDeg.sum()
-    tileArea=np.zeros(len(RMSValues))
-    for i in range(len(RMSValues)):
-        tileArea[i]=areaMapSqDeg[np.equal(RMSMap, RMSValues[i])].sum()
+    openFiles=[]
+    try:
+        RMSImg, RMSHDU=_openTileHDU(tileName, selFnDir, "RMSMap_%s" % (photFilterLabel))
+        openFiles.append(RMSImg)
+        areaImg, areaHDU=_openTileHDU(tileName, selFnDir, "areaMask")
+        openFiles.append(areaImg)
+        if maxFlags is not None:
+            flagImg, flagHDU=_openTileHDU(tileName, selFnDir, "flagMask")
+            openFiles.append(flagImg)
+        wcs=astWCS.WCS(areaHDU.header, mode = 'pyfits')
+        height, width=areaHDU.shape
+        # Pixel area only depends on the row
+        pixAreaSqDeg=maps.getPixelAreaArcmin2Map([height, 1], wcs)[:, 0].astype(np.float64)/(60**2)
+
+        # Accumulate (RMS value, area) pairs chunk-by-chunk, then merge
+        chunkValues=[]
+        chunkAreas=[]
+        totalAreaDeg2=0.0
+        for yMin in range(0, height, rowsPerChunk):
+            yMax=min(yMin+rowsPerChunk, height)
+            RMSChunk=maps.readHDUSection(RMSHDU, (slice(yMin, yMax), slice(None)))
+            areaChunk=maps.readHDUSection(areaHDU, (slice(yMin, yMax), slice(None))).astype(np.float64)
+            if maxFlags is not None:
+                areaChunk[maps.readHDUSection(flagHDU, (slice(yMin, yMax), slice(None))) > maxFlags]=0
+            areaChunk=areaChunk*pixAreaSqDeg[yMin:yMax, np.newaxis]
+            if footprintLabel is not None:
+                areaChunk=areaChunk*intersectMask[yMin:yMax]
+                RMSChunk=RMSChunk*intersectMask[yMin:yMax]
+            totalAreaDeg2=totalAreaDeg2+areaChunk.sum()
+            nonZero=np.nonzero(RMSChunk)
+            if len(nonZero[0]) == 0:
+                continue
+            values=RMSChunk[nonZero]
+            if quantizationStep is not None:
+                values=np.maximum(np.round(values/quantizationStep), 1)*quantizationStep
+            values, inverse=np.unique(values, return_inverse = True)
+            chunkValues.append(values)
+            chunkAreas.append(np.bincount(inverse.ravel(), weights = areaChunk[nonZero], minlength = len(values)))
+    finally:
+        for img in openFiles:
+            img.close()
+
+    if len(chunkValues) > 0:
+        RMSValues, inverse=np.unique(np.concatenate(chunkValues), return_inverse = True)
+        tileArea=np.bincount(inverse.ravel(), weights = np.concatenate(chunkAreas), minlength = len(RMSValues))
+    else:
+        RMSValues=np.zeros(0)
+        tileArea=np.zeros(0)
     RMSTab=atpy.Table()
     RMSTab.add_column(atpy.Column(tileArea, 'areaDeg2'))
     RMSTab.add_column(atpy.Column(RMSValues, 'y0RMS'))
     # Checks - these should be impossible but we have seen (e.g., when messed up masks)
     tol=0.003
-    if abs(RMSTab['areaDeg2'].sum()-areaMapSqDeg.sum()) > tol:
+    if abs(RMSTab['areaDeg2'].sum()-totalAreaDeg2) > tol:
         raise Exception("Mismatch between area map and area in RMSTab for tile '%s'" % (tileName))
     if np.less(RMSTab['areaDeg2'], 0).sum() > 0:
         raise Exception("Negative area in tile '%s' - check your survey mask (and delete/remake tileDir files if necessary)." % (tileName))
     RMSTab.meta['NEMOVER']=nemo.__version__
+    RMSTab.meta['QSTEP']=_RMSTabQuantizationStepValue(quantizationStep)
 
     return RMSTab
 
+#------------------------------------------------------------------------------------------------------------
+def _RMSTabQuantizationStepValue(quantizationStep):
+    """Returns the value of the `QSTEP` header keyword used to record `quantizationStep` in RMS tables
+    (zero if no quantization was applied).
+
+    """
+
+    if quantizationStep is None:
+        return 0.0
+    return float(quantizationStep)
+
+#------------------------------------------------------------------------------------------------------------
+def checkRMSTabQuantizationStep(RMSTab, quantizationStep):
+    """Checks that the given RMS table (see :meth:`getRMSTab`) was made using the given `quantizationStep`.
+    Tables without the `QSTEP` keyword were made without quantization.
+
+    Args:
+        RMSTab (:obj:`astropy.table.Table`): An RMS table, as produced by :meth:`getRMSTab`.
+        quantizationStep (:obj:`float`): The quantization step (None if no quantization was applied).
+
+    Returns:
+        True if the table was made using `quantizationStep`, False otherwise.
+
+    """
+
+    if 'QSTEP' in RMSTab.meta.keys():
+        tabStep=float(RMSTab.meta['QSTEP'])
+    else:
+        tabStep=0.0
+
+    return tabStep == _RMSTabQuantizationStepValue(quantizationStep)
+
 #------------------------------------------------------------------------------------------------------------
 def downsampleRMSTab(RMSTab, downsampleFactor = 2):
     """Downsamples `RMSTab` (see :meth:`getRMSTab`) in terms of noise resolution, binning by `stepSize`.
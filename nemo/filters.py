@@ -26,7 +26,6 @@ import astropy.wcs as enwcs
 from astLib import *
 import numpy as np
 from numpy import fft
-import pylab as plt
 import os
 from scipy import interpolate
 from scipy import ndimage
@@ -36,7 +35,10 @@ import copy
 import sys
 import glob
 import itertools
+import hashlib
+import json
 import nemo
+from ._lazy import lazyImport
 from . import maps
 from . import signals
 from . import photometry
@@ -44,13 +46,17 @@ from . import catalogs
 from . import plotSettings
 from . import gnfw
 from . import completeness
+from . import profiling
 import astropy.table as atpy
 import time
+plt=lazyImport('pylab')
 
 #-------------------------------------------------------------------------------------------------------------
+@profiling.stage('filterMaps', contextArgs = {'tileName': 'tileName',
+                                           'filterLabel': lambda args: args['filterParams']['label']})
 def filterMaps(unfilteredMapsDictList, filterParams, tileName, diagnosticsDir = '.', \
                selFnDir = '.', verbose = True, undoPixelWindow = True, useCachedFilter = False, \
-               returnFilter = False):
+               returnFilter = False, filterCacheDir = None, workspace = None):
     """Builds and applies filters to the unfiltered map(s). 
     
     Args:
@@ -68,6 +74,10 @@ def filterMaps(unfilteredMapsDictList, filterParams, tileName, diagnosticsDir =
             read from disk, rather than re-calculated (used by source injection simulations).
         returnFilter (:obj:`bool`, optional): If True, the filter object is returned, as well as a dictionary
             containing the filtered map.
+        filterCacheDir (:obj:`str`, optional): If given, path to a directory where filters are cached, keyed
+            by a hash of all of the inputs used to construct them (see :func:`makeFilterCacheKey`).
+        workspace (:obj:`MapWorkspace`, optional): If given, preprocessed maps are taken from (and stored in)
+            this per-tile workspace, so that they can be shared between filters.
     
     Returns:
         A dictionary containing the filtered map in signal units, a signal-to-noise-map, area mask, WCS, and
@@ -81,7 +91,8 @@ def filterMaps(unfilteredMapsDictList, filterParams, tileName, diagnosticsDir =
     print("... making filtered map %s" % (label))
     filterClass=eval('%s' % (f['class']))
     filterObj=filterClass(f['label'], unfilteredMapsDictList, f['params'], tileName = tileName,
-                            diagnosticsDir = diagnosticsDir, selFnDir = selFnDir)
+                            diagnosticsDir = diagnosticsDir, selFnDir = selFnDir,
+                            filterCacheDir = filterCacheDir, workspace = workspace)
     filteredMapDict=filterObj.buildAndApply(useCachedFilter = useCachedFilter)
 
     # Keywords we need for photometry later
@@ -105,6 +116,350 @@ def filterMaps(unfilteredMapsDictList, filterParams, tileName, diagnosticsDir =
     
     return filteredMapDict
     
+#------------------------------------------------------------------------------------------------------------
+def applyInverseNoiseCov(noiseCov, signalArr):
+    """Solves for the product of the inverse of the noise covariance matrix with the signal vector at every
+    Fourier pixel in a single batched operation, i.e., N\ :sup:`-1` *s* for each (*y*, *x*).
+    
+    For one or two frequencies, closed-form inverses are used. Otherwise, a Cholesky decomposition is
+    applied to the whole stack (the noise covariance is positive definite almost everywhere), with pixels
+    where that fails being handled individually using a general inverse. Pixels where the noise covariance
+    matrix is singular are set to zero.
+    
+    Args:
+        noiseCov (:obj:`np.ndarray`): Noise covariance cube, with dimensions (nFreq, nFreq, ny, nx).
+        signalArr (:obj:`np.ndarray`): Signal cube, with dimensions (nFreq, ny, nx).
+    
+    Returns:
+        Array with dimensions (nFreq, ny, nx) of N\ :sup:`-1` *s* (:obj:`np.ndarray`).
+    
+    """
+
+    nFreq=noiseCov.shape[0]
+    if noiseCov.shape[1] != nFreq or signalArr.shape[0] != nFreq or noiseCov.shape[2:] != signalArr.shape[1:]:
+        raise Exception("noiseCov must have dimensions (nFreq, nFreq, ny, nx) matching signalArr (nFreq, ny, nx)")
+
+    result=np.zeros(signalArr.shape, dtype = np.float64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        if nFreq == 1:
+            valid=np.not_equal(noiseCov[0, 0], 0)
+            result[0][valid]=signalArr[0][valid]/noiseCov[0, 0][valid]
+        elif nFreq == 2:
+            a, b, c, d=noiseCov[0, 0], noiseCov[0, 1], noiseCov[1, 0], noiseCov[1, 1]
+            det=a*d-b*c
+            valid=np.not_equal(det, 0)
+            result[0][valid]=((d*signalArr[0]-b*signalArr[1])/det)[valid]
+            result[1][valid]=((a*signalArr[1]-c*signalArr[0])/det)[valid]
+        else:
+            # Cholesky decomposition N = L L^T, done plane-by-plane so it is vectorised over all pixels
+            L=np.zeros(noiseCov.shape, dtype = np.float64)
+            valid=np.ones(noiseCov.shape[2:], dtype = bool)
+            for j in range(nFreq):
+                diag=noiseCov[j, j]-np.sum(L[j, :j]**2, axis = 0)
+                valid=np.logical_and(valid, diag > 0)
+                L[j, j]=np.sqrt(np.where(diag > 0, diag, 1.0))
+                for i in range(j+1, nFreq):
+                    L[i, j]=(noiseCov[i, j]-np.sum(L[i, :j]*L[j, :j], axis = 0))/L[j, j]
+            # Forward substitution (L u = s), then back substitution (L^T x = u)
+            u=np.zeros(signalArr.shape, dtype = np.float64)
+            for i in range(nFreq):
+                u[i]=(signalArr[i]-np.sum(L[i, :i]*u[:i], axis = 0))/L[i, i]
+            for i in reversed(range(nFreq)):
+                result[i]=(u[i]-np.sum(L[i+1:, i]*result[i+1:], axis = 0))/L[i, i]
+            del L, u
+            result[:, np.logical_not(valid)]=0.
+            # Anything that is not positive definite (rare) - same behaviour as the original per-pixel loop
+            for y, x in zip(*np.where(np.logical_not(valid))):
+                try:
+                    result[:, y, x]=np.dot(np.linalg.inv(noiseCov[:, :, y, x]), signalArr[:, y, x])
+                except:
+                    continue
+
+    return result
+
+#------------------------------------------------------------------------------------------------------------
+def _groupedPercentiles(values, groups, numGroups, percentiles):
+    """Calculates percentiles of `values` within each group in a single pass (using the same linear
+    interpolation as :func:`np.percentile`).
+    
+    Args:
+        values (:obj:`np.ndarray`): 1d array of values.
+        groups (:obj:`np.ndarray`): 1d array of integer group indices (0...numGroups-1), one per value.
+        numGroups (:obj:`int`): Total number of groups.
+        percentiles (:obj:`list`): Percentiles to calculate.
+    
+    Returns:
+        2d array (:obj:`np.ndarray`) with dimensions (numGroups, len(percentiles)). Empty groups are NaN.
+    
+    """
+    
+    order=np.lexsort((values, groups))
+    sortedValues=values[order]
+    counts=np.bincount(groups, minlength = numGroups)
+    starts=np.cumsum(counts)-counts
+    result=np.zeros([numGroups, len(percentiles)], dtype = np.float64)+np.nan
+    filled=counts > 0
+    for j in range(len(percentiles)):
+        virtualIndices=(counts[filled]-1)*(percentiles[j]/100.)
+        lowIndices=np.floor(virtualIndices).astype(np.int64)
+        highIndices=np.minimum(lowIndices+1, counts[filled]-1)
+        gamma=virtualIndices-lowIndices
+        a=sortedValues[starts[filled]+lowIndices]
+        b=sortedValues[starts[filled]+highIndices]
+        diff=b-a
+        result[filled, j]=np.where(gamma >= 0.5, b-diff*(1-gamma), a+diff*gamma)
+    
+    return result
+
+#------------------------------------------------------------------------------------------------------------
+def _groupedMeanStd(values, groups, numGroups):
+    """Returns the mean and (population) standard deviation of `values` within each group. Empty groups
+    have mean and standard deviation of zero.
+    
+    """
+    counts=np.bincount(groups, minlength = numGroups)
+    filled=counts > 0
+    mean=np.zeros(numGroups, dtype = np.float64)
+    mean[filled]=np.bincount(groups, weights = values, minlength = numGroups)[filled]/counts[filled]
+    var=np.zeros(numGroups, dtype = np.float64)
+    var[filled]=np.bincount(groups, weights = (values-mean[groups])**2, minlength = numGroups)[filled]/counts[filled]
+    
+    return mean, np.sqrt(var)
+
+#------------------------------------------------------------------------------------------------------------
+def calcGroupedRMS(values, groups, numGroups, estimator = 'clip', sigmaClip = 3.0, numIterations = 10):
+    """Estimates the noise (RMS) within many groups of pixels at once, e.g., all of the cells and weight
+    bins used by :meth:`MapFilter.makeNoiseMap`. Each estimator gives the same results as applying it to
+    each group separately.
+    
+    Args:
+        values (:obj:`np.ndarray`): 1d array of pixel values.
+        groups (:obj:`np.ndarray`): 1d array of integer group indices (0...numGroups-1), one per value.
+        numGroups (:obj:`int`): Total number of groups.
+        estimator (:obj:`str`, optional): Either 'clip' (iterative sigma-clipped standard deviation),
+            'biweight' (biweight scale, with c = 9, as given by :func:`astropy.stats.biweight_scale`; groups
+            with fewer than 10 values are not estimated), or 'percentile' (the 68.3 percentile of the
+            absolute values).
+        sigmaClip (:obj:`float`, optional): Clipping threshold in units of the standard deviation (used only
+            if `estimator` is 'clip').
+        numIterations (:obj:`int`, optional): Maximum number of clipping iterations (used only if
+            `estimator` is 'clip').
+    
+    Returns:
+        1d array (:obj:`np.ndarray`) of RMS values for each group. This is zero for groups where the noise
+        could not be estimated (e.g., empty groups).
+    
+    """
+    
+    values=np.array(values, dtype = np.float64)
+    groups=np.array(groups, dtype = np.int64)
+    counts=np.bincount(groups, minlength = numGroups)
+    RMS=np.zeros(numGroups, dtype = np.float64)
+    if len(values) == 0:
+        return RMS
+    
+    if estimator == 'biweight':
+        c=9.0
+        M=_groupedPercentiles(values, groups, numGroups, [50])[:, 0]
+        d=values-M[groups]
+        MAD=_groupedPercentiles(abs(d), groups, numGroups, [50])[:, 0]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            u=d/(c*MAD[groups])
+        mask=np.less(abs(u), 1)
+        u2=u[mask]**2
+        n=np.bincount(groups[mask], minlength = numGroups)
+        f1=np.bincount(groups[mask], weights = d[mask]**2*(1.0-u2)**4, minlength = numGroups)
+        f2=abs(np.bincount(groups[mask], weights = (1.0-u2)*(1.0-5.0*u2), minlength = numGroups))**2
+        valid=np.logical_and(counts >= 10, MAD > 0)
+        valid=np.logical_and(valid, f2 > 0)
+        RMS[valid]=np.sqrt(n[valid]*f1[valid]/f2[valid])
+    elif estimator == 'percentile':
+        RMS=_groupedPercentiles(abs(values), groups, numGroups, [68.3])[:, 0]
+        RMS[np.isnan(RMS)]=0.
+    elif estimator == 'clip':
+        nonZero=np.bincount(groups, weights = np.not_equal(values, 0), minlength = numGroups)
+        mean, std=_groupedMeanStd(values, groups, numGroups)
+        prevMask=None
+        for i in range(numIterations):
+            mask=np.less(abs(values), abs(mean+sigmaClip*std)[groups])
+            if prevMask is not None and np.array_equal(mask, prevMask):
+                break   # Converged - further iterations would not change anything
+            maskedMean, maskedStd=_groupedMeanStd(values[mask], groups[mask], numGroups)
+            update=np.bincount(groups[mask], minlength = numGroups) > 0
+            mean[update]=maskedMean[update]
+            std[update]=maskedStd[update]
+            prevMask=mask
+        RMS[nonZero > 0]=std[nonZero > 0]
+    else:
+        raise Exception("estimator must be 'clip', 'biweight', or 'percentile' (given '%s')" % (estimator))
+    
+    return RMS
+
+#------------------------------------------------------------------------------------------------------------
+def _fileIdentity(path, hashContents = False):
+    """Returns a JSON-serializable description of a file, used in filter cache keys. By default this is the
+    absolute path, size and modification time. If `hashContents` is True, a hash of the file contents is
+    used instead.
+    
+    """
+    
+    if hashContents == True:
+        with open(path, "rb") as inFile:
+            return {'path': os.path.abspath(path), 'sha1': hashlib.sha1(inFile.read()).hexdigest()}
+    st=os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+#------------------------------------------------------------------------------------------------------------
+def _cacheKeyRepr(obj, tileName, hashContents = False):
+    """Converts `obj` into a JSON-serializable form for hashing into a filter cache key. Paths to files are
+    replaced by file identities (see :func:`_fileIdentity`), and arrays and tables by hashes of their contents.
+    
+    """
+    
+    if isinstance(obj, dict):
+        return {str(k): _cacheKeyRepr(obj[k], tileName, hashContents = (k == 'beamFileName')) for k in obj.keys()}
+    elif isinstance(obj, (list, tuple)):
+        return [_cacheKeyRepr(o, tileName) for o in obj]
+    elif isinstance(obj, atpy.Table):
+        h=hashlib.sha1()
+        for colName in obj.colnames:
+            h.update(colName.encode())
+            h.update(np.ascontiguousarray(obj[colName]).tobytes())
+        return {'table': h.hexdigest()}
+    elif isinstance(obj, np.ndarray):
+        return {'array': hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest(), 'shape': list(obj.shape),
+                'dtype': obj.dtype.str}
+    elif isinstance(obj, str):
+        if os.path.isfile(obj):
+            return _fileIdentity(obj, hashContents = hashContents)
+        elif os.path.isdir(obj) and os.path.exists(obj+os.path.sep+tileName+".fits"):
+            return _fileIdentity(obj+os.path.sep+tileName+".fits")
+        return obj
+    elif isinstance(obj, (bool, int, float)) or obj is None:
+        return obj
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    else:
+        return repr(obj)
+
+#------------------------------------------------------------------------------------------------------------
+def makeFilterCacheKey(filterClassName, paramsDict, unfilteredMapsDictList, tileName, wcs, shape):
+    """Makes a key that identifies a filter by everything that goes into constructing it, for use with the
+    on-disk filter cache (see the `filterCacheDir` config parameter). If any of the inputs change, so does
+    the key, so stale cached filters are never re-used.
+    
+    Args:
+        filterClassName (:obj:`str`): Name of the filter class.
+        paramsDict (:obj:`dict`): Dictionary of filter settings (see :ref:`Filters`). Settings that only
+            control what is written to disk are ignored.
+        unfilteredMapsDictList (:obj:`list`): A list of map dictionaries (see :ref:`InputMaps`), before
+            preprocessing. These contain the paths to the maps, weights, masks and beams, and the
+            preprocessing settings. Beam files are identified by a hash of their contents, and other files
+            by their path, size and modification time.
+        tileName (:obj:`str`): Name of the tile in which the filter will be constructed.
+        wcs (:obj:`astWCS.WCS`): WCS of the (preprocessed) tile.
+        shape (:obj:`tuple`): Dimensions of the (preprocessed) tile (height, width) in pixels.
+    
+    Returns:
+        The key (a hexadecimal string).
+        
+    """
+    
+    ignoreKeys=['saveFilteredMaps', 'saveFilter', 'saveRMSMap', 'saveFreqWeightMap', 'savePlots', 'saveDS9Regions']
+    params={}
+    for key in paramsDict.keys():
+        if key not in ignoreKeys:
+            params[key]=paramsDict[key]
+    keyDict={'nemoVersion': nemo.__version__,
+             'filterClass': filterClassName,
+             'params': _cacheKeyRepr(params, tileName),
+             'maps': _cacheKeyRepr(list(unfilteredMapsDictList), tileName),
+             'header': wcs.header.tostring(),
+             'shape': list(shape)}
+    
+    return hashlib.sha1(json.dumps(keyDict, sort_keys = True).encode()).hexdigest()
+
+#------------------------------------------------------------------------------------------------------------
+class MapWorkspace(object):
+    """A per-tile store of preprocessed maps, shared between all of the filters run on a tile. Each unique
+    combination of map and preprocessing settings is preprocessed (see :meth:`maps.MapDict.preprocess`)
+    only once, and the Fourier transforms of the apodized maps are kept, so that they can be re-used by
+    every filter.
+    
+    Args:
+        tileName (:obj:`str`): Name of the tile.
+        diagnosticsDir (:obj:`str`, optional): Path to the `diagnostics` directory (passed on to
+            :meth:`maps.MapDict.preprocess`).
+    
+    Attributes:
+        tileName (:obj:`str`): Name of the tile.
+        diagnosticsDir (:obj:`str`): Path to the `diagnostics` directory.
+    
+    Note:
+        Map arrays are shared between the filters using the workspace, and so must not be modified in-place.
+        
+    """
+    
+    def __init__(self, tileName, diagnosticsDir = None):
+        self.tileName=tileName
+        self.diagnosticsDir=diagnosticsDir
+        self._preprocessedMapDicts={}
+        self._fMaps={}
+        
+    
+    def makeKey(self, mapDict):
+        """Returns the key that identifies the given (unprocessed) map dictionary in the workspace.
+        
+        Args:
+            mapDict (:obj:`maps.MapDict`): A map dictionary, before preprocessing.
+        
+        Returns:
+            The key (a hexadecimal string).
+        
+        """
+        keyRepr=_cacheKeyRepr(dict(mapDict), self.tileName)
+        return hashlib.sha1(json.dumps(keyRepr, sort_keys = True).encode()).hexdigest()
+        
+        
+    def getPreprocessedMapDict(self, mapDict, key = None):
+        """Returns a preprocessed copy of the given map dictionary, preprocessing the map only if that
+        has not already been done for the same map and settings.
+        
+        Args:
+            mapDict (:obj:`maps.MapDict`): A map dictionary, before preprocessing.
+            key (:obj:`str`, optional): The key for `mapDict`, if already known (see :meth:`makeKey`).
+        
+        Returns:
+            A (shallow) copy of the preprocessed :obj:`maps.MapDict`. The map arrays it contains are shared.
+        
+        """
+        if key is None:
+            key=self.makeKey(mapDict)
+        if key not in self._preprocessedMapDicts.keys():
+            newMapDict=mapDict.copy()
+            newMapDict.preprocess(tileName = self.tileName, diagnosticsDir = self.diagnosticsDir)
+            self._preprocessedMapDicts[key]=newMapDict
+        
+        return self._preprocessedMapDicts[key].copy()
+    
+    
+    def getApodizedFFT(self, key, apodPix):
+        """Returns the Fourier transform of the apodized, preprocessed map with the given key.
+        
+        Args:
+            key (:obj:`str`): The key for the map (see :meth:`makeKey`).
+            apodPix (:obj:`int`): Width of the apodization region in pixels.
+        
+        Returns:
+            The Fourier transform of the map (2d complex :obj:`np.ndarray`).
+        
+        """
+        if (key, apodPix) not in self._fMaps.keys():
+            data=self._preprocessedMapDicts[key]['data']
+            self._fMaps[(key, apodPix)]=enmap.fft(enmap.apod(data, apodPix))
+        
+        return self._fMaps[(key, apodPix)]
+
 #------------------------------------------------------------------------------------------------------------
 class MapFilter(object):
     """Base class for Fourier space filters, defining a common interface.
@@ -121,6 +476,11 @@ class MapFilter(object):
         diagnosticsDir (:obj:`str`, optional): Path to the `diagnostics` directory, where the filters may be
             written to disk.
         selFnDir (:obj:`str`, optional): Path to the `selFn` directory, where area masks may be written.
+        filterCacheDir (:obj:`str`, optional): If given, path to a directory where filters are cached, keyed
+            by a hash of all of the inputs used to construct them (see :func:`makeFilterCacheKey`). This is
+            ignored if the maps contain injected sources or CMB simulations.
+        workspace (:obj:`MapWorkspace`, optional): If given, preprocessed maps are taken from (and stored in)
+            this per-tile workspace, so that they can be shared between filters.
     
     Attributes:
         label (:obj:`str`): Unique label for the filter, can be anything.
@@ -130,6 +490,8 @@ class MapFilter(object):
         selFnDir (:obj:`str`, optional): Path to the `selFn` directory, where area masks may be written.       
         tileName (:obj:`str`): Name of the map tile.
         filterFileName (:obj:`str`): Path (under `diagnosticsDir`) where the cached filter is written.
+        filterCacheFileName (:obj:`str`): Path (under `filterCacheDir`) of the filter in the on-disk cache,
+            or None if the cache is not being used.
         unfilteredMapsDictList (:obj:`list`): A list of dictionaries, each of which describes a map of the sky
             at some frequency (see :ref:`InputMaps`).
         wcs (:obj:`astWCS.WCS`): Object that contains the map World Coordinate System.
@@ -140,7 +502,8 @@ class MapFilter(object):
     
     """
     def __init__(self, label, unfilteredMapsDictList, paramsDict, tileName = 'PRIMARY', writeFilter = False, 
-                 forceRebuild = False, diagnosticsDir = None, selFnDir = None):
+                 forceRebuild = False, diagnosticsDir = None, selFnDir = None, filterCacheDir = None,
+                 workspace = None):
         
         self.label=label
         self.params=paramsDict
@@ -152,16 +515,44 @@ class MapFilter(object):
         
         # Prepare all the unfilteredMaps (in terms of cutting sections, masks etc.)
         # NOTE: This is a copy to deal with repeated runs (yes, it's necessary)
+        # If we have a workspace, maps are only preprocessed once per tile and shared between filters
+        if workspace is not None and workspace.tileName != tileName:
+            raise Exception("workspace is for tile %s, but filter is for tile %s" % (workspace.tileName, tileName))
+        self.workspace=workspace
+        self.workspaceKeys=[]
         self.unfilteredMapsDictList=[]
+        inputMapsDictList=[]
         for mapDict in unfilteredMapsDictList:
             if 'mapToUse' in self.params.keys() and mapDict['label'] != self.params['mapToUse']:
                 continue
-            newMapDict=mapDict.copy()
-            newMapDict.preprocess(tileName = tileName, diagnosticsDir = diagnosticsDir)
+            inputMapsDictList.append(dict(mapDict))
+            if self.workspace is not None:
+                key=self.workspace.makeKey(mapDict)
+                newMapDict=self.workspace.getPreprocessedMapDict(mapDict, key = key)
+                self.workspaceKeys.append(key)
+            else:
+                newMapDict=mapDict.copy()
+                newMapDict.preprocess(tileName = tileName, diagnosticsDir = diagnosticsDir)
             self.unfilteredMapsDictList.append(newMapDict)
         self.wcs=self.unfilteredMapsDictList[0]['wcs']
         self.shape=self.unfilteredMapsDictList[0]['data'].shape
 
+        # On-disk cache of filters, keyed by inputs
+        # Not used for simulated data (e.g., sources injected by maps.sourceInjectionTest, or CMB sims): the
+        # inputs change on every run, and filters made from sims must never be loaded by runs on real maps
+        self.filterCacheDir=filterCacheDir
+        for mapDict in inputMapsDictList:
+            for key in ['injectSources', 'CMBSimSeed']:
+                if key in mapDict.keys() and mapDict[key] is not None:
+                    self.filterCacheDir=None
+        if self.filterCacheDir is not None:
+            self.filterCacheKey=makeFilterCacheKey(self.__class__.__name__, self.params, inputMapsDictList,
+                                                   tileName, self.wcs, self.shape)
+            self.filterCacheFileName=self.filterCacheDir+os.path.sep+"filter_%s.fits" % (self.filterCacheKey)
+        else:
+            self.filterCacheKey=None
+            self.filterCacheFileName=None
+
         # Combine flag masks (yes, we may need to think about this more...)
         self.flagMask=np.zeros(self.shape, dtype = int)
         for mapDict, i in zip(self.unfilteredMapsDictList, range(len(self.unfilteredMapsDictList))):
@@ -236,6 +627,22 @@ class MapFilter(object):
         self.radiansMap=rRadRange
         
         
+    def getApodizedFFT(self, index):
+        """Returns the Fourier transform of the apodized, preprocessed map at the given index in
+        `unfilteredMapsDictList`. This is taken from the workspace, if one is being used.
+        
+        Args:
+            index (:obj:`int`): Index of the map in `unfilteredMapsDictList`.
+        
+        Returns:
+            The Fourier transform of the map (2d complex :obj:`np.ndarray`).
+        
+        """
+        if self.workspace is not None:
+            return self.workspace.getApodizedFFT(self.workspaceKeys[index], self.apodPix)
+        return enmap.fft(enmap.apod(self.unfilteredMapsDictList[index]['data'], self.apodPix))
+        
+    
     def buildAndApply(self):
         """Builds and applies the filter to the unfiltered map(s). 
         
@@ -339,6 +746,7 @@ class MapFilter(object):
                                 #realSpace, wcs)
       
 
+    @profiling.stage('makeNoiseMap')
     def makeNoiseMap(self, mapData):
         """Estimate the noise map using local measurements in grid cells, over the whole filtered map
         (see :ref:`Filters` for the config file parameters that control this).
@@ -359,6 +767,14 @@ class MapFilter(object):
             medWeights.append(mapDict['weights'])
         medWeights=np.median(np.array(medWeights), axis = 0)
         
+        # Estimator used in each cell / weight bin (default: 3-sigma clipped stdev)
+        if 'RMSEstimator' in self.params['noiseParams'].keys() and self.params['noiseParams']['RMSEstimator'] in ['biweight', 'percentile']:
+            estimator=self.params['noiseParams']['RMSEstimator']
+        else:
+            estimator='clip'
+        apodMask=np.not_equal(mapData, 0)
+        RMSMap=np.zeros(mapData.shape, dtype = np.float32)
+
         # 'smart option' - measure noise in areas with similar weights (however weights defined)
         if self.params['noiseParams']['noiseGridArcmin'] == "smart":
             try:
@@ -366,42 +782,14 @@ class MapFilter(object):
             except:
                 raise Exception("Need to give numNoiseBins in noiseParams when using noiseGridArcmin = 'smart'")
             binEdges=np.linspace(medWeights.min(), medWeights.max(), numBins)
-            RMSMap=np.zeros(medWeights.shape, dtype = np.float32)
-            apodMask=np.not_equal(mapData, 0)
+            binIndices=np.zeros(medWeights.shape, dtype = np.int64)-1
             for i in range(len(binEdges)-1):
-                # Find area of similar weight
-                binMin=binEdges[i]
-                binMax=binEdges[i+1]
-                weightMask=np.logical_and(medWeights > binMin, medWeights < binMax)
-                # Measure noise in that area from filtered map, and fill in noise map
-                chunkValues=mapData[weightMask]
-                goodAreaMask=np.greater_equal(apodMask[weightMask], 1.0)
-                if 'RMSEstimator' in self.params['noiseParams'].keys() and self.params['noiseParams']['RMSEstimator'] == 'biweight':
-                    if goodAreaMask.sum() >= 10:
-                        # Astropy version is faster but gives identical results
-                        chunkRMS=apyStats.biweight_scale(chunkValues[goodAreaMask], c = 9.0, modify_sample_size = True)
-                        #chunkRMS=astStats.biweightScale(chunkValues[goodAreaMask], 6.0)
-                    else:
-                        chunkRMS=0.
-                elif 'RMSEstimator' in self.params['noiseParams'].keys() and self.params['noiseParams']['RMSEstimator'] == 'percentile':
-                    chunkRMS=np.percentile(abs(chunkValues[goodAreaMask]), 68.3)
-                else:
-                    # Default: 3-sigma clipped stdev
-                    if np.not_equal(chunkValues, 0).sum() != 0:
-                        goodAreaMask=np.greater_equal(apodMask[weightMask], 1.0)
-                        chunkMean=np.mean(chunkValues[goodAreaMask])
-                        chunkRMS=np.std(chunkValues[goodAreaMask])
-                        sigmaClip=3.0
-                        for c in range(10):
-                            mask=np.less(abs(chunkValues), abs(chunkMean+sigmaClip*chunkRMS))
-                            mask=np.logical_and(goodAreaMask, mask)
-                            if mask.sum() > 0:
-                                chunkMean=np.mean(chunkValues[mask])
-                                chunkRMS=np.std(chunkValues[mask])
-                    else:
-                        chunkRMS=0.
-                if chunkRMS > 0:
-                    RMSMap[weightMask]=chunkRMS
+                binIndices[np.logical_and(medWeights > binEdges[i], medWeights < binEdges[i+1])]=i
+            goodAreaMask=np.logical_and(apodMask, binIndices >= 0)
+            binRMS=calcGroupedRMS(mapData[goodAreaMask], binIndices[goodAreaMask], len(binEdges)-1,
+                                  estimator = estimator)
+            inBin=binIndices >= 0
+            RMSMap[inBin]=binRMS[binIndices[inBin]]
 
         # The grid method now recognises numNoiseBins in cells
         else:
@@ -417,77 +805,72 @@ class MapFilter(object):
                 numYChunks=mapData.shape[0]/gridSize
             yChunks=np.linspace(0, mapData.shape[0], int(numYChunks+1), dtype = int)
             xChunks=np.linspace(0, mapData.shape[1], int(numXChunks+1), dtype = int)
-            apodMask=np.not_equal(mapData, 0)
-            RMSMap=np.zeros(mapData.shape, dtype = np.float32)
             # For this mode, interpreted as number of noise bins per cell
             if 'numNoiseBins' in self.params['noiseParams'].keys():
                 numBins=self.params['noiseParams']['numNoiseBins']
             else:
                 numBins=1
-            for i in range(len(yChunks)-1):
-                for k in range(len(xChunks)-1):
-                    y0=yChunks[i]-overlapPix
-                    y1=yChunks[i+1]+overlapPix
-                    x0=xChunks[k]-overlapPix
-                    x1=xChunks[k+1]+overlapPix
-                    if y0 < 0:
-                        y0=0
-                    if y1 > mapData.shape[0]:
-                        y1=mapData.shape[0]
-                    if x0 < 0:
-                        x0=0
-                    if x1 > mapData.shape[1]:
-                        x1=mapData.shape[1]
-                    chunkValues=mapData[y0:y1, x0:x1]
-                    goodAreaMask=np.greater_equal(apodMask[y0:y1, x0:x1], 1.0)
-                    if goodAreaMask.sum() == 0:
-                        continue
-                    # Binning inside cell by weights - to handle sudden noise changes
-                    weightValues=medWeights[y0:y1, x0:x1]
-                    percentiles=np.arange(0, 100, 100/numBins)
-                    binEdges=[]
-                    for p in percentiles:
-                        binEdges.append(np.percentile(weightValues[goodAreaMask], p))
-                    binEdges.append(weightValues[goodAreaMask].max()+1e-6)
-                    for b in range(len(binEdges)-1):
-                        binMin=binEdges[b]
-                        binMax=binEdges[b+1]
-                        binMask=np.logical_and(weightValues >= binMin, weightValues < binMax)
-                        binValues=chunkValues[binMask*goodAreaMask]
-                        if 'RMSEstimator' in self.params['noiseParams'].keys() and self.params['noiseParams']['RMSEstimator'] == 'biweight':
-                            if (binMask*goodAreaMask).sum() >= 10:
-                                chunkRMS=apyStats.biweight_scale(binValues, c = 9.0, modify_sample_size = True)
-                            else:
-                                chunkRMS=0.
-                        elif 'RMSEstimator' in self.params['noiseParams'].keys() and self.params['noiseParams']['RMSEstimator'] == 'percentile':
-                            chunkRMS=np.percentile(abs(binValues), 68.3)
-                        else:
-                            # Default: 3-sigma clipped stdev
-                            if np.not_equal(binValues, 0).sum() != 0:
-                                chunkMean=np.mean(binValues)
-                                chunkRMS=np.std(binValues)
-                                sigmaClip=3.0
-                                for c in range(10):
-                                    mask=np.less(abs(binValues), abs(chunkMean+sigmaClip*chunkRMS))
-                                    if mask.sum() > 0:
-                                        chunkMean=np.mean(binValues[mask])
-                                        chunkRMS=np.std(binValues[mask])
-                            else:
-                                chunkRMS=0.
-                        if chunkRMS > 0:
-                            RMSMap[y0:y1, x0:x1][binMask]=chunkRMS
+            percentiles=list(np.arange(0, 100, 100/numBins))+[100]
+            # Cell boundaries (including overlap), clipped at map edges
+            y0s=np.maximum(yChunks[:-1]-overlapPix, 0)
+            y1s=np.minimum(yChunks[1:]+overlapPix, mapData.shape[0])
+            x0s=np.maximum(xChunks[:-1]-overlapPix, 0)
+            x1s=np.minimum(xChunks[1:]+overlapPix, mapData.shape[1])
+            numXCells=len(x0s)
+            # Each row of cells is done in one go: every (cell, pixel) pair is labelled by its cell and weight
+            # bin, and the noise is estimated in all of these groups at once
+            colPix=np.concatenate([np.arange(x0, x1) for x0, x1 in zip(x0s, x1s)])
+            colCell=np.repeat(np.arange(numXCells), x1s-x0s)
+            flatData=mapData.ravel()
+            flatWeights=medWeights.ravel()
+            flatApodMask=apodMask.ravel()
+            for y0, y1 in zip(y0s, y1s):
+                localPix=((np.arange(y0, y1)[:, np.newaxis]-y0)*mapData.shape[1]+colPix[np.newaxis, :]).ravel()
+                pix=localPix+y0*mapData.shape[1]
+                cell=np.tile(colCell, y1-y0)
+                goodAreaMask=flatApodMask[pix]
+                if goodAreaMask.sum() == 0:
+                    continue
+                # Binning inside cell by weights - to handle sudden noise changes
+                weightValues=flatWeights[pix]
+                binEdges=_groupedPercentiles(weightValues[goodAreaMask], cell[goodAreaMask], numXCells, percentiles)
+                binEdges[:, -1]=binEdges[:, -1].astype(weightValues.dtype)+1e-6
+                binIndices=np.zeros(len(pix), dtype = np.int64)-1
+                for b in range(numBins):
+                    binMask=np.logical_and(weightValues >= binEdges[cell, b], weightValues < binEdges[cell, b+1])
+                    binIndices[binMask]=b
+                inBin=binIndices >= 0
+                groups=cell*numBins+binIndices
+                useMask=np.logical_and(goodAreaMask, inBin)
+                groupRMS=calcGroupedRMS(flatData[pix[useMask]], groups[useMask], numXCells*numBins,
+                                        estimator = estimator)
+                # Overlapping cells: as when looping over cells in order, the last cell with a valid
+                # estimate wins
+                pairRMS=groupRMS[groups[inBin]]
+                valid=pairRMS > 0
+                pairLocalPix=localPix[inBin][valid]
+                pairCell=cell[inBin][valid]
+                lastCell=np.zeros((y1-y0)*mapData.shape[1], dtype = np.int64)-1
+                np.maximum.at(lastCell, pairLocalPix, pairCell)
+                keep=np.equal(pairCell, lastCell[pairLocalPix])
+                RMSMap.flat[pix[inBin][valid][keep]]=pairRMS[valid][keep]
         
         return RMSMap
     
     
-    def loadFRelWeights(self):
+    def loadFRelWeights(self, fileName = None):
         """Reads frequency weights used for relativistic corrections from the filter header.
         
+        Args:
+            fileName (:obj:`str`, optional): Path to the filter file. If None, `filterFileName` is used.
+        
         Returns:
             None
         
         """
-        with pyfits.open(self.filterFileName) as img:
+        if fileName is None:
+            fileName=self.filterFileName
+        with pyfits.open(fileName) as img:
             self.fRelWeights={}
             for i in range(1, 10):
                 if 'RW%d_GHZ' % (i) in img[0].header.keys():
@@ -495,6 +878,35 @@ class MapFilter(object):
                     self.fRelWeights[freqGHz]=img[0].header['RW%d' % (i)]
 
 
+    def saveToFilterCache(self):
+        """Writes the filter into the on-disk filter cache (if enabled), i.e., to `filterCacheFileName`.
+        
+        Returns:
+            None
+        
+        """
+        if self.filterCacheFileName is None:
+            return None
+        os.makedirs(self.filterCacheDir, exist_ok = True)
+        # Write then rename, so that other processes never see a partially written file
+        tmpFileName=self.filterCacheFileName.replace(".fits", ".%d.tmp.fits" % (os.getpid()))
+        self.writeFilterFile(tmpFileName)
+        os.replace(tmpFileName, self.filterCacheFileName)
+
+
+    def writeFilterFile(self, fileName):
+        """Writes the filter to disk, in the format read by `loadFilter`.
+        
+        Args:
+            fileName (:obj:`str`): Path to the output FITS file.
+        
+        Returns:
+            None
+        
+        """
+        raise Exception("Called a base filter class without a writeFilterFile() function implemented.")
+
+
     def makeSignalTemplateMap(self, beam, amplitude = None):
         """Makes a model signal template map. Shape parameters (if applicable) are taken from the object's
         `params` attribute.
@@ -510,8 +922,30 @@ class MapFilter(object):
         """
         raise Exception("Called a base filter class without a makeSignalTemplateMap() function implemented.")
         return None
-        
-        
+
+
+    def applyFilterToStack(self, mapStackToFilter):
+        """Applies the filter to a stack of maps (e.g., model signal maps at different scales, as used by
+        :func:`nemo.signals.fitQ`). This base implementation simply applies the filter to each map in turn -
+        derived classes may do this more efficiently.
+
+        Args:
+            mapStackToFilter (:obj:`np.ndarray`): A 4d array, where the first axis indexes the maps in the
+                stack, and each map is a cube as expected by `applyFilter` (i.e., each plane corresponds
+                to a map at a different observed frequency).
+
+        Returns:
+            Stack of filtered maps (3d :obj:`np.ndarray`)
+
+        """
+
+        filteredMaps=[]
+        for mapDataToFilter in mapStackToFilter:
+            filteredMaps.append(self.applyFilter(mapDataToFilter))
+
+        return np.array(filteredMaps, dtype = np.float32)
+
+
 #------------------------------------------------------------------------------------------------------------
 class MatchedFilter(MapFilter):
     """A multi-frequency matched filter, implemented in Fourier space. Derived from :class:`MapFilter`.
@@ -521,8 +955,8 @@ class MatchedFilter(MapFilter):
     def buildAndApply(self, useCachedFilter = False):
         
         fMapsToFilter=[]
-        for mapDict in self.unfilteredMapsDictList:
-            fMapsToFilter.append(enmap.fft(enmap.apod(mapDict['data'], self.apodPix)))
+        for i in range(len(self.unfilteredMapsDictList)):
+            fMapsToFilter.append(self.getApodizedFFT(i))
         fMapsToFilter=np.array(fMapsToFilter)
         
         # NOTE: We've tidied up the config file, so we don't have to feed in surveyMask and psMask like this
@@ -530,7 +964,12 @@ class MatchedFilter(MapFilter):
         surveyMask=self.unfilteredMapsDictList[0]['surveyMask']
         psMask=self.unfilteredMapsDictList[0]['pointSourceMask']
 
-        if os.path.exists(self.filterFileName) == False and useCachedFilter == False:
+        # With the on-disk cache enabled, filters saved under filterFileName are only re-used if asked for
+        buildFilter=useCachedFilter == False and (self.filterCacheFileName is not None or os.path.exists(self.filterFileName) == False)
+        if buildFilter == True and self.filterCacheFileName is not None and os.path.exists(self.filterCacheFileName) == True:
+            print("... loading filter from cache (key = %s)" % (self.filterCacheKey))
+            self.loadFilter(fileName = self.filterCacheFileName)
+        elif buildFilter == True:
 
             fMapsForNoise=[]
             for i in range(len(self.unfilteredMapsDictList)):
@@ -545,7 +984,10 @@ class MatchedFilter(MapFilter):
                                                       obsFreqGHz = mapDict['obsFreqGHz'])
                             if model is not None:
                                 d=d-model
-                    fMapsForNoise.append(enmap.fft(enmap.apod(d, self.apodPix)))
+                        fMapsForNoise.append(enmap.fft(enmap.apod(d, self.apodPix)))
+                    else:
+                        # Same as the map we're filtering
+                        fMapsForNoise.append(fMapsToFilter[i])
                 elif self.params['noiseParams']['method'] == 'model':
                     # Assuming weights are actually inv var white noise level per pix
                     # (which they are for Sigurd's maps)
@@ -618,13 +1060,7 @@ class MatchedFilter(MapFilter):
             fSignalsArr=np.array(fSignalsArr)
                     
             # Build the filter itself
-            self.filt=np.zeros([len(self.unfilteredMapsDictList), self.shape[0], self.shape[1]], dtype = np.float32)
-            for y in range(0, self.shape[0]):
-                for x in range(0, self.shape[1]):
-                    try:
-                        self.filt[:, y, x]=np.dot(np.linalg.inv(noiseCov[:, :, y, x]), w*abs(fSignalsArr[:, y, x])) 
-                    except:
-                        continue
+            self.filt=applyInverseNoiseCov(noiseCov, w[:, np.newaxis, np.newaxis]*abs(fSignalsArr)).astype(np.float32)
             del fSignalsArr
             del noiseCov
                         
@@ -685,6 +1121,7 @@ class MatchedFilter(MapFilter):
                 del fSignalMaps
             else:
                 raise Exception('need to specify "outputUnits" ("yc" or "uK") in filter params')
+            self.saveToFilterCache()
         else:
             print("... loading cached filter")
             self.loadFilter()
@@ -759,17 +1196,7 @@ class MatchedFilter(MapFilter):
             self.saveRealSpaceFilterProfile()
                 
         if 'saveFilter' in self.params and self.params['saveFilter'] == True:
-            img=pyfits.PrimaryHDU()                                                                                                                                                              
-            img.header['SIGNORM']=self.signalNorm
-            count=0
-            for key in list(self.fRelWeights.keys()):
-                count=count+1
-                img.header['RW%d_GHZ' % (count)]=key
-                img.header['RW%d' % (count)]=self.fRelWeights[key]
-            img.data=self.filt
-            # Just in case... saves having to fix this up elsewhere
-            os.makedirs(os.path.split(self.filterFileName)[0], exist_ok = True)
-            img.writeto(self.filterFileName, overwrite = True) 
+            self.writeFilterFile(self.filterFileName)
             
         # NOTE: What to do about frequency here? Generalise for non-SZ
         return {'data': filteredMap, 'wcs': self.wcs, 'obsFreqGHz': combinedObsFreqGHz, 'SNMap': SNMap,
@@ -777,17 +1204,45 @@ class MatchedFilter(MapFilter):
                 'beamSolidAngle_nsr': beamSolidAngle_nsr, 'label': self.label, 'tileName': self.tileName}
 
 
-    def loadFilter(self):
+    def writeFilterFile(self, fileName):
+        """Writes the filter to disk, in the format read by `loadFilter`.
+        
+        Args:
+            fileName (:obj:`str`): Path to the output FITS file.
+        
+        Returns:
+            None
+        
+        """
+        img=pyfits.PrimaryHDU()
+        img.header['SIGNORM']=self.signalNorm
+        count=0
+        for key in list(self.fRelWeights.keys()):
+            count=count+1
+            img.header['RW%d_GHZ' % (count)]=key
+            img.header['RW%d' % (count)]=self.fRelWeights[key]
+        img.data=self.filt
+        # Just in case... saves having to fix this up elsewhere
+        os.makedirs(os.path.split(fileName)[0], exist_ok = True)
+        img.writeto(fileName, overwrite = True)
+
+
+    def loadFilter(self, fileName = None):
         """Loads in a previously saved filter.
         
+        Args:
+            fileName (:obj:`str`, optional): Path to the filter file. If None, `filterFileName` is used.
+        
         Returns:
             None
         
         """
-        with pyfits.open(self.filterFileName) as img:
+        if fileName is None:
+            fileName=self.filterFileName
+        with pyfits.open(fileName) as img:
             self.filt=img[0].data.astype(np.float32)
             self.signalNorm=img[0].header['SIGNORM']
-        self.loadFRelWeights()
+        self.loadFRelWeights(fileName = fileName)
         
 
     def reshapeFilter(self, shape):
@@ -833,26 +1288,46 @@ class MatchedFilter(MapFilter):
         
         """
         
+        return self.applyFilterToStack(mapDataToFilter[np.newaxis])[0]
+
+
+    def applyFilterToStack(self, mapStackToFilter):
+        """Applies the filter to a stack of maps (e.g., model signal maps at different scales, as used by
+        :func:`nemo.signals.fitQ`). The filter is reshaped (if needed) only once, and the whole stack is
+        filtered using a single (batched) FFT. If the map data are not complex, they will be Fourier
+        transformed.
+
+        Args:
+            mapStackToFilter (:obj:`np.ndarray`): A 4d array, where the first axis indexes the maps in the
+                stack, and each map is a cube as expected by `applyFilter` (i.e., each plane corresponds
+                to a map at a different observed frequency).
+
+        Returns:
+            Stack of filtered maps (3d :obj:`np.ndarray`)
+
+        """
+
         # NOTE: need to check appropriate signalNorm after reshaping
-        if mapDataToFilter.shape == self.filt.shape:
+        if mapStackToFilter.shape[1:] == self.filt.shape:
             filt=self.filt
         else:
-            filt=self.reshapeFilter(mapDataToFilter.shape)
+            filt=self.reshapeFilter(mapStackToFilter.shape[1:])
 
-        if 'complex' in mapDataToFilter.dtype.name:
-            fMapsToFilter=mapDataToFilter
+        if 'complex' in mapStackToFilter.dtype.name:
+            fMapsToFilter=mapStackToFilter
         else:
-            fMapsToFilter=enmap.fft(enmap.apod(mapDataToFilter, self.apodPix))
+            fMapsToFilter=enmap.fft(enmap.apod(mapStackToFilter, self.apodPix))
 
-        filteredMap=np.real(enmap.ifft(fMapsToFilter*filt, normalize = False)).sum(axis = 0).astype(np.float32)
+        filteredMaps=np.real(enmap.ifft(fMapsToFilter*filt, normalize = False)).sum(axis = 1).astype(np.float32)
 
         # Optional additional high-pass filter
         if 'bckSub' in self.params.keys() and 'bckSubScaleArcmin' in self.params.keys() and self.params['bckSub'] == True:
-            filteredMap=maps.subtractBackground(filteredMap, self.wcs, smoothScaleDeg = self.params['bckSubScaleArcmin']/60.)
-        
-        filteredMap=filteredMap*self.signalNorm
+            for i in range(filteredMaps.shape[0]):
+                filteredMaps[i]=maps.subtractBackground(filteredMaps[i], self.wcs, smoothScaleDeg = self.params['bckSubScaleArcmin']/60.)
+
+        filteredMaps=filteredMaps*self.signalNorm
 
-        return filteredMap
+        return filteredMaps
         
 #------------------------------------------------------------------------------------------------------------
 class RealSpaceMatchedFilter(MapFilter):
@@ -863,15 +1338,20 @@ class RealSpaceMatchedFilter(MapFilter):
         
     """       
     
-    def loadFilter(self):
+    def loadFilter(self, fileName = None):
         """Loads in a previously saved filter kernel.
         
+        Args:
+            fileName (:obj:`str`, optional): Path to the filter file. If None, `filterFileName` is used.
+        
         Returns:
             None
         
         """
         
-        with pyfits.open(self.filterFileName) as img:
+        if fileName is None:
+            fileName=self.filterFileName
+        with pyfits.open(fileName) as img:
             kern2d=img[0].data
             signalNorm=img[0].header['SIGNORM']
             if 'BCKSCALE' in img[0].header.keys():
@@ -883,6 +1363,33 @@ class RealSpaceMatchedFilter(MapFilter):
         self.kern2d=kern2d
         self.signalNorm=signalNorm
         self.bckSubScaleArcmin=bckSubScaleArcmin
+        self.loadFRelWeights(fileName = fileName)
+
+
+    def writeFilterFile(self, fileName):
+        """Writes the filter kernel to disk, in the format read by `loadFilter`.
+        
+        Args:
+            fileName (:obj:`str`): Path to the output FITS file.
+        
+        Returns:
+            None
+        
+        """
+        # Add bckSubScaleArcmin to the header
+        kernWCS=self.wcs.copy()
+        if self.params['bckSub'] == True:
+            kernWCS.header['BCKSCALE']=self.bckSubScaleArcmin
+        kernWCS.header['SIGNORM']=self.signalNorm
+        kernWCS.header['APP_RA']=self.applyRACentre
+        kernWCS.header['APP_DEC']=self.applyDecCentre
+        count=0
+        for key in list(self.fRelWeights.keys()):
+            count=count+1
+            kernWCS.header['RW%d_GHZ' % (count)]=key
+            kernWCS.header['RW%d' % (count)]=self.fRelWeights[key]
+        kernWCS.header['NEMOVER']=nemo.__version__
+        maps.saveFITS(fileName, self.kern2d, kernWCS)
 
         
     def buildKernel(self, RADecSection, RADeg = 'centre', decDeg = 'centre'):
@@ -904,7 +1411,7 @@ class RealSpaceMatchedFilter(MapFilter):
             
         """
         
-        if os.path.exists(self.filterFileName) == True:
+        if self.filterCacheFileName is None and os.path.exists(self.filterFileName) == True:
             return self.loadFilter()
         
         wcs=self.wcs
@@ -934,7 +1441,8 @@ class RealSpaceMatchedFilter(MapFilter):
         matchedFilter=matchedFilterClass(kernelLabel, kernelUnfilteredMapsDictList, self.params,
                                          tileName = mapDict['tileName'],
                                          diagnosticsDir = matchedFilterDir+os.path.sep+'diagnostics',
-                                         selFnDir = matchedFilterDir+os.path.sep+'selFn')
+                                         selFnDir = matchedFilterDir+os.path.sep+'selFn',
+                                         filterCacheDir = self.filterCacheDir)
         filteredMapDict=matchedFilter.buildAndApply()
         
         # Turn the matched filter into a smaller real space convolution kernel
@@ -1021,20 +1529,8 @@ class RealSpaceMatchedFilter(MapFilter):
             raise Exception('need to specify "outputUnits" ("yc" or "uK") in filter params')
         
         # Save 2d kernel - we need this (at least for the photometry ref scale) to calc Q later
-        # Add bckSubScaleArcmin to the header
-        kernWCS=wcs.copy()
-        if self.params['bckSub'] == True:
-            kernWCS.header['BCKSCALE']=self.bckSubScaleArcmin
-        kernWCS.header['SIGNORM']=self.signalNorm
-        kernWCS.header['APP_RA']=self.applyRACentre
-        kernWCS.header['APP_DEC']=self.applyDecCentre
-        count=0
-        for key in list(self.fRelWeights.keys()):
-            count=count+1
-            kernWCS.header['RW%d_GHZ' % (count)]=key
-            kernWCS.header['RW%d' % (count)]=self.fRelWeights[key]
-        kernWCS.header['NEMOVER']=nemo.__version__
-        maps.saveFITS(self.filterFileName, self.kern2d, kernWCS)
+        self.writeFilterFile(self.filterFileName)
+        self.saveToFilterCache()
         
         # Filter profile plot   
         # Save the stuff we plot first, in case we want to make a plot with multiple filters on later
@@ -1073,7 +1569,15 @@ class RealSpaceMatchedFilter(MapFilter):
         surveyMask=self.unfilteredMapsDictList[0]['surveyMask']
         psMask=self.unfilteredMapsDictList[0]['pointSourceMask']
 
-        if os.path.exists(self.filterFileName) == False:
+        # With the on-disk cache enabled, filters saved under filterFileName are only re-used if asked for
+        buildFilter=useCachedFilter == False and (self.filterCacheFileName is not None or os.path.exists(self.filterFileName) == False)
+        if buildFilter == True and self.filterCacheFileName is not None and os.path.exists(self.filterCacheFileName) == True:
+            print("... loading filter from cache (key = %s)" % (self.filterCacheKey))
+            self.loadFilter(fileName = self.filterCacheFileName)
+            # Other stages (e.g., fitQ) expect to find the kernel here
+            if os.path.exists(self.filterFileName) == False:
+                self.writeFilterFile(self.filterFileName)
+        elif buildFilter == True:
 
             # Noise region to use
             RAMin, RAMax, decMin, decMax=self.wcs.getImageMinMaxWCSCoords()
@@ -1177,37 +1681,60 @@ class RealSpaceMatchedFilter(MapFilter):
         
         """
         
+        return self.applyFilterToStack(mapDataToFilter[np.newaxis], calcFRelWeights = calcFRelWeights)[0]
+
+
+    def applyFilterToStack(self, mapStackToFilter, calcFRelWeights = False):
+        """Applies the filter to a stack of maps (e.g., model signal maps at different scales, as used by
+        :func:`nemo.signals.fitQ`). The maps at each frequency are convolved with the kernel all at once.
+
+        Args:
+            mapStackToFilter (:obj:`np.ndarray`): A 4d array, where the first axis indexes the maps in the
+                stack, and each map is a cube as expected by `applyFilter` (i.e., each plane corresponds
+                to a map at a different observed frequency).
+            calcFRelWeights (:obj:`bool`, optional): If `True`, the relative weights of each frequency
+                plane are measured from the first map in the stack. This should *only* be set to `True`
+                if that is an ideal signal map.
+
+        Returns:
+            Stack of filtered maps (3d :obj:`np.ndarray`)
+
+        """
+
         # Apply the high pass filter - subtract background on larger scales using difference of Gaussians 
-        filteredMap=np.zeros(mapDataToFilter.shape, dtype = np.float32)
+        filteredMaps=np.zeros(mapStackToFilter.shape, dtype = np.float32)
         if self.params['bckSub'] == True and self.bckSubScaleArcmin > 0:
-            for i in range(mapDataToFilter.shape[0]):
-                filteredMap[i]=maps.subtractBackground(mapDataToFilter[i], self.wcs, 
-                                                       RADeg = self.applyRACentre,
-                                                       decDeg = self.applyDecCentre,
-                                                       smoothScaleDeg = self.bckSubScaleArcmin/60.)
+            for j in range(mapStackToFilter.shape[0]):
+                for i in range(mapStackToFilter.shape[1]):
+                    filteredMaps[j, i]=maps.subtractBackground(mapStackToFilter[j, i], self.wcs,
+                                                               RADeg = self.applyRACentre,
+                                                               decDeg = self.applyDecCentre,
+                                                               smoothScaleDeg = self.bckSubScaleArcmin/60.)
         else:
-            filteredMap=filteredMap+mapDataToFilter
-        
+            filteredMaps=filteredMaps+mapStackToFilter
+
         # Apply the kernel
-        for i in range(filteredMap.shape[0]):
-            filteredMap[i]=ndimage.convolve(filteredMap[i], self.kern2d[i])
-        
+        if 'convolutionMethod' in self.params.keys():
+            convolutionMethod=self.params['convolutionMethod']
+        else:
+            convolutionMethod='auto'
+        for i in range(filteredMaps.shape[1]):
+            filteredMaps[:, i]=maps.convolveWithKernel(filteredMaps[:, i], self.kern2d[i], method = convolutionMethod)
+
         # For relativistic corrections (see signals module)
         if calcFRelWeights == True:
             self.fRelWeights={}
-            maxIndex=np.argmax(filteredMap.sum(axis = 0))
-            totalSignal=filteredMap.sum(axis = 0).flatten()[maxIndex]
-            for filteredSignalPlane, mapDict in zip(filteredMap, self.unfilteredMapsDictList):
+            maxIndex=np.argmax(filteredMaps[0].sum(axis = 0))
+            totalSignal=filteredMaps[0].sum(axis = 0).flatten()[maxIndex]
+            for filteredSignalPlane, mapDict in zip(filteredMaps[0], self.unfilteredMapsDictList):
                 freqGHz=mapDict['obsFreqGHz']
                 fRelWeight=filteredSignalPlane.flatten()[maxIndex]/totalSignal
                 self.fRelWeights[freqGHz]=fRelWeight
-                
-        filteredMap=filteredMap.sum(axis = 0).astype(np.float32)
-        
+
         # Apply the normalisation
-        filteredMap=filteredMap*self.signalNorm
-        
-        return filteredMap
+        filteredMaps=filteredMaps.sum(axis = 1).astype(np.float32)*self.signalNorm
+
+        return filteredMaps
     
         
 #------------------------------------------------------------------------------------------------------------
@@ -8,14 +8,12 @@ from astLib import *
 from scipy import ndimage
 from scipy import interpolate
 from scipy.signal import convolve as scipy_convolve
+from scipy.signal import oaconvolve as scipy_oaconvolve
 from scipy import optimize
 import astropy.io.fits as pyfits
 import astropy.table as atpy
 import astropy.stats as apyStats
-import mahotas
-import colorcet
 import numpy as np
-import pylab as plt
 import glob
 import os
 import sys
@@ -23,12 +21,17 @@ import math
 import time
 import shutil
 import copy
+import collections
 import yaml
 import pickle
 from pixell import enmap, curvedsky, utils, powspec
 import nemo
+from ._lazy import lazyImport
+mahotas=lazyImport('mahotas')
+colorcet=lazyImport('colorcet')
+plt=lazyImport('pylab')
 try:
-    import reproject
+    reproject=lazyImport('reproject')
 except:
     pass
 from . import catalogs
@@ -37,8 +40,121 @@ from . import photometry
 from . import plotSettings
 from . import pipelines
 from . import completeness
+from . import profiling
 np.random.seed()
 
+#------------------------------------------------------------------------------------------------------------
+# Per-process pool of open FITS file handles, used by MapDict.loadTile - see getPooledImageHDU
+_imageHDUPool={'pid': None, 'handles': collections.OrderedDict()}
+MAX_POOLED_HANDLES=32
+
+def getPooledImageHDU(path):
+    """Return the first image HDU containing data in the given FITS file, keeping the file open (memory
+    mapped) in a per-process pool so that repeated reads (e.g., of many tiles clipped from the same large
+    map) do not re-open and re-parse the file each time. Handles are keyed by file identity (path, size,
+    modification time), so files that are overwritten during a run are re-opened. The pool is reset if the
+    process ID changes (e.g., after a fork), and the least recently used handles are closed if more than
+    `MAX_POOLED_HANDLES` files are open.
+
+    Args:
+        path (:obj:`str`): Path to a FITS image.
+
+    Returns:
+        An astropy.io.fits HDU object. Use its `section` attribute to read only the part of the image that
+        is needed.
+
+    """
+
+    if _imageHDUPool['pid'] != os.getpid():
+        # Handles inherited across a fork share file offsets - start again in the child
+        _imageHDUPool['pid']=os.getpid()
+        _imageHDUPool['handles']=collections.OrderedDict()
+    handles=_imageHDUPool['handles']
+    stat=os.stat(path)
+    key=(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    if key in handles:
+        handles.move_to_end(key)
+        return handles[key][1]
+    img=pyfits.open(path, memmap = True)
+    hdu=None
+    for h in img:
+        if h.is_image and h.header.get('NAXIS', 0) > 0:
+            hdu=h
+            break
+    if hdu is None:
+        img.close()
+        raise Exception("No image data found in %s." % (path))
+    handles[key]=(img, hdu)
+    while len(handles) > MAX_POOLED_HANDLES:
+        oldKey, (oldImg, oldHDU)=handles.popitem(last = False)
+        oldImg.close()
+    return hdu
+
+#------------------------------------------------------------------------------------------------------------
+def closePooledImageHDUs():
+    """Close all FITS file handles held open by :meth:`getPooledImageHDU` in this process.
+
+    """
+    for img, hdu in _imageHDUPool['handles'].values():
+        img.close()
+    _imageHDUPool['handles'].clear()
+
+#------------------------------------------------------------------------------------------------------------
+def readHDUSection(hdu, key):
+    """Read part of the image in the given HDU, using its `section` attribute, so that only the part of
+    the file that is needed is read. Compressed image HDUs only have a `section` attribute in astropy
+    >= 5.3 - for older versions, the whole image is read (and decompressed) instead.
+
+    Args:
+        hdu (:obj:`astropy.io.fits.ImageHDU` or :obj:`astropy.io.fits.CompImageHDU`): Image HDU.
+        key (:obj:`tuple`): Slices (or indices) giving the part of the image to read.
+
+    Returns:
+        Array containing the requested part of the image.
+
+    """
+
+    if hasattr(hdu, 'section') == True:
+        return hdu.section[key]
+
+    return hdu.data[key]
+
+#------------------------------------------------------------------------------------------------------------
+def readImageSection(path, section = None):
+    """Read a rectangular section of the image stored in a FITS file, touching only the rows of the file
+    that overlap the section. For 3d images (e.g., maps with Stokes I, Q, U planes), the first plane is
+    read. The file handle is kept open in a per-process pool (see :meth:`getPooledImageHDU`).
+
+    Args:
+        path (:obj:`str`): Path to a FITS image.
+        section (:obj:`list`, optional): Pixel coordinates [minX, maxX, minY, maxY] of the region to
+            read. If None, the whole image is read.
+
+    Returns:
+        2d array. This is a new array (not a view of the file), which the caller is free to modify.
+
+    """
+
+    hdu=getPooledImageHDU(path)
+    ndim=hdu.header['NAXIS']
+    if section is None:
+        ySlice, xSlice=slice(None), slice(None)
+    else:
+        minX, maxX, minY, maxY=section
+        ySlice, xSlice=slice(minY, maxY), slice(minX, maxX)
+    if ndim == 3:
+        data=readHDUSection(hdu, (0, ySlice, xSlice))
+    elif ndim == 2:
+        data=readHDUSection(hdu, (ySlice, xSlice))
+    else:
+        raise Exception("Map data has %d dimensions - only ndim = 2 or ndim = 3 are currently handled." % (ndim))
+    # Contiguous sections of uncompressed images are views of the (shared, memory mapped) file, and
+    # without section support, compressed images are sliced from the (shared) decompressed data
+    if data.flags.owndata == False:
+        data=np.array(data, copy = True)
+
+    return data
+
 #------------------------------------------------------------------------------------------------------------
 class MapDict(dict):
     """A dictionary for managing a sky map (a 2d array with an associated WCS) within Nemo. Keys within the
@@ -100,40 +216,19 @@ class MapDict(dict):
         pathToTileImages=self.get(mapKey)
         if os.path.isdir(pathToTileImages) == True:
             # Directory full of tile images (used by, e.g., on-the-fly extended source masking)
-            with pyfits.open(pathToTileImages+os.path.sep+tileName+".fits") as img:
-                extName=0
-                tileData=img[extName].data
-                if tileData is None:
-                    for extName in img:
-                        tileData=img[extName].data
-                        if tileData is not None:
-                            break
-                assert tileData is not None
-                if returnWCS == True or self['reprojectToTan'] == True:
-                    # Zapping keywords in old ACT maps that confuse astropy.wcs
-                    wcs=astWCS.WCS(img[extName].header, mode = 'pyfits', zapKeywords = ['PC1_1', 'PC1_2', 'PC2_1', 'PC2_2'])
-                data=tileData
+            tilePath=pathToTileImages+os.path.sep+tileName+".fits"
+            data=readImageSection(tilePath)
+            if returnWCS == True or self['reprojectToTan'] == True:
+                # Zapping keywords in old ACT maps that confuse astropy.wcs
+                wcs=astWCS.WCS(getPooledImageHDU(tilePath).header.copy(), mode = 'pyfits', zapKeywords = ['PC1_1', 'PC1_2', 'PC2_1', 'PC2_2'])
         elif type(pathToTileImages) == np.ndarray:
             # We no longer want to support this kind of thing... clean this up later
             raise Exception("Expected a path but got an array instead (image already loaded).")
         else:
-            # On-the-fly tile clipping
-            with pyfits.open(pathToTileImages) as img:
-                for ext in img:
-                    if img[ext].data is not None:
-                        break
-                if returnWCS == True or self['reprojectToTan'] == True:
-                    wcs=astWCS.WCS(self.tileCoordsDict[tileName]['header'], mode = 'pyfits')
-                minX, maxX, minY, maxY=self.tileCoordsDict[tileName]['clippedSection']
-                if img[ext].data.ndim == 3:
-                    data=img[ext].data[0, minY:maxY, minX:maxX]
-                elif img[ext].data.ndim == 2:
-                    data=img[ext].data[minY:maxY, minX:maxX]
-                else:
-                    raise Exception("Map data has %d dimensions - only ndim = 2 or ndim = 3 are currently handled." % (img[ext].data.ndim))
-                # Avoiding potential for read-only weirdness
-                data=data[:]
-                data=data.copy()
+            # On-the-fly tile clipping - only the rows covering the clipped section are read from disk
+            if returnWCS == True or self['reprojectToTan'] == True:
+                wcs=astWCS.WCS(self.tileCoordsDict[tileName]['header'], mode = 'pyfits')
+            data=readImageSection(pathToTileImages, self.tileCoordsDict[tileName]['clippedSection'])
 
         # Convert any mask to 8-bit unsigned ints to save memory
         if mapKey in self._maskKeys:
@@ -171,6 +266,7 @@ class MapDict(dict):
             return data
 
 
+    @profiling.stage('preprocess')
     def preprocess(self, tileName = 'PRIMARY', diagnosticsDir = None):
         """Applies a number of pre-processing steps to the map described by this :class:`MapDict` object,
         typically used before filtering.
@@ -384,7 +480,6 @@ class MapDict(dict):
             psMask=np.ones(data.shape, dtype = np.uint8)
             #pixRad=(10.0/60.0)/wcs.getPixelSizeDeg()
             #bckData=ndimage.median_filter(data, int(pixRad))
-            rDegMap=np.ones(data.shape, dtype = float)*1e6
             for catalogInfo in self['maskPointSourcesFromCatalog']:
                 if type(catalogInfo) == str:
                     catalogPath=catalogInfo
@@ -400,24 +495,26 @@ class MapDict(dict):
                 tab=catalogs.getCatalogWithinImage(tab, data.shape, wcs)
                 # If we're given a catalog that already has rArcmin in it, we use that to set hole size
                 # Otherwise, if we have shape measurements (ellipse_A at least), we can use that
-                for row in tab:
-                    # Extended sources - identify by measured size > masking radius
-                    # These will mess up noise term in filter, so add to psMask also and fill + smooth
-                    # We won't fiddle with PA here, we'll just maximise based on x-pixel scale (because CAR)
-                    if 'rArcmin' in tab.keys():
-                        maskRadiusArcmin=row['rArcmin']
-                    elif 'ellipse_A' in tab.keys():
-                        xPixSizeArcmin=(wcs.getXPixelSizeDeg()/np.cos(np.radians(row['decDeg'])))*60
-                        ASizeArcmin=row['ellipse_A']/xPixSizeArcmin
-                        maskRadiusArcmin=ASizeArcmin/2
-                    else:
-                        raise Exception("To mask sources in a catalog, need either 'rArcmin' or 'ellipse_A' column to be present.")
-                    rDegMap, xBounds, yBounds=makeDegreesDistanceMap(rDegMap, wcs,
-                                                                     row['RADeg'], row['decDeg'],
-                                                                     maskRadiusArcmin/60)
-                    surveyMask[rDegMap < maskRadiusArcmin/60.0]=0
-                    psMask[rDegMap < maskRadiusArcmin/60.0]=0
-                    data[rDegMap < maskRadiusArcmin/60.0]=bckData[rDegMap < maskRadiusArcmin/60.0]
+                # Extended sources - identify by measured size > masking radius
+                # These will mess up noise term in filter, so add to psMask also and fill + smooth
+                # We won't fiddle with PA here, we'll just maximise based on x-pixel scale (because CAR)
+                if len(tab) == 0:
+                    continue
+                if 'rArcmin' in tab.keys():
+                    maskRadiiArcmin=np.array(tab['rArcmin'])
+                elif 'ellipse_A' in tab.keys():
+                    xPixSizeArcmin=(wcs.getXPixelSizeDeg()/np.cos(np.radians(np.array(tab['decDeg']))))*60
+                    ASizeArcmin=np.array(tab['ellipse_A'])/xPixSizeArcmin
+                    maskRadiiArcmin=ASizeArcmin/2
+                else:
+                    raise Exception("To mask sources in a catalog, need either 'rArcmin' or 'ellipse_A' column to be present.")
+                # Only the box around each source is touched, so we don't allocate map-sized arrays per source
+                cutouts=makeDegreesDistanceCutouts(data.shape, wcs, tab['RADeg'], tab['decDeg'], maskRadiiArcmin/60)
+                for maskRadiusArcmin, (rDeg, slices) in zip(maskRadiiArcmin, cutouts):
+                    holeMask=rDeg < maskRadiusArcmin/60.0
+                    surveyMask[slices][holeMask]=0
+                    psMask[slices][holeMask]=0
+                    data[slices][holeMask]=bckData[slices][holeMask]
 
         if 'subtractModelFromCatalog' in list(self.keys()) and self['subtractModelFromCatalog'] is not None:
             if type(self['subtractModelFromCatalog']) is not list:
@@ -442,23 +539,21 @@ class MapDict(dict):
                 if len(tab) > 0:
                     if 'ellipse_A' not in tab.keys() and 'maskHoleRadiusArcmin' not in self.keys():
                         raise Exception("Need to set measureShapes: True or set maskHoleRadiusArcmin to use maskAndFillFromCatalog")
-                for row in tab:
-                    x, y=wcs.wcs2pix(row['RADeg'], row['decDeg'])
-                    rArcminMap=np.ones(data.shape, dtype = float)*1e6
-                    if 'ellipse_A' and 'ellipse_B' in tab.keys():
-                        xPixSizeArcmin=(wcs.getXPixelSizeDeg()/np.cos(np.radians(row['decDeg'])))*60
-                        maskRadiusArcmin=(row['ellipse_A']/xPixSizeArcmin)/2
-                    if 'maskHoleRadiusArcmin' in self.keys() and self['maskHoleRadiusArcmin'] is not None:
-                        maskRadiusArcmin=self['maskHoleRadiusArcmin']
-                    if 'maskHoleDilationFactor' in self.keys() and self['maskHoleDilationFactor'] is not None:
-                        maskRadiusArcmin=maskRadiusArcmin*self['maskHoleDilationFactor']
-                    rArcminMap, xBounds, yBounds=makeDegreesDistanceMap(rArcminMap, wcs,
-                                                                        row['RADeg'], row['decDeg'],
-                                                                        maskRadiusArcmin/60)
-                    rArcminMap=rArcminMap*60
-                    surveyMask[rArcminMap < maskRadiusArcmin]=0
-                    psMask[rArcminMap < maskRadiusArcmin]=0
-                    data[rArcminMap < maskRadiusArcmin]=bckData[rArcminMap < maskRadiusArcmin]
+                else:
+                    continue
+                if 'ellipse_A' and 'ellipse_B' in tab.keys():
+                    xPixSizeArcmin=(wcs.getXPixelSizeDeg()/np.cos(np.radians(np.array(tab['decDeg']))))*60
+                    maskRadiiArcmin=(np.array(tab['ellipse_A'])/xPixSizeArcmin)/2
+                if 'maskHoleRadiusArcmin' in self.keys() and self['maskHoleRadiusArcmin'] is not None:
+                    maskRadiiArcmin=np.ones(len(tab))*self['maskHoleRadiusArcmin']
+                if 'maskHoleDilationFactor' in self.keys() and self['maskHoleDilationFactor'] is not None:
+                    maskRadiiArcmin=maskRadiiArcmin*self['maskHoleDilationFactor']
+                cutouts=makeDegreesDistanceCutouts(data.shape, wcs, tab['RADeg'], tab['decDeg'], maskRadiiArcmin/60)
+                for maskRadiusArcmin, (rDeg, slices) in zip(maskRadiiArcmin, cutouts):
+                    holeMask=rDeg*60 < maskRadiusArcmin
+                    surveyMask[slices][holeMask]=0
+                    psMask[slices][holeMask]=0
+                    data[slices][holeMask]=bckData[slices][holeMask]
 
         # Add the map data to the dict
         self['data']=data
@@ -568,9 +663,45 @@ class TileDict(dict):
         newImg.writeto(outFileName, overwrite = True)
 
 
+    def getStitchableTile(self, tileName, compressionType = None):
+        """Returns the image data for the given tile, reprojected back to CAR if necessary, ready to be
+        pasted into the stitched map at the tile's `clippedSection` (see :meth:`saveStitchedFITS`).
+
+        Args:
+            tileName (:obj:`str`): The name of the tile.
+            compressionType (:obj:`str`): Compression type that will be used for the stitched image. This
+                sets the interpolation order used when reprojecting (nearest neighbour for `PLIO_1`).
+
+        Returns:
+            2d array
+
+        """
+
+        if self.tileCoordsDict[tileName]['reprojectToTan'] == True:
+            carWCS=astWCS.WCS(self.tileCoordsDict[tileName]['header'], mode = 'pyfits')
+            tanWCS=_makeTanWCS(carWCS)
+            shape=[self.tileCoordsDict[tileName]['header']['NAXIS2'],
+                   self.tileCoordsDict[tileName]['header']['NAXIS1']]
+            if compressionType == 'PLIO_1':
+                order=0
+            else:
+                order='bicubic'
+            carData, footprint=reproject.reproject_interp((self[tileName], tanWCS.AWCS), carWCS.AWCS, shape_out = shape, order = order,
+                                                          return_footprint = True)
+            carData[footprint == 0]=0 # get rid of nans which will be in borders anyway
+        else:
+            carData=self[tileName]
+
+        return carData
+
+
     def saveStitchedFITS(self, outFileName, stitchedWCS, compressionType = None):
         """Stitch together the tiles into a monolithic image and save in a FITS file.
 
+        The stitched image is assembled one tile at a time in a memory-mapped file on disk (either the
+        output file itself, or a temporary file if compressing), so the memory needed does not depend on
+        the size of the stitched map.
+
         Args:
             outFileName (:obj:`str`): Path where the stitched image FITS file will be written.
             stitchedWCS (:obj:`astWCS.WCS`): WCS object corresponding to the stitched map
@@ -585,29 +716,108 @@ class TileDict(dict):
 
         """
 
-        wcs=stitchedWCS
-        d=np.zeros([stitchedWCS.header['NAXIS2'], stitchedWCS.header['NAXIS1']], dtype = np.float32)
-        for tileName in self.keys():
-            if self.tileCoordsDict[tileName]['reprojectToTan'] == True:
-                carWCS=astWCS.WCS(self.tileCoordsDict[tileName]['header'], mode = 'pyfits')
-                tanWCS=_makeTanWCS(carWCS)
-                shape=[self.tileCoordsDict[tileName]['header']['NAXIS2'],
-                       self.tileCoordsDict[tileName]['header']['NAXIS1']]
-                if compressionType == 'PLIO_1':
-                    order=0
-                else:
-                    order='bicubic'
-                carData, footprint=reproject.reproject_interp((self[tileName], tanWCS.AWCS), carWCS.AWCS, shape_out = shape, order = order,
-                                                              return_footprint = True)
-                carData[footprint == 0]=0 # get rid of nans which will be in borders anyway
+        shape=(stitchedWCS.header['NAXIS2'], stitchedWCS.header['NAXIS1'])
+        if compressionType is None:
+            dataOffset=makeEmptyFITS(outFileName, stitchedWCS)
+            d=np.memmap(outFileName, dtype = '>f4', mode = 'r+', offset = dataOffset, shape = shape)
+            tmpFileName=None
+        else:
+            # Compression needs the whole image, so we stitch into a temporary (uncompressed) file first
+            if compressionType == 'PLIO_1':
+                dtype=np.uint8
             else:
-                carData=self[tileName]
-            minX, maxX, minY, maxY=self.tileCoordsDict[tileName]['clippedSection']
-            try:
-                d[minY:maxY, minX:maxX]=d[minY:maxY, minX:maxX]+carData.data
-            except:
-                raise Exception("Stitching error on tile %s" % (tileName))
-        saveFITS(outFileName, d, wcs, compressionType = compressionType)
+                dtype=np.float32
+            tmpFileName=outFileName+".stitching.tmp"
+            d=np.memmap(tmpFileName, dtype = dtype, mode = 'w+', shape = shape)
+        try:
+            for tileName in self.keys():
+                carData=self.getStitchableTile(tileName, compressionType = compressionType)
+                minX, maxX, minY, maxY=self.tileCoordsDict[tileName]['clippedSection']
+                try:
+                    d[minY:maxY, minX:maxX]=d[minY:maxY, minX:maxX]+carData.data
+                except:
+                    raise Exception("Stitching error on tile %s" % (tileName))
+            d.flush()
+            if compressionType is not None:
+                saveFITS(outFileName, d, stitchedWCS, compressionType = compressionType)
+        finally:
+            del d
+            if tmpFileName is not None and os.path.exists(tmpFileName):
+                os.remove(tmpFileName)
+
+
+    def pasteIntoStitchedFITS(self, outFileName):
+        """Adds the tiles in this :class:`TileDict` into an existing, uncompressed stitched image FITS file
+        (as made by :meth:`makeEmptyFITS`), giving the same result as :meth:`saveStitchedFITS` once all
+        tiles have been added. This uses ordinary file reads and writes of only the pixels covered by
+        each tile, rather than memory mapping, so that e.g. each MPI rank can add its own tiles to the same
+        file without the tiles having to be gathered by one process. Since tiles overlap, processes must
+        take turns in doing this.
+
+        Args:
+            outFileName (:obj:`str`): Path to the stitched image FITS file.
+
+        Returns:
+            None
+
+        """
+
+        with pyfits.open(outFileName) as img:
+            dataOffset=img.fileinfo(0)['datLoc']
+            header=img[0].header
+            width=header['NAXIS1']
+            if header['BITPIX'] != -32:
+                raise Exception("Can only paste tiles into FITS images with BITPIX = -32")
+        itemSize=4
+        with open(outFileName, "r+b") as outFile:
+            for tileName in self.keys():
+                carData=self.getStitchableTile(tileName)
+                minX, maxX, minY, maxY=self.tileCoordsDict[tileName]['clippedSection']
+                if carData.shape != (maxY-minY, maxX-minX):
+                    raise Exception("Stitching error on tile %s" % (tileName))
+                numBytes=(maxX-minX)*itemSize
+                for y in range(minY, maxY):
+                    outFile.seek(dataOffset+(y*width+minX)*itemSize)
+                    row=np.frombuffer(outFile.read(numBytes), dtype = '>f4')
+                    row=(row+carData[y-minY]).astype('>f4')
+                    outFile.seek(dataOffset+(y*width+minX)*itemSize)
+                    outFile.write(row.tobytes())
+
+#-------------------------------------------------------------------------------------------------------------
+def makeEmptyFITS(outFileName, wcs, shape = None):
+    """Writes a FITS image file (32-bit float) containing zeros, with space for the data allocated on disk
+    but without making the image in memory. The image can then be filled in using memory mapping, or
+    :meth:`TileDict.pasteIntoStitchedFITS`.
+
+    Args:
+        outFileName (:obj:`str`): Path where the FITS file will be written.
+        wcs (:obj:`astWCS.WCS`): WCS of the image.
+        shape (:obj:`tuple`, optional): Dimensions of the image (height, width). If not given, these are
+            taken from the NAXIS2, NAXIS1 keywords in the WCS header.
+
+    Returns:
+        The offset in bytes of the start of the image data in the file.
+
+    """
+
+    if shape is None:
+        shape=(wcs.header['NAXIS2'], wcs.header['NAXIS1'])
+    wcs.header['NEMOVER']=nemo.__version__
+    hdu=pyfits.PrimaryHDU(np.zeros([1, 1], dtype = np.float32), wcs.header)
+    header=hdu.header
+    header['NAXIS1']=shape[1]
+    header['NAXIS2']=shape[0]
+    if os.path.exists(outFileName):
+        os.remove(outFileName)
+    headerBytes=header.tostring().encode('ascii')
+    dataSize=shape[0]*shape[1]*4
+    paddedDataSize=int(np.ceil(dataSize/2880))*2880
+    with open(outFileName, "wb") as outFile:
+        outFile.write(headerBytes)
+        # Sparse file on most filesystems - unwritten data reads as zeros
+        outFile.truncate(len(headerBytes)+paddedDataSize)
+
+    return len(headerBytes)
 
 #-------------------------------------------------------------------------------------------------------------
 def _makeTanWCS(wcs, pixScale = 0.5/60.0):
@@ -982,58 +1192,57 @@ def maskOutSources(mapData, wcs, catalog, radiusArcmin = 7.0, mask = 0.0, growMa
                                                 np.arange(mapData.shape[1]), 
                                                 bckSubbed, kx = 1, ky = 1)
 
-    for obj in catalog:
-        if wcs.coordsAreInImage(obj['RADeg'], obj['decDeg']) == True:
-            degreesMap=np.ones(mapData.shape, dtype = float)*1e6
-            rRange, xBounds, yBounds=makeDegreesDistanceMap(degreesMap, wcs,
-                                                            obj['RADeg'], obj['decDeg'],
-                                                            20.0/60.0)
-            circleMask=np.less(rRange, radiusArcmin/60.0)
-            grownCircleMask=np.less(rRange, (radiusArcmin*growMaskedArea)/60.0)
-            maskMap[grownCircleMask]=1.0
-            if type(mask) == float or type(mask) == int:
-                maskedMapData[circleMask]=mask
-
-            elif mask == 'shuffle':
-                # How about copying random pixels from the vicinity into the area to be masked?
-                annulusMask=np.logical_and(np.greater(rRange, 5.0/60.0), \
-                                            np.less(rRange, 10.0/60.0))
-                annulusValues=mapData[annulusMask].flatten()
-                indices=np.random.randint(0, annulusValues.shape[0], circleMask.flatten().nonzero()[0].shape[0])
-                maskedMapData[circleMask]=annulusValues[indices]
-                
-            elif mask == 'subtract':         
-                peakValue=mapData[int(round(obj['y'])), int(round(obj['x']))]
-                sigmaDeg=(1.4/60.0)/np.sqrt(8.0*np.log(2.0))            
-                profRDeg=np.linspace(0.0, 30.0/60.0, 5000)
-                profile1d=peakValue*np.exp(-((profRDeg**2)/(2*sigmaDeg**2)))                
-                r2p=interpolate.interp1d(profRDeg, profile1d, bounds_error=False, fill_value=0.0)
-                profile2d=np.zeros(rRange.shape)
-                profMask=np.less(rRange, 1.0)
-                profile2d[profMask]=r2p(rRange[profMask])
-                maskedMapData[profMask]=maskedMapData[profMask]-profile2d[profMask]
-                
-                # NOTE: below old, replaced Jul 2015 but not deleted as yet...
-                # 1.3197 is a correction factor for effect of filtering on bckSubbed
-                # Worked out by comparing peak value of bckSubbed profile2d only map
-                #peakValue=mapInterpolator(obj['y'], obj['x'])[0][0]*1.3197   
-                #sigmaDeg=(1.4/60.0)/np.sqrt(8.0*np.log(2.0))            
-                #profRDeg=np.linspace(0.0, 30.0/60.0, 5000)
-                #profile1d=peakValue*np.exp(-((profRDeg**2)/(2*sigmaDeg**2)))                
-                #r2p=interpolate.interp1d(profRDeg, profile1d, bounds_error=False, fill_value=0.0)
-                #profile2d=np.zeros(rRange.shape)
-                #profMask=np.less(rRange, 1.0)
-                #profile2d[profMask]=r2p(rRange[profMask])
-                #maskedMapData[profMask]=maskedMapData[profMask]-profile2d[profMask]
+    inImage=[wcs.coordsAreInImage(obj['RADeg'], obj['decDeg']) for obj in catalog]
+    catalog=catalog[np.array(inImage, dtype = bool)]
+    cutouts=makeDegreesDistanceCutouts(mapData.shape, wcs, catalog['RADeg'], catalog['decDeg'], 20.0/60.0)
+    for obj, (rRange, slices) in zip(catalog, cutouts):
+        # NOTE: rRange only covers the 20 arcmin box around the object, found at slices in the map
+        circleMask=np.less(rRange, radiusArcmin/60.0)
+        grownCircleMask=np.less(rRange, (radiusArcmin*growMaskedArea)/60.0)
+        maskMap[slices][grownCircleMask]=1.0
+        if type(mask) == float or type(mask) == int:
+            maskedMapData[slices][circleMask]=mask
+
+        elif mask == 'shuffle':
+            # How about copying random pixels from the vicinity into the area to be masked?
+            annulusMask=np.logical_and(np.greater(rRange, 5.0/60.0), \
+                                        np.less(rRange, 10.0/60.0))
+            annulusValues=mapData[slices][annulusMask].flatten()
+            indices=np.random.randint(0, annulusValues.shape[0], circleMask.flatten().nonzero()[0].shape[0])
+            maskedMapData[slices][circleMask]=annulusValues[indices]
             
-                
-            elif mask == "whiteNoise":
-                # Get pedestal level and white noise level from average between radiusArcmin and  2*radiusArcmin
-                annulusMask=np.logical_and(np.greater(rRange, 2*radiusArcmin/60.0), \
-                                            np.less(rRange, 4*radiusArcmin/60.0))
-                maskedMapData[circleMask]=np.random.normal(mapData[annulusMask].mean(), \
-                                                            mapData[annulusMask].std(),  \
-                                                            mapData[circleMask].shape)
+        elif mask == 'subtract':         
+            peakValue=mapData[int(round(obj['y'])), int(round(obj['x']))]
+            sigmaDeg=(1.4/60.0)/np.sqrt(8.0*np.log(2.0))            
+            profRDeg=np.linspace(0.0, 30.0/60.0, 5000)
+            profile1d=peakValue*np.exp(-((profRDeg**2)/(2*sigmaDeg**2)))                
+            r2p=interpolate.interp1d(profRDeg, profile1d, bounds_error=False, fill_value=0.0)
+            profile2d=np.zeros(rRange.shape)
+            profMask=np.less(rRange, 1.0)
+            profile2d[profMask]=r2p(rRange[profMask])
+            maskedMapData[slices][profMask]=maskedMapData[slices][profMask]-profile2d[profMask]
+            
+            # NOTE: below old, replaced Jul 2015 but not deleted as yet...
+            # 1.3197 is a correction factor for effect of filtering on bckSubbed
+            # Worked out by comparing peak value of bckSubbed profile2d only map
+            #peakValue=mapInterpolator(obj['y'], obj['x'])[0][0]*1.3197   
+            #sigmaDeg=(1.4/60.0)/np.sqrt(8.0*np.log(2.0))            
+            #profRDeg=np.linspace(0.0, 30.0/60.0, 5000)
+            #profile1d=peakValue*np.exp(-((profRDeg**2)/(2*sigmaDeg**2)))                
+            #r2p=interpolate.interp1d(profRDeg, profile1d, bounds_error=False, fill_value=0.0)
+            #profile2d=np.zeros(rRange.shape)
+            #profMask=np.less(rRange, 1.0)
+            #profile2d[profMask]=r2p(rRange[profMask])
+            #maskedMapData[profMask]=maskedMapData[profMask]-profile2d[profMask]
+        
+            
+        elif mask == "whiteNoise":
+            # Get pedestal level and white noise level from average between radiusArcmin and  2*radiusArcmin
+            annulusMask=np.logical_and(np.greater(rRange, 2*radiusArcmin/60.0), \
+                                        np.less(rRange, 4*radiusArcmin/60.0))
+            maskedMapData[slices][circleMask]=np.random.normal(mapData[slices][annulusMask].mean(), \
+                                                                mapData[slices][annulusMask].std(),  \
+                                                                mapData[slices][circleMask].shape)
     
     return {'data': maskedMapData, 'mask': maskMap}
 
@@ -1072,18 +1281,16 @@ def applyPointSourceMask(maskFileName, mapData, mapWCS, mask = 0.0, radiusArcmin
         elif mask == "whiteNoise":
             RADeg, decDeg=mapWCS.pix2wcs(pos[1], pos[0])
             if np.isnan(RADeg) == False and np.isnan(decDeg) == False:
-                degreesMap=np.ones(mapData.shape, dtype = float)*1e6
-                rRange, xBounds, yBounds=makeDegreesDistanceMap(degreesMap, mapWCS,
-                                                                RADeg, decDeg,
-                                                                (radiusArcmin*4)/60.0)
+                rRange, slices=makeDegreesDistanceCutout(mapData.shape, mapWCS, RADeg, decDeg,
+                                                         (radiusArcmin*4)/60.0)
                 # Get pedestal level and white noise level from average between radiusArcmin and  2*radiusArcmin
                 annulusMask=np.logical_and(np.greater(rRange, radiusArcmin/60.0), \
                                               np.less(rRange, 2*radiusArcmin/60.0))
                 # Below just does a quick sanity check - we don't bother masking if std == 0, because we're
                 # most likely applying this in the middle of a fake source sim with map set to zero for testing
-                sigma=mapData[annulusMask].std()
+                sigma=mapData[slices][annulusMask].std()
                 if sigma > 0:
-                    maskedMapData[circleMask]=np.random.normal(mapData[annulusMask].mean(), \
+                    maskedMapData[circleMask]=np.random.normal(mapData[slices][annulusMask].mean(), \
                                                                   sigma,  \
                                                                   mapData[circleMask].shape)
     
@@ -1320,6 +1527,52 @@ def convolveMapWithBeam(data, wcs, beam, maxDistDegrees = 1.0):
         
     return outMap
 
+#-------------------------------------------------------------------------------------------------------------
+def convolveWithKernel(data, kernel, method = 'auto'):
+    """Convolves a map with a real space kernel, treating the map edges in the same way as
+    :func:`scipy.ndimage.convolve` (i.e., by reflection).
+    
+    Args:
+        data (:obj:`numpy.ndarray`): Map to convolve, as 2d array. This may also be a stack of maps (with
+            the maps along the last two axes), in which case all maps in the stack are convolved at once.
+        kernel (:obj:`numpy.ndarray`): Convolution kernel, as 2d array.
+        method (:obj:`str`, optional): Either 'direct' (use :func:`scipy.ndimage.convolve`), 'fft' (use 
+            FFT-based overlap-add convolution on the reflection-padded map), or 'auto' (choose whichever
+            of these is expected to be fastest, given the sizes of the kernel and the map).
+    
+    Returns:
+        Convolved map (numpy array), with the same shape and dtype as `data`.
+    
+    """
+    
+    if method == 'auto':
+        # Rough operation counts - direct convolution scales with kernel area x map area
+        paddedPix=(data.shape[-2]+kernel.shape[0]-1)*(data.shape[-1]+kernel.shape[1]-1)
+        directCost=float(kernel.size)*data.shape[-2]*data.shape[-1]
+        fftCost=3*paddedPix*np.log2(paddedPix)
+        if directCost > fftCost:
+            method='fft'
+        else:
+            method='direct'
+
+    # For a stack of maps, the kernel is broadcast along the leading axes
+    stackDims=data.ndim-2
+    
+    if method == 'direct':
+        outMap=ndimage.convolve(data, kernel.reshape((1,)*stackDims+kernel.shape))
+    elif method == 'fft':
+        # Padding chosen such that the 'valid' region lines up with ndimage.convolve (for odd or even kernels)
+        cy=kernel.shape[0]//2
+        cx=kernel.shape[1]//2
+        padded=np.pad(data, ((0, 0),)*stackDims+((kernel.shape[0]-1-cy, cy), (kernel.shape[1]-1-cx, cx)),
+                      mode = 'symmetric')
+        outMap=scipy_oaconvolve(padded, kernel.reshape((1,)*stackDims+kernel.shape), mode = 'valid',
+                                axes = (-2, -1)).astype(data.dtype)
+    else:
+        raise Exception("convolution method must be 'direct', 'fft', or 'auto' (given '%s')" % (method))
+    
+    return outMap
+
 #-------------------------------------------------------------------------------------------------------------
 def smoothMap(data, wcs, RADeg = 'centre', decDeg = 'centre', smoothScaleDeg = 5.0/60.0):
     """Smoothes map with Gaussian of given scale.
@@ -1664,6 +1917,10 @@ def makeModelImage(shape, wcs, catalog, beamFileName, obsFreqGHz = None, GNFWPar
         
     Returns:
         Map containing injected sources, or None if there are no objects within the map dimensions.
+
+    Note:
+        Clusters that share the same mass and redshift (e.g., objects in a nemo catalog that were matched to
+        the same filter template) are painted together, so that each profile is only calculated once.
     
     """
 
@@ -1707,7 +1964,7 @@ def makeModelImage(shape, wcs, catalog, beamFileName, obsFreqGHz = None, GNFWPar
         return None
 
     if cosmoModel is None:
-        cosmoModel=signals.fiducialCosmoModel
+        cosmoModel=signals.getFiducialCosmoModel()
 
     # Set initial max size in degrees from beam file (used for sources; clusters adjusted for each object)
     t0=time.time()
@@ -1751,8 +2008,11 @@ def makeModelImage(shape, wcs, catalog, beamFileName, obsFreqGHz = None, GNFWPar
                 modelMap=convertToDeltaT(modelMap, obsFrequencyGHz = obsFreqGHz,
                                          TCMBAlpha = TCMBAlpha, z = z)
         else:
-            for row in catalog:
-                count=count+1
+            zs=np.zeros(len(catalog))
+            M500s=np.zeros(len(catalog))
+            y0sToInsert=np.zeros(len(catalog))
+            for i in range(len(catalog)):
+                row=catalog[i]
                 if 'true_M500c' in catalog.keys():
                     # This case is for when we're running from nemoMock output
                     # Since the idea of this is to create noise-free model images, we must use true values here
@@ -1769,29 +2029,35 @@ def makeModelImage(shape, wcs, catalog, beamFileName, obsFreqGHz = None, GNFWPar
                     M500=float(bits[1][1:].replace("p", "."))
                     z=float(bits[2][1:].replace("p", "."))
                     y0ToInsert=row['y_c']*1e-4  # or fixed_y_c...
+                zs[i]=z
+                M500s[i]=M500
+                y0sToInsert[i]=y0ToInsert
+            # Objects with the same (z, M500) share a profile, so we build it once and paint the whole group
+            # with one call (e.g., nemo output catalogs, where objects are matched to a grid of templates)
+            RAs=np.array(catalog['RADeg'], dtype = np.float64)
+            decs=np.array(catalog['decDeg'], dtype = np.float64)
+            scales, groupIndices=np.unique(np.array([zs, M500s]).transpose(), axis = 0, return_inverse = True)
+            groupIndices=groupIndices.flatten()
+            for i in range(len(scales)):
+                z, M500=scales[i]
+                groupMask=np.equal(groupIndices, i)
+                count=count+groupMask.sum()
                 theta500Arcmin=signals.calcTheta500Arcmin(z, M500, cosmoModel)
                 maxSizeDeg=5*(theta500Arcmin/60)
                 # Updated in place
-                makeClusterSignalMap(z, M500, modelMap.shape, wcs, RADeg = row['RADeg'],
-                                     decDeg = row['decDeg'], beam = beam,
-                                     GNFWParams = GNFWParams, amplitude = y0ToInsert,
+                makeClusterSignalMap(z, M500, modelMap.shape, wcs, RADeg = RAs[groupMask],
+                                     decDeg = decs[groupMask], beam = beam,
+                                     GNFWParams = GNFWParams, amplitude = y0sToInsert[groupMask],
                                      maxSizeDeg = maxSizeDeg, convolveWithBeam = convolveWithBeam,
                                      cosmoModel = cosmoModel, omap = modelMap,
                                      obsFrequencyGHz = obsFreqGHz, TCMBAlpha = TCMBAlpha)
     else:
         # Sources - slower but more accurate way
-        for row in catalog:
-            if validAreaSection is not None:
-                x0, x1, y0, y1=validAreaSection
-                x, y=wcs.wcs2pix(row['RADeg'], row['decDeg'])
-                if (x >= x0 and x < x1 and y >= y0 and y < y1) == False:
-                    continue
-            degreesMap=np.ones(modelMap.shape, dtype = float)*1e6 # NOTE: never move this
-            degreesMap, xBounds, yBounds=makeDegreesDistanceMap(degreesMap, wcs,
-                                                                row['RADeg'], row['decDeg'],
-                                                                maxSizeDeg)
-            signalMap=signals.makeBeamModelSignalMap(degreesMap, wcs, beam)*row['deltaT_c']
-            modelMap=modelMap+signalMap
+        # Catalog has already been cut to validAreaSection above, and each source only touches its own box
+        modelMap=modelMap.astype(np.float64)
+        cutouts=makeDegreesDistanceCutouts(modelMap.shape, wcs, catalog['RADeg'], catalog['decDeg'], maxSizeDeg)
+        for row, (rDeg, slices) in zip(catalog, cutouts):
+            modelMap[slices]+=signals.makeBeamModelSignalMap(rDeg, wcs, beam)*row['deltaT_c']
     t1=time.time()
     if reportTimingInfo: print("makeModelImage - painting objects - took %.3f sec" % (t1-t0))
 
@@ -1805,6 +2071,68 @@ def makeModelImage(shape, wcs, catalog, beamFileName, obsFreqGHz = None, GNFWPar
 
     return modelMap
         
+#------------------------------------------------------------------------------------------------------------
+def _makeInjectSources(config, filtDict, sourceInjectionModel, realCatalog, selFn, numSourcesPerTile, fluxCol):
+    """Generates a mock catalog of objects to inject into the maps for :meth:`sourceInjectionTest`.
+
+    Args:
+        config (:obj:`nemo.startUp.NemoConfig`): Nemo configuration object.
+        filtDict (:obj:`dict`): Dictionary describing the reference filter (see :ref:`Filters`).
+        sourceInjectionModel (:obj:`dict`): The source injection model in use.
+        realCatalog (:obj:`astropy.table.Table`): The catalog of real objects found in the maps.
+        selFn (:obj:`completeness.SelFn`): Selection function object, used for its area mask.
+        numSourcesPerTile (:obj:`int`): The maximum number of sources to inject into each tile.
+        fluxCol (:obj:`str`): Name of the column in which the amplitudes of the injected objects are given.
+
+    Returns:
+        A dictionary in the format expected for the `injectSources` key of a :class:`MapDict` (the mock
+        catalog itself is given in the `catalog` key).
+
+    """
+
+    if filtDict['class'].find("ArnaudModel") != -1:
+        if 'sourceInjectionAmplitudeRange' not in config.parDict.keys():
+            amplitudeRange=[0.001, 10]
+        else:
+            amplitudeRange=config.parDict['sourceInjectionAmplitudeRange']
+            if amplitudeRange == 'auto':
+                amplitudeRange=[realCatalog['fixed_y_c'].min()*0.5, realCatalog['fixed_y_c'].max()]
+        if 'sourceInjectionDistribution' not in config.parDict.keys():
+            distribution='linear'
+        else:
+            distribution=config.parDict['sourceInjectionDistribution']
+        # Quick test catalog - takes < 1 sec to generate
+        mockCatalog=catalogs.generateTestCatalog(config, numSourcesPerTile,
+                                                amplitudeColumnName = fluxCol,
+                                                amplitudeRange = amplitudeRange,
+                                                amplitudeDistribution = distribution,
+                                                selFn = selFn, maskDilationPix = 20)
+        # Or... proper mock, but this takes ~24 sec for E-D56
+        #mockCatalog=pipelines.makeMockClusterCatalog(config, writeCatalogs = False, verbose = False)[0]
+        injectSources={'catalog': mockCatalog, 'GNFWParams': config.parDict['GNFWParams'],
+                       'override': sourceInjectionModel, 'profile': 'A10'}
+    elif filtDict['class'].find("Beam") != -1:
+        if 'sourceInjectionAmplitudeRange' not in config.parDict.keys():
+            amplitudeRange=[1, 1000]
+        else:
+            amplitudeRange=config.parDict['sourceInjectionAmplitudeRange']
+        if 'sourceInjectionDistribution' not in config.parDict.keys():
+            distribution='log'
+        else:
+            distribution=config.parDict['sourceInjectionDistribution']
+        mockCatalog=catalogs.generateTestCatalog(config, numSourcesPerTile,
+                                                amplitudeColumnName = fluxCol,
+                                                amplitudeRange = amplitudeRange,
+                                                amplitudeDistribution = distribution,
+                                                selFn = selFn, maskDilationPix = 20)
+        injectSources={'catalog': mockCatalog, 'override': sourceInjectionModel, 'profile': None}
+    else:
+        raise Exception("Don't know how to generate injected source catalogs for filterClass '%s'" % (filtDict['class']))
+    if 'theta500Arcmin' in sourceInjectionModel.keys():
+        mockCatalog['theta500Arcmin']=sourceInjectionModel['theta500Arcmin']
+
+    return injectSources
+
 #------------------------------------------------------------------------------------------------------------
 def sourceInjectionTest(config):
     """Insert sources with known positions and properties into the map, apply the filter, and record their
@@ -1826,7 +2154,11 @@ def sourceInjectionTest(config):
         in the config). Input amplitudes for clusters are in `y_c`, while output is in `fixed_y_c`
         (because the reference filter is used). Similarly, output SNR is `fixed_SNR`, although the
         output column is labelled as `SNR`.
-    
+
+        If `sourceInjectionIncremental` is set in the config, the maps are only filtered once, and then
+        only the injected sources are filtered in each iteration (see
+        :meth:`pipelines.injectAndRecoverSources`).
+
     """
 
     # WARNING: For multi-pass mode, this has the desired behaviour IF this is called after a nemo run
@@ -1858,7 +2190,7 @@ def sourceInjectionTest(config):
         for sourceInjectionModel in sourceInjectionModelList:
             theta500Arcmin=signals.calcTheta500Arcmin(sourceInjectionModel['redshift'],
                                                       sourceInjectionModel['M500'],
-                                                      signals.fiducialCosmoModel)
+                                                      signals.getFiducialCosmoModel())
             label='%.2f' % (theta500Arcmin)
             sourceInjectionModel['label']=label
             sourceInjectionModel['theta500Arcmin']=theta500Arcmin
@@ -1907,144 +2239,140 @@ def sourceInjectionTest(config):
         outFluxDict[sourceInjectionModel['label']]=[]
         noiseLevelDict[sourceInjectionModel['label']]=[]
         tileNamesDict[sourceInjectionModel['label']]=[]
-        for i in range(numIterations):        
-            print(">>> Source injection and recovery test %d/%d [rank = %d]" % (i+1, numIterations, config.rank))
 
-            # NOTE: This block below should be handled when parsing the config file - fix/remove
-            # Optional override of default GNFW parameters (used by Arnaud model), if used in filters given
-            if 'GNFWParams' not in list(config.parDict.keys()):
-                config.parDict['GNFWParams']='default'
-            for filtDict in config.parDict['mapFilters']:
-                filtDict['params']['GNFWParams']=config.parDict['GNFWParams']
-            
-            # We don't want to save/cache position recovery test maps
-            for filtDict in config.parDict['mapFilters']:
-                keysToFalsify=['saveFilteredMaps', 'savePlots']
-                for key in keysToFalsify:
-                    filtDict['params'][key]=False
-            
-            # Delete all non-reference scale filters (otherwise we'd want to cache all filters for speed)
-            # NOTE: As it stands, point-source only runs may not define photFilter - we need to handle that
-            # That should be obvious, as mapFilters will only have one entry
-            for filtDict in config.parDict['mapFilters']:
-                if filtDict['label'] == config.parDict['photFilter']:
-                    break
-            config.parDict['mapFilters']=[filtDict]
-                
-            # Filling maps with injected sources will be done when maps.preprocessMapDict is called by the filter object
-            # So, we only generate the catalog here
-            print("... generating mock catalog")
+        # NOTE: This block below should be handled when parsing the config file - fix/remove
+        # Optional override of default GNFW parameters (used by Arnaud model), if used in filters given
+        if 'GNFWParams' not in list(config.parDict.keys()):
+            config.parDict['GNFWParams']='default'
+        for filtDict in config.parDict['mapFilters']:
+            filtDict['params']['GNFWParams']=config.parDict['GNFWParams']
+
+        # We don't want to save/cache position recovery test maps
+        for filtDict in config.parDict['mapFilters']:
+            keysToFalsify=['saveFilteredMaps', 'savePlots']
+            for key in keysToFalsify:
+                filtDict['params'][key]=False
+
+        # Delete all non-reference scale filters (otherwise we'd want to cache all filters for speed)
+        # NOTE: As it stands, point-source only runs may not define photFilter - we need to handle that
+        # That should be obvious, as mapFilters will only have one entry
+        for filtDict in config.parDict['mapFilters']:
+            if filtDict['label'] == config.parDict['photFilter']:
+                break
+        config.parDict['mapFilters']=[filtDict]
+
+        # Incremental mode: all of the mock catalogs are made up front, and then the injected sources are
+        # filtered and recovered in batches, re-using the filtered real maps (see pipelines.injectAndRecoverSources)
+        if config.parDict['sourceInjectionIncremental'] == True:
+            print("... generating %d mock catalogs" % (numIterations))
             if config.rank == 0:
-                if filtDict['class'].find("ArnaudModel") != -1:
-                    if 'sourceInjectionAmplitudeRange' not in config.parDict.keys():
-                        amplitudeRange=[0.001, 10]
-                    else:
-                        amplitudeRange=config.parDict['sourceInjectionAmplitudeRange']
-                        if amplitudeRange == 'auto':
-                            amplitudeRange=[realCatalog['fixed_y_c'].min()*0.5, realCatalog['fixed_y_c'].max()]
-                    if 'sourceInjectionDistribution' not in config.parDict.keys():
-                        distribution='linear'
-                    else:
-                        distribution=config.parDict['sourceInjectionDistribution']
-                    # Quick test catalog - takes < 1 sec to generate
-                    mockCatalog=catalogs.generateTestCatalog(config, numSourcesPerTile,
-                                                            amplitudeColumnName = fluxCol,
-                                                            amplitudeRange = amplitudeRange,
-                                                            amplitudeDistribution = distribution,
-                                                            selFn = selFn, maskDilationPix = 20)
-                    # Or... proper mock, but this takes ~24 sec for E-D56
-                    #mockCatalog=pipelines.makeMockClusterCatalog(config, writeCatalogs = False, verbose = False)[0]
-                    injectSources={'catalog': mockCatalog, 'GNFWParams': config.parDict['GNFWParams'],
-                                   'override': sourceInjectionModel, 'profile': 'A10'}
-                elif filtDict['class'].find("Beam") != -1:
-                    if 'sourceInjectionAmplitudeRange' not in config.parDict.keys():
-                        amplitudeRange=[1, 1000]
-                    else:
-                        amplitudeRange=config.parDict['sourceInjectionAmplitudeRange']
-                    if 'sourceInjectionDistribution' not in config.parDict.keys():
-                        distribution='log'
-                    else:
-                        distribution=config.parDict['sourceInjectionDistribution']
-                    mockCatalog=catalogs.generateTestCatalog(config, numSourcesPerTile,
-                                                            amplitudeColumnName = fluxCol,
-                                                            amplitudeRange = amplitudeRange,
-                                                            amplitudeDistribution = distribution,
-                                                            selFn = selFn, maskDilationPix = 20)
-                    injectSources={'catalog': mockCatalog, 'override': sourceInjectionModel, 'profile': None}
-                else:
-                    raise Exception("Don't know how to generate injected source catalogs for filterClass '%s'" % (filtDict['class']))
-                if 'theta500Arcmin' in sourceInjectionModel.keys():
-                    mockCatalog['theta500Arcmin']=sourceInjectionModel['theta500Arcmin']
-                allInputCatalogs.append(mockCatalog)
+                injectSourcesList=[]
+                for i in range(numIterations):
+                    injectSources=_makeInjectSources(config, filtDict, sourceInjectionModel, realCatalog, selFn,
+                                                     numSourcesPerTile, fluxCol)
+                    injectSourcesList.append(injectSources)
+                    allInputCatalogs.append(injectSources['catalog'])
             else:
-                injectSources=None
-                mockCatalog=None
-
+                injectSourcesList=None
             if config.MPIEnabled == True:
-                bcastInjectSources=config.comm.bcast(injectSources, root = 0)
-                config.comm.barrier()
-                if config.rank > 0:
-                    injectSources=bcastInjectSources
-                    mockCatalog=bcastInjectSources['catalog']
-
+                injectSourcesList=config.comm.bcast(injectSourcesList, root = 0)
             for mapDict in config.unfilteredMapsDictList:
-                mapDict['injectSources']=injectSources
-            
-            # Ideally we shouldn't have blank tiles... but if we do, skip
-            if len(mockCatalog) > 0:
-
-                # Uncomment line below if want to save filtered maps for quick and dirty debugging
-                # Overwrites the original filtered map, but can compare to 'stitched' map
-                # config.parDict['mapFilters'][0]['params']['saveFilteredMaps']=True
-
-                recCatalog=pipelines.filterMapsAndMakeCatalogs(config, useCachedFilters = True,
-                                                               useCachedRMSMap = True, writeAreaMask = False,
-                                                               writeFlagMask = False)
-
-                # NOTE: Below here only rank 0 really needed (could then broadcast result)
-
-                # We should be conservative in removing potential matches with real objects
-                # Because we have a huge sky area and there's no reason to risk contamination of this kind
-                # Effectively this is the same as using 5' circular holes in the survey mask on real objects
-                # (but actually adding the avoidance radius parameter to the test catalogs really solved this)
-                if len(recCatalog) > 0:
-                    recCatalog=catalogs.removeCrossMatched(recCatalog, realCatalog,
-                                                           radiusArcmin = realExclusionRadiusArcmin)
-                if len(recCatalog) > 0:
-                    try:
-                        x_mockCatalog, x_recCatalog, rDeg=catalogs.crossMatch(mockCatalog, recCatalog,
-                                                                              radiusArcmin = realExclusionRadiusArcmin)
-                    except:
-                        raise Exception("Source injection test: cross match failed on tileNames = %s; mockCatalog length = %d; recCatalog length = %d" % (str(config.tileNames), len(mockCatalog), len(recCatalog)))
-
-                    # Catching any crazy mismatches, writing output for debugging
-                    if clusterMode == False and np.logical_and(rDeg > 1.5/60, x_recCatalog['SNR'] > 10).sum() > 0:
-                        mask=np.logical_and(rDeg > 1.5/60, x_recCatalog['SNR'] > 10)
-                        config.parDict['mapFilters'][0]['params']['saveFilteredMaps']=True
-                        recCatalog2=pipelines.filterMapsAndMakeCatalogs(config, useCachedFilters = True,
-                                                                        writeAreaMask = False, writeFlagMask = False)
-                        recCatalog2=catalogs.removeCrossMatched(recCatalog2, realCatalog,
-                                                                radiusArcmin = realExclusionRadiusArcmin)
-                        catalogs.catalog2DS9(x_recCatalog[mask],
-                                             simRootOutDir+os.path.sep+"filteredMaps"+os.path.sep+tileName+os.path.sep+"mismatch-rec.reg")
-                        catalogs.catalog2DS9(x_mockCatalog[mask],
-                                             simRootOutDir+os.path.sep+"filteredMaps"+os.path.sep+tileName+os.path.sep+"mismatch-input.reg",
-                                             color = 'red')
-                        msg="Caught recovered source at large offset - check output under %s" % (simRootOutDir+os.path.sep+"filteredMaps"+os.path.sep+tileName)
-                        if config.parDict['haltOnPositionRecoveryProblem'] == True:
-                            raise Exception(msg)
-                        else:
-                            print("... Warning: %s ..." % (msg))
-
-                    # Store everything - analyse later
-                    RADegDict[sourceInjectionModel['label']]=RADegDict[sourceInjectionModel['label']]+x_recCatalog['RADeg'].tolist()
-                    decDegDict[sourceInjectionModel['label']]=decDegDict[sourceInjectionModel['label']]+x_recCatalog['decDeg'].tolist()
-                    SNRDict[sourceInjectionModel['label']]=SNRDict[sourceInjectionModel['label']]+x_recCatalog[SNRCol].tolist()
-                    rArcminDict[sourceInjectionModel['label']]=rArcminDict[sourceInjectionModel['label']]+(rDeg*60).tolist()
-                    inFluxDict[sourceInjectionModel['label']]=inFluxDict[sourceInjectionModel['label']]+x_mockCatalog[fluxCol].tolist()
-                    outFluxDict[sourceInjectionModel['label']]=outFluxDict[sourceInjectionModel['label']]+x_recCatalog[fluxCol].tolist()
-                    noiseLevelDict[sourceInjectionModel['label']]=noiseLevelDict[sourceInjectionModel['label']]+x_recCatalog[noiseLevelCol].tolist()
-                    tileNamesDict[sourceInjectionModel['label']]=tileNamesDict[sourceInjectionModel['label']]+x_recCatalog['tileName'].tolist()
+                if 'injectSources' in mapDict.keys():
+                    del mapDict['injectSources']
+            recCatalogsList=pipelines.injectAndRecoverSources(config, injectSourcesList,
+                                                              batchSize = config.parDict['sourceInjectionBatchSize'])
+
+        for i in range(numIterations):
+            print(">>> Source injection and recovery test %d/%d [rank = %d]" % (i+1, numIterations, config.rank))
+
+            if config.parDict['sourceInjectionIncremental'] == True:
+                injectSources=injectSourcesList[i]
+                mockCatalog=injectSources['catalog']
+                recCatalog=recCatalogsList[i]
+            else:
+                # Filling maps with injected sources will be done when maps.preprocessMapDict is called by the filter object
+                # So, we only generate the catalog here
+                print("... generating mock catalog")
+                if config.rank == 0:
+                    injectSources=_makeInjectSources(config, filtDict, sourceInjectionModel, realCatalog, selFn,
+                                                     numSourcesPerTile, fluxCol)
+                    mockCatalog=injectSources['catalog']
+                    allInputCatalogs.append(mockCatalog)
+                else:
+                    injectSources=None
+                    mockCatalog=None
+
+                if config.MPIEnabled == True:
+                    bcastInjectSources=config.comm.bcast(injectSources, root = 0)
+                    config.comm.barrier()
+                    if config.rank > 0:
+                        injectSources=bcastInjectSources
+                        mockCatalog=bcastInjectSources['catalog']
+
+                for mapDict in config.unfilteredMapsDictList:
+                    mapDict['injectSources']=injectSources
+
+                # Ideally we shouldn't have blank tiles... but if we do, skip
+                if len(mockCatalog) > 0:
+
+                    # Uncomment line below if want to save filtered maps for quick and dirty debugging
+                    # Overwrites the original filtered map, but can compare to 'stitched' map
+                    # config.parDict['mapFilters'][0]['params']['saveFilteredMaps']=True
+
+                    recCatalog=pipelines.filterMapsAndMakeCatalogs(config, useCachedFilters = True,
+                                                                   useCachedRMSMap = True, writeAreaMask = False,
+                                                                   writeFlagMask = False)
+                else:
+                    recCatalog=[]
+
+            # NOTE: Below here only rank 0 really needed (could then broadcast result)
+
+            # We should be conservative in removing potential matches with real objects
+            # Because we have a huge sky area and there's no reason to risk contamination of this kind
+            # Effectively this is the same as using 5' circular holes in the survey mask on real objects
+            # (but actually adding the avoidance radius parameter to the test catalogs really solved this)
+            if len(recCatalog) > 0:
+                recCatalog=catalogs.removeCrossMatched(recCatalog, realCatalog,
+                                                       radiusArcmin = realExclusionRadiusArcmin)
+            if len(recCatalog) > 0:
+                try:
+                    x_mockCatalog, x_recCatalog, rDeg=catalogs.crossMatch(mockCatalog, recCatalog,
+                                                                          radiusArcmin = realExclusionRadiusArcmin)
+                except:
+                    raise Exception("Source injection test: cross match failed on tileNames = %s; mockCatalog length = %d; recCatalog length = %d" % (str(config.tileNames), len(mockCatalog), len(recCatalog)))
+
+                # Catching any crazy mismatches, writing output for debugging
+                if clusterMode == False and np.logical_and(rDeg > 1.5/60, x_recCatalog['SNR'] > 10).sum() > 0:
+                    mask=np.logical_and(rDeg > 1.5/60, x_recCatalog['SNR'] > 10)
+                    config.parDict['mapFilters'][0]['params']['saveFilteredMaps']=True
+                    for mapDict in config.unfilteredMapsDictList:
+                        mapDict['injectSources']=injectSources
+                    recCatalog2=pipelines.filterMapsAndMakeCatalogs(config, useCachedFilters = True,
+                                                                    writeAreaMask = False, writeFlagMask = False)
+                    config.parDict['mapFilters'][0]['params']['saveFilteredMaps']=False
+                    if config.parDict['sourceInjectionIncremental'] == True:
+                        for mapDict in config.unfilteredMapsDictList:
+                            del mapDict['injectSources']
+                    catalogs.catalog2DS9(x_recCatalog[mask],
+                                         config.filteredMapsDir+os.path.sep+"mismatch-rec.reg")
+                    catalogs.catalog2DS9(x_mockCatalog[mask],
+                                         config.filteredMapsDir+os.path.sep+"mismatch-input.reg",
+                                         color = 'red')
+                    msg="Caught recovered source at large offset - check output under %s" % (config.filteredMapsDir)
+                    if config.parDict['haltOnPositionRecoveryProblem'] == True:
+                        raise Exception(msg)
+                    else:
+                        print("... Warning: %s ..." % (msg))
+
+                # Store everything - analyse later
+                RADegDict[sourceInjectionModel['label']]=RADegDict[sourceInjectionModel['label']]+x_recCatalog['RADeg'].tolist()
+                decDegDict[sourceInjectionModel['label']]=decDegDict[sourceInjectionModel['label']]+x_recCatalog['decDeg'].tolist()
+                SNRDict[sourceInjectionModel['label']]=SNRDict[sourceInjectionModel['label']]+x_recCatalog[SNRCol].tolist()
+                rArcminDict[sourceInjectionModel['label']]=rArcminDict[sourceInjectionModel['label']]+(rDeg*60).tolist()
+                inFluxDict[sourceInjectionModel['label']]=inFluxDict[sourceInjectionModel['label']]+x_mockCatalog[fluxCol].tolist()
+                outFluxDict[sourceInjectionModel['label']]=outFluxDict[sourceInjectionModel['label']]+x_recCatalog[fluxCol].tolist()
+                noiseLevelDict[sourceInjectionModel['label']]=noiseLevelDict[sourceInjectionModel['label']]+x_recCatalog[noiseLevelCol].tolist()
+                tileNamesDict[sourceInjectionModel['label']]=tileNamesDict[sourceInjectionModel['label']]+x_recCatalog['tileName'].tolist()
 
         RADegDict[sourceInjectionModel['label']]=np.array(RADegDict[sourceInjectionModel['label']])
         decDegDict[sourceInjectionModel['label']]=np.array(decDegDict[sourceInjectionModel['label']])
@@ -2390,7 +2718,7 @@ def saveFITS(outputFileName, mapData, wcs, compressionType = None):
                 dtype=np.uint8
             else:
                 dtype=np.float32
-            hdu=pyfits.CompImageHDU(np.array(mapData, dtype = dtype), wcs.header, 
+            hdu=pyfits.CompImageHDU(np.asarray(mapData, dtype = dtype), wcs.header, 
                                     compression_type = compressionType)
         else:
             hdu=pyfits.CompImageHDU(np.array(mapData, dtype = dtype), None,
@@ -2427,39 +2755,97 @@ def makeDegreesDistanceMap(degreesMap, wcs, RADeg, decDeg, maxDistDegrees):
         does not change. So, this routine may only be accurate close to the given position,
         depending upon the WCS projection used.
 
+    Note:
+        If only the region around the given position is needed, :func:`makeDegreesDistanceCutout`
+        avoids having to allocate (and search) an array the size of the whole map.
+
     """
 
-    x0, y0=wcs.wcs2pix(RADeg, decDeg)
-    ra0, dec0=RADeg, decDeg
-    ra1, dec1=wcs.pix2wcs(x0+1, y0+1)
-    xPixScale=astCoords.calcAngSepDeg(ra0, dec0, ra1, dec0)
-    yPixScale=astCoords.calcAngSepDeg(ra0, dec0, ra0, dec1)
+    rDeg, (ySlice, xSlice)=makeDegreesDistanceCutout(degreesMap.shape, wcs, RADeg, decDeg, maxDistDegrees)
+    degreesMap[ySlice, xSlice]=rDeg
+
+    return degreesMap, [xSlice.start, xSlice.stop], [ySlice.start, ySlice.stop]
+
+#---------------------------------------------------------------------------------------------------
+def makeDegreesDistanceCutout(shape, wcs, RADeg, decDeg, maxDistDegrees):
+    """Returns a 2d array of distance in degrees from the given position, covering only the box
+    (within a map of the given shape) that encloses the circle of radius maxDistDegrees, together with
+    the slices that locate that box within the map. The slices can be used to update the map in place,
+    e.g.,
+
+    .. code-block:: python
+
+        rDeg, slices=makeDegreesDistanceCutout(data.shape, wcs, RADeg, decDeg, maskRadiusDeg)
+        data[slices][rDeg < maskRadiusDeg]=0
+
+    Args:
+        shape (:obj:`tuple`): Shape (height, width) of the map.
+        wcs (:obj:`astWCS.WCS`): WCS corresponding to the map.
+        RADeg (:obj:`float`): RA in decimal degrees of position of interest (e.g., object location).
+        decDeg (:obj:`float`): Declination in decimal degrees of position of interest (e.g., object
+            location).
+        maxDistDegrees (:obj:`float`): The maximum radius out to which distance will be calculated.
+
+    Returns:
+        A 2d array of distance in degrees from the given position, and a tuple of slices (y, x) that
+        gives the location of this array within the map. The array may have zero size if the box does
+        not overlap the map.
 
-    xDistPix=int(round((maxDistDegrees)/xPixScale))
-    yDistPix=int(round((maxDistDegrees)/yPixScale))
-
-    Y=degreesMap.shape[0]
-    X=degreesMap.shape[1]
-
-    minX=int(round(x0))-xDistPix
-    maxX=int(round(x0))+xDistPix
-    minY=int(round(y0))-yDistPix
-    maxY=int(round(y0))+yDistPix
-    if minX < 0:
-        minX=0
-    if maxX > X:
-        maxX=X
-    if minY < 0:
-        minY=0
-    if maxY > Y:
-        maxY=Y
-
-    xDeg=(np.arange(degreesMap.shape[1])-x0)*xPixScale
-    yDeg=(np.arange(degreesMap.shape[0])-y0)*yPixScale
-    for i in range(minY, maxY):
-        degreesMap[i][minX:maxX]=np.sqrt(yDeg[i]**2+xDeg[minX:maxX]**2)
-
-    return degreesMap, [minX, maxX], [minY, maxY]
+    Note:
+        As with :func:`makeDegreesDistanceMap`, the pixel scale is measured local to the given position,
+        and assumed not to change across the box.
+
+    """
+
+    return next(makeDegreesDistanceCutouts(shape, wcs, [RADeg], [decDeg], maxDistDegrees))
+
+#---------------------------------------------------------------------------------------------------
+def makeDegreesDistanceCutouts(shape, wcs, RADeg, decDeg, maxDistDegrees):
+    """Generator version of :func:`makeDegreesDistanceCutout`, for a whole catalog of positions. The
+    pixel coordinates, local pixel scales, and box bounds are computed for all positions at once, and
+    then the distance array and slices for each position are yielded in turn (so that only one cutout
+    needs to be held in memory at a time).
+
+    Args:
+        shape (:obj:`tuple`): Shape (height, width) of the map.
+        wcs (:obj:`astWCS.WCS`): WCS corresponding to the map.
+        RADeg (:obj:`np.ndarray`): RA coordinates in decimal degrees of positions of interest.
+        decDeg (:obj:`np.ndarray`): Declination coordinates in decimal degrees of positions of interest.
+        maxDistDegrees (:obj:`float` or :obj:`np.ndarray`): The maximum radius out to which distance will
+            be calculated. This may be given as an array, in which case each position can have its own
+            radius.
+
+    Yields:
+        A 2d array of distance in degrees from each position, and a tuple of slices (y, x) that gives the
+        location of this array within the map, in the same order as the input coordinates.
+
+    """
+
+    RADeg=np.array(RADeg, dtype = np.float64).flatten()
+    decDeg=np.array(decDeg, dtype = np.float64).flatten()
+    if len(RADeg) == 0:
+        return None
+    maxDistDegrees=np.ones(len(RADeg))*maxDistDegrees
+
+    pixCoords=np.array(wcs.wcs2pix(RADeg, decDeg), dtype = np.float64).reshape(len(RADeg), 2)
+    x0, y0=pixCoords[:, 0], pixCoords[:, 1]
+    shiftedCoords=np.array(wcs.pix2wcs(x0+1, y0+1), dtype = np.float64).reshape(len(RADeg), 2)
+    ra1, dec1=shiftedCoords[:, 0], shiftedCoords[:, 1]
+    xPixScale=astCoords.calcAngSepDeg(RADeg, decDeg, ra1, decDeg)
+    yPixScale=astCoords.calcAngSepDeg(RADeg, decDeg, RADeg, dec1)
+
+    xDistPix=np.round(maxDistDegrees/xPixScale).astype(int)
+    yDistPix=np.round(maxDistDegrees/yPixScale).astype(int)
+    minX=np.clip(np.round(x0).astype(int)-xDistPix, 0, shape[1])
+    maxX=np.clip(np.round(x0).astype(int)+xDistPix, minX, shape[1])
+    minY=np.clip(np.round(y0).astype(int)-yDistPix, 0, shape[0])
+    maxY=np.clip(np.round(y0).astype(int)+yDistPix, minY, shape[0])
+
+    for i in range(len(RADeg)):
+        xDeg=(np.arange(minX[i], maxX[i])-x0[i])*xPixScale[i]
+        yDeg=(np.arange(minY[i], maxY[i])-y0[i])*yPixScale[i]
+        rDeg=np.sqrt(yDeg[:, np.newaxis]**2+xDeg[np.newaxis, :]**2)
+        yield rDeg, (slice(int(minY[i]), int(maxY[i])), slice(int(minX[i]), int(maxX[i])))
 
 #---------------------------------------------------------------------------------------------------
 def makeExtendedSourceMask(config, tileName):
@@ -11,17 +11,121 @@ import numpy as np
 import numpy.fft as fft
 from astLib import *
 import os
-import pylab
 import math
 from scipy import ndimage
 from scipy import interpolate
+from scipy.spatial import cKDTree
+from ._lazy import lazyImport
 from . import catalogs
 from . import maps
 from . import completeness
 from . import signals
+from . import profiling
 import sys
+pylab=lazyImport('pylab')
 
 #------------------------------------------------------------------------------------------------------------
+class MapInterpolator(object):
+    """Bicubic spline interpolation of a map, as given by fitting :obj:`scipy.interpolate.RectBivariateSpline`
+    to the whole map, but where splines are only fitted to the small regions of the map that are needed. The
+    map is divided into blocks, and the spline for each block is fitted (on first use) to the block plus a
+    margin of `marginPix` pixels on each side. Splines are kept, so that they are shared by all positions
+    that fall in the same block, and by later calls. Memory and CPU use therefore scale with the number
+    of objects, rather than the map area. If the blocks needed would cover more pixels than the map itself
+    (i.e., for densely populated maps), a single spline is fitted to the whole map instead.
+
+    Args:
+        mapData (:obj:`np.ndarray`): The 2d map to interpolate.
+        blockPix (:obj:`int`, optional): Size of the blocks (in pixels) that the map is divided into.
+        marginPix (:obj:`int`, optional): Number of pixels around each block that are included when fitting
+            the spline. At 10 pixels, values agree with those from a spline fitted to the whole map to
+            better than about 1 part in 10\ :sup:`7`.
+
+    Note:
+        Splines are kept for the lifetime of the interpolator, so a new interpolator should be made if the
+        map is modified in place.
+
+    """
+
+    def __init__(self, mapData, blockPix = 64, marginPix = 10):
+        self.mapData=mapData
+        self.blockPix=blockPix
+        self.marginPix=marginPix
+        self.numBlocksY=int(np.ceil(mapData.shape[0]/blockPix))
+        self.numBlocksX=int(np.ceil(mapData.shape[1]/blockPix))
+        self.splines={}
+        self.fullSpline=None
+
+
+    def getBlockSpline(self, blockY, blockX):
+        """Returns the spline fitted to the given block (fitting it, if this has not already been done).
+
+        Args:
+            blockY (:obj:`int`): Block index along the y-axis.
+            blockX (:obj:`int`): Block index along the x-axis.
+
+        Returns:
+            Spline (:obj:`scipy.interpolate.RectBivariateSpline`), in map pixel coordinates.
+
+        """
+
+        key=(blockY, blockX)
+        if key not in self.splines.keys():
+            yMin=max(0, blockY*self.blockPix-self.marginPix)
+            yMax=min(self.mapData.shape[0], (blockY+1)*self.blockPix+self.marginPix)
+            xMin=max(0, blockX*self.blockPix-self.marginPix)
+            xMax=min(self.mapData.shape[1], (blockX+1)*self.blockPix+self.marginPix)
+            self.splines[key]=interpolate.RectBivariateSpline(np.arange(yMin, yMax), np.arange(xMin, xMax),
+                                                              self.mapData[yMin:yMax, xMin:xMax], kx = 3, ky = 3)
+
+        return self.splines[key]
+
+
+    def __call__(self, y, x):
+        """Evaluates the interpolated map at the given pixel coordinates.
+
+        Args:
+            y (:obj:`float` or :obj:`np.ndarray`): Pixel coordinate(s) along the y-axis.
+            x (:obj:`float` or :obj:`np.ndarray`): Pixel coordinate(s) along the x-axis.
+
+        Returns:
+            Interpolated value(s) - an array if arrays of coordinates were given, otherwise a float.
+
+        """
+
+        scalar=np.ndim(y) == 0 and np.ndim(x) == 0
+        y=np.atleast_1d(np.array(y, dtype = np.float64))
+        x=np.atleast_1d(np.array(x, dtype = np.float64))
+        blockYs=np.clip(np.floor(y/self.blockPix).astype(int), 0, self.numBlocksY-1)
+        blockXs=np.clip(np.floor(x/self.blockPix).astype(int), 0, self.numBlocksX-1)
+        values=np.zeros(len(y))
+        blockIDs, inverse=np.unique(blockYs*self.numBlocksX+blockXs, return_inverse = True)
+        if self.fullSpline is None:
+            numNewBlocks=0
+            for blockID in blockIDs:
+                if (blockID // self.numBlocksX, blockID % self.numBlocksX) not in self.splines.keys():
+                    numNewBlocks=numNewBlocks+1
+            paddedBlockPix=(self.blockPix+2*self.marginPix)**2
+            if (len(self.splines)+numNewBlocks)*paddedBlockPix > self.mapData.shape[0]*self.mapData.shape[1]:
+                self.fullSpline=interpolate.RectBivariateSpline(np.arange(self.mapData.shape[0]),
+                                                                np.arange(self.mapData.shape[1]),
+                                                                self.mapData, kx = 3, ky = 3)
+                self.splines={}
+        if self.fullSpline is not None:
+            blockIDs=[]
+            values=self.fullSpline.ev(y, x)
+        for i in range(len(blockIDs)):
+            indices=np.where(inverse == i)[0]
+            spline=self.getBlockSpline(blockYs[indices[0]], blockXs[indices[0]])
+            values[indices]=spline.ev(y[indices], x[indices])
+        if scalar == True:
+            return values[0]
+
+        return values
+
+
+#------------------------------------------------------------------------------------------------------------
+@profiling.stage('findObjects')
 def findObjects(filteredMapDict, threshold = 3.0, minObjPix = 3, rejectBorder = 10, 
                 findCenterOfMass = True, flagRings = True, ringThresholdSigma = 0,
                 ringFlagDistArcmin = 12.0, ringFlagMinRingerSNR = 20,
@@ -59,25 +163,26 @@ def findObjects(filteredMapDict, threshold = 3.0, minObjPix = 3, rejectBorder =
     objIDs, objPositions, objNumPix, segMap=getObjectPositions(data, threshold,
                                                                findCenterOfMass = findCenterOfMass)
     if flagRings == True:
+        # Rings are large objects (at a low threshold) whose centre of mass lies outside of the object
         minRingPix=30
         ringIDs, ringPositions, ringNumPix, ringSegMap=getObjectPositions(data, ringThresholdSigma, 
-                                                                          findCenterOfMass = True)    
-        for i in range(len(ringIDs)):
-            if type(ringNumPix) != float and ringNumPix[i] > minRingPix:
-                y, x=ringPositions[i]
-                if ringSegMap[int(y), int(x)] != ringIDs[i]:
-                    ringSegMap[np.equal(ringSegMap, ringIDs[i])]=-1*ringSegMap[np.equal(ringSegMap, ringIDs[i])]
-        ringSegMap=np.array(np.less(ringSegMap, 0), dtype = int)
-        ringMask=ringSegMap
+                                                                          findCenterOfMass = True)
+        ringPositions=np.array(ringPositions, dtype = float).reshape(len(ringIDs), 2)
+        ringNumPix=np.atleast_1d(ringNumPix)
+        isRing=np.zeros(len(ringIDs), dtype = bool)
+        large=np.where(ringNumPix > minRingPix)[0]
+        centreIDs=ringSegMap[ringPositions[large, 0].astype(int), ringPositions[large, 1].astype(int)]
+        isRing[large]=np.not_equal(centreIDs, ringIDs[large])
+        ringLookup=np.zeros(ringSegMap.max()+1, dtype = bool)
+        ringLookup[ringIDs]=isRing
+        ringMask=np.array(ringLookup[ringSegMap], dtype = int)
         #filteredMapDict['flagMask']=filteredMapDict['flagMask']-ringMask
     else:
         ringMask=None
 
     # In the past this had problems - Simone using happily in his fork though, so now optional
     if useInterpolator == True:
-        mapInterpolator=interpolate.RectBivariateSpline(np.arange(data.shape[0]), 
-                                                        np.arange(data.shape[1]), 
-                                                        data, kx = 3, ky = 3)
+        mapInterpolator=MapInterpolator(data)
                                                     
     # Border around edge where we might throw stuff out just to cut down contamination
     if type(areaMask) == np.ndarray and areaMask.sum() > 0:
@@ -94,117 +199,168 @@ def findObjects(filteredMapDict, threshold = 3.0, minObjPix = 3, rejectBorder =
     maxX=maxX-rejectBorder
     minY=minY+rejectBorder
     maxY=maxY-rejectBorder
-        
-    # Build catalog - initially as a list of dictionaries, then converted to astropy Table
-    catalog=[]
-    idNumCount=1
-    for i in range(len(objIDs)):
-        if type(objNumPix) != float and objNumPix[i] >= minObjPix:
-            objDict={}
-            objDict['id']=idNumCount
-            objDict['x']=objPositions[i][1]
-            objDict['y']=objPositions[i][0]
-            objDict['ringFlag']=False
-            if ringMask is not None:
-                if ringMask[int(objDict['y']), int(objDict['x'])] > 0:
-                    objDict['ringFlag']=True
-            objDict['RADeg'], objDict['decDeg']=wcs.pix2wcs(objDict['x'], objDict['y'])
-            if objDict['RADeg'] < 0:
-                objDict['RADeg']=360.0+objDict['RADeg']
-            galLong, galLat=astCoords.convertCoords("J2000", "GALACTIC", objDict['RADeg'], objDict['decDeg'], 2000)
-            objDict['galacticLatDeg']=galLat
-            if longNames == False:
-                objDict['name']=catalogs.makeName(objDict['RADeg'], objDict['decDeg'], prefix = objIdent)
-            else:
-                objDict['name']=catalogs.makeLongName(objDict['RADeg'], objDict['decDeg'], prefix = objIdent)                    
-            objDict['numSigPix']=objNumPix[i]
-            objDict['template']=filteredMapDict['label']
-            objDict['tileName']=filteredMapDict['tileName']
-            if useInterpolator == True:
-                objDict['SNR']=mapInterpolator(objDict['y'], objDict['x'])[0][0]
-            else:
-                objDict['SNR']=data[int(round(objDict['y'])), int(round(objDict['x']))]
-            objDict['flags']=flagMask[int(round(objDict['y'])), int(round(objDict['x']))]
-            # Optional SExtractor style shape measurements                
-            if measureShapes == True:
-                doubleCheck=False
-                if objDict['numSigPix'] > 9:
-                    mask=np.equal(segMap, objIDs[i])
-                    ys, xs=np.where(segMap == objIDs[i])
-                    yMin=ys.min()
-                    xMin=xs.min()
-                    yMax=ys.max()
-                    xMax=xs.max()
-                    # Centres (1st order moments) - cx2, cy2 here to avoid overwriting whatever catalog cx, cy is (see above)
-                    xs=xs-xMin
-                    ys=ys-yMin
-                    cx2=(xs*data[mask]).sum()/data[mask].sum()
-                    cy2=(ys*data[mask]).sum()/data[mask].sum()
-                    # Spread (2nd order moments)
-                    x2=(((xs**2)*data[mask]).sum()/data[mask].sum())-cx2**2
-                    y2=(((ys**2)*data[mask]).sum()/data[mask].sum())-cy2**2
-                    xy=(((xs*ys)*data[mask]).sum()/data[mask].sum())-cx2*cy2
-                    # A, B, theta from above - correct theta has same sign as xy (see SExtractor manual) 
-                    theta=np.degrees(np.arctan(2*(xy/(x2-y2)))/2.0)
-                    if xy > 0 and theta < 0:
-                        theta=theta+90
-                    elif xy < 0 and theta > 0:
-                        theta=theta-90
-                    if theta > 0 and xy > 0:
-                        doubleCheck=True
-                    if theta < 0 and xy < 0:
-                        doubleCheck=True
-                    if doubleCheck == True:
-                        A=np.sqrt((x2+y2)/2.0 + np.sqrt( ((x2-y2)/2)**2 + xy**2))
-                        B=np.sqrt((x2+y2)/2.0 - np.sqrt( ((x2-y2)/2)**2 + xy**2))
-                        # Moments work terribly for low surface brightness, diffuse things which aren't strongly peaked
-                        # Shape measurement is okay though - so just scale A, B to match segMap area
-                        segArea=float(np.count_nonzero(np.equal(segMap, objIDs[i])))
-                        curArea=A*B*np.pi
-                        scaleFactor=np.sqrt(segArea/curArea)
-                        A=A*scaleFactor
-                        B=B*scaleFactor  
-                        ecc=np.sqrt(1-B**2/A**2)
-                        objDict['ellipse_PA']=theta
-                        objDict['ellipse_A']=A
-                        objDict['ellipse_B']=B
-                        objDict['ellipse_x0']=cx2+xMin
-                        objDict['ellipse_y0']=cy2+yMin
-                        objDict['ellipse_e']=ecc
-                if objDict['numSigPix'] <= 9 or doubleCheck == False:
-                    objDict['ellipse_PA']=-99
-                    objDict['ellipse_A']=-99
-                    objDict['ellipse_B']=-99
-                    objDict['ellipse_x0']=-99
-                    objDict['ellipse_y0']=-99
-                    objDict['ellipse_e']=-99
-            # Add to catalog (masks now applied before we get here so no need to check)
-            if objDict['SNR'] > threshold:
-                catalog.append(objDict)
-            idNumCount=idNumCount+1     
-    
+
+    # Build catalog - all objects are measured at once, as arrays
+    # Masks are applied before we get here, so we only need to cut on size and S/N
+    objPositions=np.array(objPositions, dtype = float).reshape(len(objIDs), 2)
+    objNumPix=np.atleast_1d(objNumPix)
+    keep=np.where(objNumPix >= minObjPix)[0]
+    ys=objPositions[keep, 0]
+    xs=objPositions[keep, 1]
+    if useInterpolator == True:
+        SNRs=mapInterpolator(ys, xs)
+    else:
+        SNRs=data[np.round(ys).astype(int), np.round(xs).astype(int)]
+    aboveThreshold=SNRs > threshold
+    if aboveThreshold.sum() == 0:
+        return []
+    keep=keep[aboveThreshold]
+    SNRs=SNRs[aboveThreshold]
+    ys=ys[aboveThreshold]
+    xs=xs[aboveThreshold]
+    objIDs=objIDs[keep]
+    objNumPix=objNumPix[keep]
+    RADeg, decDeg=np.array(wcs.pix2wcs(xs, ys)).reshape(len(keep), 2).transpose()
+    RADeg[RADeg < 0]=RADeg[RADeg < 0]+360.0
+    galLong, galLat=astCoords.convertCoords("J2000", "GALACTIC", RADeg, decDeg, 2000)
+    if longNames == False:
+        names=[catalogs.makeName(RA, dec, prefix = objIdent) for RA, dec in zip(RADeg, decDeg)]
+    else:
+        names=[catalogs.makeLongName(RA, dec, prefix = objIdent) for RA, dec in zip(RADeg, decDeg)]
+    if ringMask is not None:
+        ringFlag=ringMask[ys.astype(int), xs.astype(int)] > 0
+    else:
+        ringFlag=np.zeros(len(keep), dtype = bool)
+    columnsDict={'name': names, 'RADeg': RADeg, 'decDeg': decDeg, 'SNR': SNRs, 'numSigPix': objNumPix,
+                 'template': [filteredMapDict['label']]*len(keep),
+                 'tileName': [filteredMapDict['tileName']]*len(keep),
+                 'flags': flagMask[np.round(ys).astype(int), np.round(xs).astype(int)],
+                 'ringFlag': ringFlag, 'galacticLatDeg': galLat}
+    # Optional SExtractor style shape measurements
+    if measureShapes == True:
+        columnsDict.update(measureObjectShapes(data, segMap, objIDs, objNumPix))
+
     # From here on, catalogs should be astropy Table objects...
-    if len(catalog) > 0:
-        catalog=catalogs.catalogListToTab(catalog)
-        if DS9RegionsPath is not None:
-            catalogs.catalog2DS9(catalog, DS9RegionsPath)
-
-        # Ring flagging should only be applied around high S/N objects
-        flagged=catalog[catalog['ringFlag'] == True]
-        highSNR=catalog[catalog['SNR'] > ringFlagMinRingerSNR]
-        for row in catalog:
-            if row['ringFlag'] == True:
-                rDeg=astCoords.calcAngSepDeg(row['RADeg'], row['decDeg'], highSNR['RADeg'], highSNR['decDeg'])
-                # Second condition here because we don't want to flag if we have picked the central object
-                if np.logical_and((rDeg*60) < ringFlagDistArcmin, rDeg > 0).sum() == 0:
-                    row['ringFlag']=False
-
-        # Add to ringFlag to flags column (but doesn't affect flagMask area calc)
-        # This allows us to continue cleaning catalogs based on flags column value alone
-        catalog['flags']=catalog['flags']+catalog['ringFlag']
+    catalog=atpy.Table()
+    for key in catalogs.COLUMN_NAMES:
+        if key in columnsDict.keys():
+            catalog.add_column(atpy.Column(columnsDict[key], key))
+    if DS9RegionsPath is not None:
+        catalogs.catalog2DS9(catalog, DS9RegionsPath)
+
+    # Ring flagging should only be applied around high S/N objects
+    # Second condition here because we don't want to flag if we have picked the central object
+    flagged=np.where(catalog['ringFlag'] == True)[0]
+    highSNR=catalog[catalog['SNR'] > ringFlagMinRingerSNR]
+    if len(flagged) > 0 and len(highSNR) > 0:
+        # Search a little beyond ringFlagDistArcmin, then check candidates using the exact separation
+        tree=cKDTree(_unitVectors(highSNR['RADeg'], highSNR['decDeg']))
+        chordDist=2*np.sin(np.radians(ringFlagDistArcmin/60.0)/2)*1.0001
+        neighboursList=tree.query_ball_point(_unitVectors(catalog['RADeg'][flagged],
+                                                          catalog['decDeg'][flagged]), chordDist)
+        for i, neighbours in zip(flagged, neighboursList):
+            if len(neighbours) > 0:
+                rDeg=astCoords.calcAngSepDeg(catalog['RADeg'][i], catalog['decDeg'][i],
+                                             highSNR['RADeg'][neighbours], highSNR['decDeg'][neighbours])
+                if np.logical_and((rDeg*60) < ringFlagDistArcmin, rDeg > 0).sum() > 0:
+                    continue
+            catalog['ringFlag'][i]=False
+    elif len(flagged) > 0:
+        catalog['ringFlag'][flagged]=False
+
+    # Add to ringFlag to flags column (but doesn't affect flagMask area calc)
+    # This allows us to continue cleaning catalogs based on flags column value alone
+    catalog['flags']=catalog['flags']+catalog['ringFlag']
 
     return catalog
 
+#------------------------------------------------------------------------------------------------------------
+def measureObjectShapes(mapData, segmentationMap, objIDs, objNumPix):
+    """Fits ellipses to objects in a segmentation map using moments, in a similar style to how SExtractor
+    does it. All objects are measured at once (using reductions over the labelled pixels of the
+    segmentation map).
+
+    Args:
+        mapData (:obj:`numpy.ndarray`): The 2d map (e.g., S/N map) used for weighting.
+        segmentationMap (:obj:`numpy.ndarray`): The segmentation map (2d array), as returned by
+            :func:`getObjectPositions`.
+        objIDs (:obj:`numpy.ndarray`): ID numbers (labels in the segmentation map) of the objects to measure.
+        objNumPix (:obj:`numpy.ndarray`): Number of pixels in each object.
+
+    Returns:
+        Dictionary of arrays with keys `ellipse_PA`, `ellipse_A`, `ellipse_B`, `ellipse_x0`, `ellipse_y0`,
+        and `ellipse_e`. These are set to -99 for objects with 9 pixels or fewer, or where the moments do
+        not give a sensible ellipse.
+
+    """
+
+    # Pixel coordinates are measured relative to the corner of each object's bounding box
+    pixYs, pixXs=np.nonzero(segmentationMap)
+    labels=segmentationMap[pixYs, pixXs]
+    weights=mapData[pixYs, pixXs].astype(np.float64)
+    xMin=np.zeros(segmentationMap.max()+1, dtype = int)
+    yMin=np.zeros(segmentationMap.max()+1, dtype = int)
+    xMin[objIDs]=ndimage.minimum(pixXs, labels = labels, index = objIDs)
+    yMin[objIDs]=ndimage.minimum(pixYs, labels = labels, index = objIDs)
+    xs=pixXs-xMin[labels]
+    ys=pixYs-yMin[labels]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        # Centres (1st order moments)
+        sumW=ndimage.sum(weights, labels = labels, index = objIDs)
+        cx2=ndimage.sum(xs*weights, labels = labels, index = objIDs)/sumW
+        cy2=ndimage.sum(ys*weights, labels = labels, index = objIDs)/sumW
+        # Spread (2nd order moments)
+        x2=ndimage.sum((xs**2)*weights, labels = labels, index = objIDs)/sumW-cx2**2
+        y2=ndimage.sum((ys**2)*weights, labels = labels, index = objIDs)/sumW-cy2**2
+        xy=ndimage.sum((xs*ys)*weights, labels = labels, index = objIDs)/sumW-cx2*cy2
+        # A, B, theta from above - correct theta has same sign as xy (see SExtractor manual)
+        theta=np.degrees(np.arctan(2*(xy/(x2-y2)))/2.0)
+        theta=np.where(np.logical_and(xy > 0, theta < 0), theta+90, theta)
+        theta=np.where(np.logical_and(xy < 0, theta > 0), theta-90, theta)
+        doubleCheck=np.logical_or(np.logical_and(theta > 0, xy > 0), np.logical_and(theta < 0, xy < 0))
+        A=np.sqrt((x2+y2)/2.0 + np.sqrt( ((x2-y2)/2)**2 + xy**2))
+        B=np.sqrt((x2+y2)/2.0 - np.sqrt( ((x2-y2)/2)**2 + xy**2))
+        # Moments work terribly for low surface brightness, diffuse things which aren't strongly peaked
+        # Shape measurement is okay though - so just scale A, B to match segMap area
+        scaleFactor=np.sqrt(objNumPix/(A*B*np.pi))
+        A=A*scaleFactor
+        B=B*scaleFactor
+        ecc=np.sqrt(1-B**2/A**2)
+
+    valid=np.logical_and(objNumPix > 9, doubleCheck)
+    shapesDict={'ellipse_PA': theta, 'ellipse_A': A, 'ellipse_B': B, 'ellipse_x0': cx2+xMin[objIDs],
+                'ellipse_y0': cy2+yMin[objIDs], 'ellipse_e': ecc}
+    for key in shapesDict.keys():
+        if valid.sum() > 0:
+            shapesDict[key]=np.where(valid, shapesDict[key], -99)
+        else:
+            shapesDict[key]=np.full(len(objIDs), -99)
+
+    return shapesDict
+
+#------------------------------------------------------------------------------------------------------------
+def _getPixelCoords(catalog, wcs):
+    """Returns the pixel coordinates (x, y) of all objects in the catalog, as arrays.
+
+    """
+
+    coords=np.array(wcs.wcs2pix(np.array(catalog['RADeg']), np.array(catalog['decDeg'])), dtype = np.float64)
+
+    return coords.reshape(len(catalog), 2).transpose()
+
+#------------------------------------------------------------------------------------------------------------
+def _unitVectors(RADeg, decDeg):
+    """Converts RA, dec coordinates (in decimal degrees) into Cartesian unit vectors, for use with
+    :obj:`scipy.spatial.cKDTree`.
+
+    """
+
+    RARad=np.radians(np.array(RADeg, dtype = np.float64))
+    decRad=np.radians(np.array(decDeg, dtype = np.float64))
+
+    return np.array([np.cos(decRad)*np.cos(RARad), np.cos(decRad)*np.sin(RARad), np.sin(decRad)]).transpose()
+
 #------------------------------------------------------------------------------------------------------------
 def getObjectPositions(mapData, threshold, findCenterOfMass = True):
     """Creates a segmentation map and find objects above the given threshold.
@@ -254,21 +410,22 @@ def getSNRValues(catalog, SNMap, wcs, useInterpolator = True, invertMap = False,
     if invertMap == True:
         SNMap=SNMap*-1
         
+    if len(catalog) == 0:
+        return None
+
     # In the past this had problems - Simone using happily in his fork though, so now optional
     if useInterpolator == True:
-        mapInterpolator=interpolate.RectBivariateSpline(np.arange(SNMap.shape[0]), 
-                                                        np.arange(SNMap.shape[1]), 
-                                                        SNMap, kx = 3, ky = 3)
-    
-    if len(catalog) > 0:
-        catalog.add_column(atpy.Column(np.zeros(len(catalog)), prefix+'SNR'))
-    for obj in catalog:
-        x, y=wcs.wcs2pix(obj['RADeg'], obj['decDeg'])
-        if int(x) > 0 and int(x) < SNMap.shape[1] and int(y) > 0 and int(y) < SNMap.shape[0]:
-            if useInterpolator == True:
-                obj[prefix+'SNR']=mapInterpolator(y, x)[0][0]
-            else:
-                obj[prefix+'SNR']=SNMap[int(round(y)), int(round(x))] # read directly off of S/N map
+        mapInterpolator=MapInterpolator(SNMap)
+
+    SNRs=np.zeros(len(catalog))
+    x, y=_getPixelCoords(catalog, wcs)
+    inMap=np.logical_and(np.logical_and(np.trunc(x) > 0, np.trunc(x) < SNMap.shape[1]),
+                         np.logical_and(np.trunc(y) > 0, np.trunc(y) < SNMap.shape[0]))
+    if useInterpolator == True:
+        SNRs[inMap]=mapInterpolator(y[inMap], x[inMap])
+    else:
+        SNRs[inMap]=SNMap[np.round(y[inMap]).astype(int), np.round(x[inMap]).astype(int)] # read directly off of S/N map
+    catalog.add_column(atpy.Column(SNRs, prefix+'SNR'))
            
 #------------------------------------------------------------------------------------------------------------
 def measureFluxes(catalog, filteredMapDict, diagnosticsDir, photFilteredMapDict = None,
@@ -308,9 +465,7 @@ def measureFluxes(catalog, filteredMapDict, diagnosticsDir, photFilteredMapDict
     
     # In the past this had problems - Simone using happily in his fork though, so now optional
     if useInterpolator == True:
-        mapInterpolator=interpolate.RectBivariateSpline(np.arange(mapData.shape[0]), 
-                                                        np.arange(mapData.shape[1]), 
-                                                        mapData, kx = 3, ky = 3)
+        mapInterpolator=MapInterpolator(mapData)
     else:
         mapInterpolator=None
     
@@ -323,9 +478,7 @@ def measureFluxes(catalog, filteredMapDict, diagnosticsDir, photFilteredMapDict
         mapDataList.append(photMapData)
         prefixList.append('fixed_')
         if useInterpolator == True:
-            photMapInterpolator=interpolate.RectBivariateSpline(np.arange(photMapData.shape[0]), 
-                                                                np.arange(photMapData.shape[1]), 
-                                                                photMapData, kx = 3, ky = 3)
+            photMapInterpolator=MapInterpolator(photMapData)
         else:
             photMapInterpolator=None
         interpolatorList.append(photMapInterpolator)
@@ -340,31 +493,34 @@ def measureFluxes(catalog, filteredMapDict, diagnosticsDir, photFilteredMapDict
             if len(catalog) > 0:
                 catalog.add_column(atpy.Column(np.zeros(len(catalog)), prefix+k))
 
-    for obj in catalog:
-        x, y=wcs.wcs2pix(obj['RADeg'], obj['decDeg'])
-        for data, prefix, interpolator in zip(mapDataList, prefixList, interpolatorList):
-            # NOTE: We might want to avoid 2d interpolation here because that was found not to be robust elsewhere
-            # 2018: Simone seems to now be using this happily, so now optional
-            if useInterpolator == True:
-                mapValue=interpolator(y, x)[0][0]
-            else:
-                mapValue=data[int(round(y)), int(round(x))]
-            # NOTE: remember, all normalisation should be done when constructing the filtered maps, i.e., not here!
-            if mapUnits == 'yc':
-                yc=mapValue
-                obj[prefix+'y_c']=yc/1e-4                            # So that same units as H13 in output catalogs
-                obj[prefix+'err_y_c']=obj[prefix+'y_c']/obj[prefix+'SNR']
-                deltaTc=maps.convertToDeltaT(yc, obsFrequencyGHz = ycObsFreqGHz)
-                obj[prefix+'deltaT_c']=deltaTc
-                obj[prefix+'err_deltaT_c']=abs(deltaTc/obj[prefix+'SNR'])
-            elif mapUnits == 'uK':
-                # For this, we want deltaTc to be source amplitude
-                deltaTc=mapValue
-                obj[prefix+'deltaT_c']=deltaTc
-                obj[prefix+'err_deltaT_c']=deltaTc/obj[prefix+'SNR']                        
-                if reportJyFluxes == True:
-                    obj[prefix+"fluxJy"]=deltaTToJyPerSr(obj[prefix+'deltaT_c'], obsFreqGHz)*beamSolidAngle_nsr*1.e-9
-                    obj[prefix+"err_fluxJy"]=deltaTToJyPerSr(obj[prefix+'err_deltaT_c'], obsFreqGHz)*beamSolidAngle_nsr*1.e-9
+    if len(catalog) == 0:
+        return None
+
+    # All objects are measured at once, and written into the catalog columns in bulk
+    x, y=_getPixelCoords(catalog, wcs)
+    for data, prefix, interpolator in zip(mapDataList, prefixList, interpolatorList):
+        # NOTE: We might want to avoid 2d interpolation here because that was found not to be robust elsewhere
+        # 2018: Simone seems to now be using this happily, so now optional
+        if useInterpolator == True:
+            mapValues=interpolator(y, x)
+        else:
+            mapValues=data[np.round(y).astype(int), np.round(x).astype(int)]
+        # NOTE: remember, all normalisation should be done when constructing the filtered maps, i.e., not here!
+        if mapUnits == 'yc':
+            yc=mapValues
+            catalog[prefix+'y_c'][:]=yc/1e-4                            # So that same units as H13 in output catalogs
+            catalog[prefix+'err_y_c'][:]=catalog[prefix+'y_c']/catalog[prefix+'SNR']
+            deltaTc=maps.convertToDeltaT(yc, obsFrequencyGHz = ycObsFreqGHz)
+            catalog[prefix+'deltaT_c'][:]=deltaTc
+            catalog[prefix+'err_deltaT_c'][:]=abs(deltaTc/catalog[prefix+'SNR'])
+        elif mapUnits == 'uK':
+            # For this, we want deltaTc to be source amplitude
+            deltaTc=mapValues
+            catalog[prefix+'deltaT_c'][:]=deltaTc
+            catalog[prefix+'err_deltaT_c'][:]=deltaTc/catalog[prefix+'SNR']
+            if reportJyFluxes == True:
+                catalog[prefix+"fluxJy"][:]=deltaTToJyPerSr(catalog[prefix+'deltaT_c'], obsFreqGHz)*beamSolidAngle_nsr*1.e-9
+                catalog[prefix+"err_fluxJy"][:]=deltaTToJyPerSr(catalog[prefix+'err_deltaT_c'], obsFreqGHz)*beamSolidAngle_nsr*1.e-9
 
 #------------------------------------------------------------------------------------------------------------
 def makeForcedPhotometryCatalog(filteredMapDict, inputCatalog, useInterpolator = True,\
@@ -394,40 +550,38 @@ def makeForcedPhotometryCatalog(filteredMapDict, inputCatalog, useInterpolator =
     tileName=filteredMapDict['tileName']
     data=filteredMapDict['SNMap']
     if useInterpolator == True:
-        mapInterpolator=interpolate.RectBivariateSpline(np.arange(data.shape[0]), 
-                                                        np.arange(data.shape[1]), 
-                                                        data, kx = 3, ky = 3)
+        mapInterpolator=MapInterpolator(data)
 
     forcedTab=catalogs.getCatalogWithinImage(forcedTab, data.shape, wcs)
-    catalog=[]
-    idNumCount=1
-    for row in forcedTab:
-        objDict={}
-        objDict['id']=idNumCount
-        x, y=wcs.wcs2pix(row['RADeg'], row['decDeg'])
-        x, y=int(round(x)), int(round(y))
-        if data[y, x] != 0:
-            objDict['x']=x
-            objDict['y']=y
-            objDict['RADeg'], objDict['decDeg']=row['RADeg'], row['decDeg']
-            galLong, galLat=astCoords.convertCoords("J2000", "GALACTIC", objDict['RADeg'], objDict['decDeg'], 2000)
-            objDict['galacticLatDeg']=galLat
-            objDict['name']=row['name']
-            objDict['numSigPix']=1
-            objDict['template']=filteredMapDict['label']
-            objDict['tileName']=filteredMapDict['tileName']
-            if useInterpolator == True:
-                objDict['SNR']=mapInterpolator(objDict['y'], objDict['x'])[0][0]
-            else:
-                objDict['SNR']=data[int(round(objDict['y'])), int(round(objDict['x']))]
-            catalog.append(objDict)
-            idNumCount=idNumCount+1
+    if len(forcedTab) == 0:
+        return []
+    x, y=_getPixelCoords(forcedTab, wcs)
+    x, y=np.round(x).astype(int), np.round(y).astype(int)
+    inData=np.not_equal(data[y, x], 0)
+    if inData.sum() == 0:
+        return []
+    forcedTab=forcedTab[inData]
+    x, y=x[inData], y[inData]
+    galLong, galLat=astCoords.convertCoords("J2000", "GALACTIC", np.array(forcedTab['RADeg']),
+                                            np.array(forcedTab['decDeg']), 2000)
+    if useInterpolator == True:
+        SNRs=mapInterpolator(y, x)
+    else:
+        SNRs=data[y, x]
+    columnsDict={'name': np.array(forcedTab['name']), 'RADeg': np.array(forcedTab['RADeg']),
+                 'decDeg': np.array(forcedTab['decDeg']), 'SNR': SNRs,
+                 'numSigPix': np.ones(len(forcedTab), dtype = int),
+                 'template': [filteredMapDict['label']]*len(forcedTab),
+                 'tileName': [filteredMapDict['tileName']]*len(forcedTab),
+                 'galacticLatDeg': galLat}
 
     # From here on, catalogs should be astropy Table objects...
-    if len(catalog) > 0:
-        catalog=catalogs.catalogListToTab(catalog)
-        if DS9RegionsPath is not None:
-            catalogs.catalog2DS9(catalog, DS9RegionsPath)
+    catalog=atpy.Table()
+    for key in catalogs.COLUMN_NAMES:
+        if key in columnsDict.keys():
+            catalog.add_column(atpy.Column(columnsDict[key], key))
+    if DS9RegionsPath is not None:
+        catalogs.catalog2DS9(catalog, DS9RegionsPath)
             
     return catalog
 
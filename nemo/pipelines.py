@@ -10,6 +10,7 @@ import sys
 import glob
 import shutil
 import time
+import multiprocessing
 import astropy
 import astropy.io.fits as pyfits
 import astropy.table as atpy
@@ -18,8 +19,8 @@ import numpy as np
 from scipy import ndimage, interpolate
 import copy
 from pixell import enmap
-import pyccl as ccl
 import nemo
+from ._lazy import lazyImport
 from . import startUp
 from . import filters
 from . import photometry
@@ -28,6 +29,8 @@ from . import maps
 from . import signals
 from . import completeness
 from . import MockSurvey
+from . import profiling
+ccl=lazyImport('pyccl')
 
 #------------------------------------------------------------------------------------------------------------
 def filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = False, useCachedRMSMap = False,\
@@ -109,83 +112,41 @@ def filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = Fals
     return catalog
 
 #------------------------------------------------------------------------------------------------------------
-def _filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = False, useCachedRMSMap = False,\
-                               useCachedFilteredMaps = False, measureFluxes = True, invertMap = False, \
-                               verbose = True, writeAreaMask = False, writeFlagMask = False):
-    """Runs the map filtering and catalog construction steps according to the given configuration.
-    
-    Args:
-        config (:obj: 'startup.NemoConfig'): Nemo configuration object.
-        rootOutDir (str): If None, use the default given by config. Otherwise, use this to override where the
-            output filtered maps and catalogs are written.
-        useCachedFilters (:obj:`bool`, optional): If True, and previously made filters are found, they will be
-            read from disk, rather than re-calculated (used by source injection simulations).
-        useCachedFilteredMaps (:obj:`bool`, optional): If True, and previously written maps are found, these
-            will be read from disk, rather than re-made. This is useful for performing forced photometry using
-            external catalogs without having to run nemo again. Otherwise, this should be set to False.
-        measureFluxes (bool, optional): If True, measure fluxes. If False, just extract S/N values for 
-            detected objects.
-        invertMap (bool, optional): If True, multiply all maps by -1; needed by 
-            :meth:maps.estimateContaminationFromInvertedMaps).
-    
-    Returns:
-        Optimal catalog (keeps the highest S/N detection when filtering at multiple scales).
-    
-    Note:
-        See bin/nemo for how this pipeline is applied to real data, and maps.sourceInjectionTest
-        for how this is applied to source-free sims that are generated on the fly.
-        
-    """
+@profiling.stage('filterTile', contextArgs = {'tileName': 'tileName'})
+def _filterTile(config, tileName, filtersList, filteredMapsDir, photFilter = None, filterCacheDir = None,
+                undoPixelWindow = True, useCachedFilters = False, useCachedRMSMap = False,
+                useCachedFilteredMaps = False, measureFluxes = True, invertMap = False, verbose = True,
+                writeAreaMask = False, writeFlagMask = False):
+    """Runs the map filtering and object detection steps of :meth:`_filterMapsAndMakeCatalogs` for a
+    single tile, with all of the given filters (the reference filter, if given, must be first in
+    `filtersList`).
 
-    # If running on sims (source-free or with injected sources), this ensures we use the same kernels for 
-    # filtering the sim maps as was used on the real data, by copying kernels to the sims dir. The kernels 
-    # will then be loaded automatically when filterMaps is called. Yes, this is a bit clunky...
-    if rootOutDir is not None:
-        filteredMapsDir=rootOutDir+os.path.sep+"filteredMaps"
-        diagnosticsDir=rootOutDir+os.path.sep+"diagnostics"
-        dirList=[rootOutDir, filteredMapsDir, diagnosticsDir]
-        for d in dirList:
-            os.makedirs(d, exist_ok = True)
-    else:
-        rootOutDir=config.rootOutDir
-        filteredMapsDir=config.filteredMapsDir
-        diagnosticsDir=config.diagnosticsDir
-    
-    # We re-sort the filters list here - in case we have photFilter defined
-    photFilter=config.parDict['photFilter']
-    filtersList=[]
-    if photFilter is not None:
-        for f in config.parDict['mapFilters']:
-            if f['label'] == photFilter:
-                filtersList.append(f)
-    for f in config.parDict['mapFilters']:
-        if photFilter is not None:
-            if f['label'] == photFilter:
-                continue
-        filtersList.append(f)
-    if photFilter is not None and len(config.parDict['mapFilters']) > 1:
-        assert(filtersList[0]['label'] == photFilter)
-    photFilteredMapDict=None
+    Returns:
+        A dictionary containing the catalogs for each filter (`catalogDict`, in the format expected by
+        :meth:`catalogs.makeOptimalCatalog`), the area mask, flag mask, filtered, S/N and RMS maps to be
+        stitched (these are None if not wanted), the reference filter object (`cachedFilter`; None if not
+        made), and the time taken for each filter (`timings`).
 
-    # For source injection stuff (yes, this is messy - see below for why we do this)
-    undoPixelWindow=True
-    if useCachedRMSMap == True:
-        undoPixelWindow=False
+    """
 
-    # Make filtered maps for each filter and tile
+    if verbose == True: print(">>> [rank = %d] Making filtered maps - tileName = %s " % (config.rank, tileName))
     catalogDict={}
-    areaMaskDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
-    flagMaskDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
-    stitchedFilteredMapDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
-    stitchedSNMapDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
-    stitchedRMSMapDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
-    for tileName in config.tileNames:
-        if verbose == True: print(">>> [rank = %d] Making filtered maps - tileName = %s " % (config.rank, tileName))
-        # Operations that only need to be done once go here
-        if 'findAndMaskExtended' in config.parDict.keys():
-            maps.makeExtendedSourceMask(config, tileName)
-        for f in filtersList:
-
+    areaMask=None
+    flagMask=None
+    stitchedFilteredMap=None
+    stitchedSNMap=None
+    stitchedRMSMap=None
+    cachedFilter=None
+    photFilteredMapDict=None
+    timings={}
+    t0=time.time()
+    # Operations that only need to be done once go here
+    if 'findAndMaskExtended' in config.parDict.keys():
+        maps.makeExtendedSourceMask(config, tileName)
+    # Preprocessed maps (and their FFTs) are shared by all filters in this tile
+    workspace=filters.MapWorkspace(tileName, diagnosticsDir = config.diagnosticsDir)
+    for f in filtersList:
+        with profiling.stage('filter', filterLabel = f['label']):
             label=f['label']+"#"+tileName            
             catalogDict[label]={}
             if 'saveDS9Regions' in f['params'] and f['params']['saveDS9Regions'] == True:
@@ -219,11 +180,14 @@ def _filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = Fal
                 filterResults=filters.filterMaps(config.unfilteredMapsDictList, f, tileName,
                                                  diagnosticsDir = config.diagnosticsDir, selFnDir = config.selFnDir,
                                                  verbose = True, undoPixelWindow = undoPixelWindow,
-                                                 useCachedFilter = useCachedFilters, returnFilter = returnFilter)
+                                                 useCachedFilter = useCachedFilters, returnFilter = returnFilter,
+                                                 filterCacheDir = filterCacheDir, workspace = workspace)
                 if returnFilter == False:
                     filteredMapDict=filterResults
                 else:
-                    filteredMapDict, config.cachedFilters[tileName]=filterResults[0], filterResults[1]
+                    filteredMapDict, cachedFilter=filterResults[0], filterResults[1]
+                    # Don't keep the whole tile workspace alive just for the cached filter
+                    cachedFilter.workspace=None
 
             if useCachedRMSMap == True and photFilter is not None: # i.e., only an option for cluster insertion sims
                 # This is messy:
@@ -245,9 +209,9 @@ def _filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = Fal
 
             # New behavior - only save stitched tiles [and make stitched maps even if not tiled]
             if 'saveFilteredMaps' in f['params'] and f['params']['saveFilteredMaps'] == True:
-                stitchedFilteredMapDict[tileName]=filteredMapDict['data'].astype(np.float32)
-                stitchedSNMapDict[tileName]=filteredMapDict['SNMap'].astype(np.float32)
-                stitchedRMSMapDict[tileName]=filteredMapDict['RMSMap'].astype(np.float32)
+                stitchedFilteredMap=filteredMapDict['data'].astype(np.float32)
+                stitchedSNMap=filteredMapDict['SNMap'].astype(np.float32)
+                stitchedRMSMap=filteredMapDict['RMSMap'].astype(np.float32)
                 # If needed for debugging new behaviour
                 # maps.saveFITS(filteredMapFileName, filteredMapDict['data'], filteredMapDict['wcs'])
                 # maps.saveFITS(SNMapFileName, filteredMapDict['SNMap'], filteredMapDict['wcs'])
@@ -279,15 +243,15 @@ def _filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = Fal
                                                measureShapes = config.parDict['measureShapes'],
                                                invertMap = invertMap,
                                                DS9RegionsPath = DS9RegionsPath)
-            
+    
             # We collect the area mask here, because it gets modified by findObjects if removing rings
             # NOTE: area mask should always be the same across all filters, could add a consistency check here
-            if writeAreaMask == True and tileName not in areaMaskDict.keys():
-                areaMaskDict[tileName]=np.array(filteredMapDict['surveyMask'], dtype = np.uint8)
+            if writeAreaMask == True and areaMask is None:
+                areaMask=np.array(filteredMapDict['surveyMask'], dtype = np.uint8)
 
-            if writeFlagMask == True and tileName not in flagMaskDict.keys():
-                flagMaskDict[tileName]=filteredMapDict['flagMask']
-            
+            if writeFlagMask == True and flagMask is None:
+                flagMask=filteredMapDict['flagMask']
+    
             if measureFluxes == True:
                 photometry.measureFluxes(catalog, filteredMapDict, config.diagnosticsDir,
                                          photFilteredMapDict = photFilteredMapDict,
@@ -303,6 +267,198 @@ def _filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = Fal
                                             invertMap = invertMap)
             del filteredMapDict
             catalogDict[label]['catalog']=catalog
+            t1=time.time()
+            timings[f['label']]=t1-t0
+            t0=t1
+    del workspace
+
+    return {'tileName': tileName, 'catalogDict': catalogDict, 'areaMask': areaMask, 'flagMask': flagMask,
+            'filteredMap': stitchedFilteredMap, 'SNMap': stitchedSNMap,
+            'RMSMap': stitchedRMSMap, 'cachedFilter': cachedFilter,
+            'timings': timings}
+
+#------------------------------------------------------------------------------------------------------------
+# Used to hand the config and options to worker processes in _filterTilesInPool (inherited when forked)
+_poolState={}
+
+def _filterTileInWorker(tileName):
+    """Worker process function used by :meth:`_filterTilesInPool`.
+
+    """
+    numRecords=len(profiling.getRecords())
+    tileResult=_filterTile(_poolState['config'], tileName, **_poolState['tileOptions'])
+    # Filter objects can't be pickled (they hold WCS objects) - later stages (e.g., fitQ) will load them
+    # from disk instead, so the reference filter is always written here, even if saveFilter is False
+    if tileResult['cachedFilter'] is not None:
+        tileResult['cachedFilter'].writeFilterFile(tileResult['cachedFilter'].filterFileName)
+    tileResult['cachedFilter']=None
+    # Profiling records made in the worker are passed back to be merged into those of the parent
+    tileResult['profileRecords']=profiling.getRecords()[numRecords:]
+
+    return tileResult
+
+#------------------------------------------------------------------------------------------------------------
+def _filterTilesInPool(config, tileOptions):
+    """Filters tiles and makes catalogs in a pool of `config.numProcesses` worker processes, for running
+    in parallel on a single machine without MPI. Tiles are handed out in order of decreasing expected cost
+    (see :meth:`startUp.NemoConfig.getTileQueue`), to each worker as it becomes free.
+
+    Args:
+        config (:obj:`startUp.NemoConfig`): Nemo configuration object.
+        tileOptions (:obj:`dict`): Keyword arguments for :meth:`_filterTile`.
+
+    Yields:
+        Results for each tile, as returned by :meth:`_filterTile`, in the same order as `config.tileNames`.
+
+    Note:
+        Worker processes are forked from the parent, so that they inherit the config object and any maps
+        already loaded, rather than these being pickled and sent to each worker.
+
+    """
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise Exception("Running with numProcesses > 1 requires the 'fork' multiprocessing start method, which is not available on this platform.")
+    queue=config.getTileQueue()
+    queue=[tileName for tileName in queue if tileName in config.tileNames]
+    if len(queue) == 0:
+        return
+    _poolState['config']=config
+    _poolState['tileOptions']=tileOptions
+    try:
+        context=multiprocessing.get_context('fork')
+        with context.Pool(processes = min(config.numProcesses, len(queue))) as pool:
+            # Results are passed on in tileNames order, so that output is identical to a serial run
+            tileResults={}
+            nextIndex=0
+            for tileResult in pool.imap_unordered(_filterTileInWorker, queue, chunksize = 1):
+                tileResults[tileResult['tileName']]=tileResult
+                while nextIndex < len(config.tileNames) and config.tileNames[nextIndex] in tileResults:
+                    yield tileResults.pop(config.tileNames[nextIndex])
+                    nextIndex=nextIndex+1
+    finally:
+        _poolState.clear()
+
+#------------------------------------------------------------------------------------------------------------
+@profiling.stage('filterMapsAndMakeCatalogs')
+def _filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = False, useCachedRMSMap = False,\
+                               useCachedFilteredMaps = False, measureFluxes = True, invertMap = False, \
+                               verbose = True, writeAreaMask = False, writeFlagMask = False):
+    """Runs the map filtering and catalog construction steps according to the given configuration.
+    
+    Args:
+        config (:obj: 'startup.NemoConfig'): Nemo configuration object.
+        rootOutDir (str): If None, use the default given by config. Otherwise, use this to override where the
+            output filtered maps and catalogs are written.
+        useCachedFilters (:obj:`bool`, optional): If True, and previously made filters are found, they will be
+            read from disk, rather than re-calculated (used by source injection simulations).
+        useCachedFilteredMaps (:obj:`bool`, optional): If True, and previously written maps are found, these
+            will be read from disk, rather than re-made. This is useful for performing forced photometry using
+            external catalogs without having to run nemo again. Otherwise, this should be set to False.
+        measureFluxes (bool, optional): If True, measure fluxes. If False, just extract S/N values for 
+            detected objects.
+        invertMap (bool, optional): If True, multiply all maps by -1; needed by 
+            :meth:maps.estimateContaminationFromInvertedMaps).
+    
+    Returns:
+        Optimal catalog (keeps the highest S/N detection when filtering at multiple scales).
+    
+    Note:
+        See bin/nemo for how this pipeline is applied to real data, and maps.sourceInjectionTest
+        for how this is applied to source-free sims that are generated on the fly.
+        
+    """
+
+    # Per-tile timings are used to order the queue if using the dynamic tile scheduler - we only keep those
+    # from runs on the real maps (not sims, or re-runs using cached filters or filtered maps)
+    simRun=False
+    for mapDict in config.unfilteredMapsDictList:
+        if 'injectSources' in mapDict.keys() and mapDict['injectSources'] is not None:
+            simRun=True
+        if 'CMBSimSeed' in mapDict.keys() and mapDict['CMBSimSeed'] is not None:
+            simRun=True
+    recordTimings=rootOutDir is None and simRun == False and useCachedFilters == False and \
+                  useCachedFilteredMaps == False and invertMap == False
+
+    # If running on sims (source-free or with injected sources), this ensures we use the same kernels for 
+    # filtering the sim maps as was used on the real data, by copying kernels to the sims dir. The kernels 
+    # will then be loaded automatically when filterMaps is called. Yes, this is a bit clunky...
+    if rootOutDir is not None:
+        filteredMapsDir=rootOutDir+os.path.sep+"filteredMaps"
+        diagnosticsDir=rootOutDir+os.path.sep+"diagnostics"
+        dirList=[rootOutDir, filteredMapsDir, diagnosticsDir]
+        for d in dirList:
+            os.makedirs(d, exist_ok = True)
+    else:
+        rootOutDir=config.rootOutDir
+        filteredMapsDir=config.filteredMapsDir
+        diagnosticsDir=config.diagnosticsDir
+    
+    # We re-sort the filters list here - in case we have photFilter defined
+    photFilter=config.parDict['photFilter']
+    filtersList=[]
+    if photFilter is not None:
+        for f in config.parDict['mapFilters']:
+            if f['label'] == photFilter:
+                filtersList.append(f)
+    for f in config.parDict['mapFilters']:
+        if photFilter is not None:
+            if f['label'] == photFilter:
+                continue
+        filtersList.append(f)
+    if photFilter is not None and len(config.parDict['mapFilters']) > 1:
+        assert(filtersList[0]['label'] == photFilter)
+
+    # On-disk cache of filters, keyed by inputs
+    if 'filterCacheDir' in config.parDict.keys():
+        filterCacheDir=config.parDict['filterCacheDir']
+    else:
+        filterCacheDir=None
+
+    # For source injection stuff (yes, this is messy - see below for why we do this)
+    undoPixelWindow=True
+    if useCachedRMSMap == True:
+        undoPixelWindow=False
+
+    # Make filtered maps for each filter and tile
+    catalogDict={}
+    areaMaskDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
+    flagMaskDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
+    stitchedFilteredMapDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
+    stitchedSNMapDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
+    stitchedRMSMapDict=maps.TileDict({}, tileCoordsDict = config.tileCoordsDict)
+    tileOptions={'filtersList': filtersList, 'filteredMapsDir': filteredMapsDir, 'photFilter': photFilter,
+                 'filterCacheDir': filterCacheDir, 'undoPixelWindow': undoPixelWindow,
+                 'useCachedFilters': useCachedFilters, 'useCachedRMSMap': useCachedRMSMap,
+                 'useCachedFilteredMaps': useCachedFilteredMaps, 'measureFluxes': measureFluxes,
+                 'invertMap': invertMap, 'verbose': verbose, 'writeAreaMask': writeAreaMask,
+                 'writeFlagMask': writeFlagMask}
+    if config.numProcesses > 1:
+        tileResults=_filterTilesInPool(config, tileOptions)
+    else:
+        tileResults=(_filterTile(config, tileName, **tileOptions) for tileName in config.iterTileNames())
+    for tileResult in tileResults:
+        tileName=tileResult['tileName']
+        catalogDict.update(tileResult['catalogDict'])
+        if tileResult['areaMask'] is not None:
+            areaMaskDict[tileName]=tileResult['areaMask']
+        if tileResult['flagMask'] is not None:
+            flagMaskDict[tileName]=tileResult['flagMask']
+        if tileResult['filteredMap'] is not None:
+            stitchedFilteredMapDict[tileName]=tileResult['filteredMap']
+            stitchedSNMapDict[tileName]=tileResult['SNMap']
+            stitchedRMSMapDict[tileName]=tileResult['RMSMap']
+        if tileResult['cachedFilter'] is not None:
+            config.cachedFilters[tileName]=tileResult['cachedFilter']
+        if 'profileRecords' in tileResult.keys():
+            profiling.addRecords(tileResult['profileRecords'])
+        if recordTimings == True:
+            if tileName not in config.tileTimings.keys():
+                config.tileTimings[tileName]={}
+            config.tileTimings[tileName].update(tileResult['timings'])
+        del tileResult
+
+    if recordTimings == True:
+        config.saveTileTimings()
 
     # Merged/optimal catalogs
     optimalCatalog=catalogs.makeOptimalCatalog(catalogDict, constraintsList = config.parDict['catalogCuts'],
@@ -351,41 +507,244 @@ def _filterMapsAndMakeCatalogs(config, rootOutDir = None, useCachedFilters = Fal
         MEFPath=MEFPaths[i]
         stitchedPath=stitchedPaths[i]
         compressionType=compressionTypeList[i]
-        # MPI stuff
-        if (writeMEF == True or writeStitched == True) and config.MPIEnabled == True:
-            # Hmm. This isn't reliable on wits-core at least
-            # gathered_tileDicts=config.comm.gather(tileDict, root = 0)
-            # if config.rank == 0:
-            #     print("... gathered %s" % (label))
-            #     for rankTileDict in gathered_tileDicts:
-            #         for key in rankTileDict:
-            #             if key not in tileDict:
-            #                 tileDict[key]=rankTileDict[key]
-            # else:
-            #     del tileDict
-            if config.rank > 0:
-                config.comm.send(tileDict, dest = 0)
+        with profiling.stage('stitchMaps', product = label):
+            # MPI: stitched-only products (filtered, S/N maps) aren't gathered - processes take turns to add
+            # their own tiles straight into the output file, so rank 0 never holds all of the tiles
+            if writeMEF == False and writeStitched == True and stitchedPath is not None and compressionType is None \
+                and config.MPIEnabled == True:
+                if config.comm.allreduce(len(tileDict)) > 0:
+                    if config.rank == 0:
+                        maps.makeEmptyFITS(stitchedPath, config.origWCS)
+                    for rank in range(config.size):
+                        config.comm.barrier()
+                        if config.rank == rank:
+                            tileDict.pasteIntoStitchedFITS(stitchedPath)
+                    config.comm.barrier()
+                    if config.rank == 0:
+                        print("... stitched %s" % (label))
+                del tileDict
+                continue
+            # MPI stuff
+            if (writeMEF == True or writeStitched == True) and config.MPIEnabled == True:
+                # Hmm. This isn't reliable on wits-core at least
+                # gathered_tileDicts=config.comm.gather(tileDict, root = 0)
+                # if config.rank == 0:
+                #     print("... gathered %s" % (label))
+                #     for rankTileDict in gathered_tileDicts:
+                #         for key in rankTileDict:
+                #             if key not in tileDict:
+                #                 tileDict[key]=rankTileDict[key]
+                # else:
+                #     del tileDict
+                if config.rank > 0:
+                    config.comm.send(tileDict, dest = 0)
+                    del tileDict
+                elif config.rank == 0:
+                    gathered_tileDicts=[]
+                    gathered_tileDicts.append(tileDict)
+                    for source in range(1, config.size):
+                        gathered_tileDicts.append(config.comm.recv(source = source))
+                    print("... gathered %s" % (label))
+                    for t in gathered_tileDicts:
+                        for tileName in t.keys():
+                            tileDict[tileName]=t[tileName]
+            # Write MEFs and stitched versions
+            if config.rank == 0:
+                if writeMEF == True and MEFPath is not None and len(tileDict) > 0:
+                    tileDict.saveMEF(MEFPath, compressionType = compressionType)
+                if writeStitched == True and stitchedPath is not None and len(tileDict) > 0:
+                    tileDict.saveStitchedFITS(stitchedPath, config.origWCS, compressionType = compressionType)
                 del tileDict
-            elif config.rank == 0:
-                gathered_tileDicts=[]
-                gathered_tileDicts.append(tileDict)
-                for source in range(1, config.size):
-                    gathered_tileDicts.append(config.comm.recv(source = source))
-                print("... gathered %s" % (label))
-                for t in gathered_tileDicts:
-                    for tileName in t.keys():
-                        tileDict[tileName]=t[tileName]
-        # Write MEFs and stitched versions
-        if config.rank == 0:
-            if writeMEF == True and MEFPath is not None and len(tileDict) > 0:
-                tileDict.saveMEF(MEFPath, compressionType = compressionType)
-            if writeStitched == True and stitchedPath is not None and len(tileDict) > 0:
-                tileDict.saveStitchedFITS(stitchedPath, config.origWCS, compressionType = compressionType)
-            del tileDict
 
     return optimalCatalog
 
 #------------------------------------------------------------------------------------------------------------
+def injectAndRecoverSources(config, injectSourcesList, batchSize = 8, verbose = True):
+    """Injects sources into the maps and recovers them, for each of the given sets of sources, with the
+    same end result as running :meth:`filterMapsAndMakeCatalogs` (with `useCachedFilters` and
+    `useCachedRMSMap` set) on each set of injected sources in turn, as done by
+    :meth:`maps.sourceInjectionTest`. This is much quicker, for the following reasons.
+
+    Filtering is linear, so the filtered map of the real data plus injected sources is the sum of the
+    filtered real map and the filtered model image of the injected sources. So, the real maps are
+    preprocessed and filtered using the (cached) reference filter only once per tile, and after that only
+    model images are filtered, `batchSize` at a time. The linear preprocessing steps that
+    :meth:`maps.MapDict.preprocess` applies after injecting sources (`applyBeamConvolution`, `smoothKernel`)
+    are applied to the model images. The S/N maps are made using the cached RMS map.
+
+    Args:
+        config (:obj:`nemo.startUp.NemoConfig`): Nemo configuration object.
+        injectSourcesList (:obj:`list`): List of dictionaries, each of which describes a set of sources to
+            inject, in the format used for the `injectSources` key of a :class:`maps.MapDict`.
+        batchSize (:obj:`int`, optional): Number of model images (one per set of injected sources) that
+            are filtered at once.
+        verbose (:obj:`bool`, optional): If True, print progress messages.
+
+    Returns:
+        A list of catalogs, one for each entry in `injectSourcesList`, of objects recovered in the maps.
+
+    Note:
+        This gives the same results as injecting the sources into the maps before filtering only if the
+        preprocessing applied to the maps is linear, so an exception is raised if holes in the maps are
+        filled (i.e., if `maskPointSourcesFromCatalog`, `maskAndFillFromCatalog` or `findAndMaskExtended`
+        are used). The reference filter (`photFilter`) must be set.
+
+    """
+
+    if 'findAndMaskExtended' in config.parDict.keys():
+        raise Exception("incremental source injection can't be used with findAndMaskExtended (filling holes in maps is not linear)")
+    for mapDict in config.unfilteredMapsDictList:
+        for key in ['maskPointSourcesFromCatalog', 'maskAndFillFromCatalog', 'extendedMask']:
+            if key in mapDict.keys() and mapDict[key] is not None:
+                raise Exception("incremental source injection can't be used with %s (filling holes in maps is not linear)" % (key))
+
+    photFilter=config.parDict['photFilter']
+    filtDict=None
+    for f in config.parDict['mapFilters']:
+        if f['label'] == photFilter:
+            filtDict=f
+    if filtDict is None:
+        raise Exception("incremental source injection needs the reference filter (photFilter) to be set")
+
+    if 'filterCacheDir' in config.parDict.keys():
+        filterCacheDir=config.parDict['filterCacheDir']
+    else:
+        filterCacheDir=None
+
+    catalogDictsList=[]
+    for injectSources in injectSourcesList:
+        catalogDictsList.append({})
+    for tileName in config.iterTileNames():
+        if verbose == True: print(">>> [rank = %d] Injecting and recovering sources - tileName = %s " % (config.rank, tileName))
+        tileCatalogs=_injectAndRecoverInTile(config, tileName, filtDict, injectSourcesList,
+                                             filterCacheDir = filterCacheDir, batchSize = batchSize)
+        for catalogDict, catalog in zip(catalogDictsList, tileCatalogs):
+            catalogDict[photFilter+"#"+tileName]={'catalog': catalog}
+
+    recCatalogsList=[]
+    for catalogDict in catalogDictsList:
+        recCatalogsList.append(catalogs.makeOptimalCatalog(catalogDict, constraintsList = config.parDict['catalogCuts'],
+                                                           photFilter = photFilter,
+                                                           method = config.parDict['optimalCatalogMethod']))
+
+    # Gathering catalogs - for all sets of injected sources at once
+    if config.MPIEnabled == True:
+        gatheredCatalogsLists=config.comm.allgather(recCatalogsList)
+        for i in range(len(recCatalogsList)):
+            toStack=[]  # We sometimes return [] if no objects found - we can't vstack those
+            for collectedList in gatheredCatalogsLists:
+                collectedTab=collectedList[i]
+                if type(collectedTab) == astropy.table.table.Table and len(collectedTab) > 0:
+                    toStack.append(collectedTab)
+            if len(toStack) > 0:
+                recCatalog=atpy.vstack(toStack)
+                recCatalog, numDuplicatesFound, names=catalogs.removeDuplicates(recCatalog)
+            else:
+                recCatalog=[]
+            recCatalogsList[i]=recCatalog
+
+    return recCatalogsList
+
+#------------------------------------------------------------------------------------------------------------
+@profiling.stage('injectAndRecoverTile', contextArgs = {'tileName': 'tileName'})
+def _injectAndRecoverInTile(config, tileName, filtDict, injectSourcesList, filterCacheDir = None,
+                            batchSize = 8):
+    """Runs :meth:`injectAndRecoverSources` for a single tile.
+
+    Returns:
+        A list of catalogs, one for each entry in `injectSourcesList`.
+
+    """
+
+    # The real maps are filtered only once (as in _filterTile, the pixel window is undone later)
+    workspace=filters.MapWorkspace(tileName, diagnosticsDir = config.diagnosticsDir)
+    filteredMapDict, filterObj=filters.filterMaps(config.unfilteredMapsDictList, filtDict, tileName,
+                                                  diagnosticsDir = config.diagnosticsDir,
+                                                  selFnDir = config.selFnDir, undoPixelWindow = False,
+                                                  useCachedFilter = True, returnFilter = True,
+                                                  filterCacheDir = filterCacheDir, workspace = workspace)
+    del workspace
+    RMSMap, wcs=completeness.loadRMSMap(tileName, config.selFnDir, filtDict['label'])
+    validMask=np.greater(RMSMap, 0)
+
+    # Filtered maps are zeroed by the masks applied by the filter (point source mask, edges etc.)
+    dataMask=np.not_equal(filteredMapDict['data'], 0)
+    realFilteredMap=filteredMapDict['data']
+    realData=enmap.apply_window(realFilteredMap, pow=-1.0)*dataMask
+
+    shape=realFilteredMap.shape
+    tileCatalogs=[]
+    for batchStart in range(0, len(injectSourcesList), batchSize):
+        batch=injectSourcesList[batchStart:batchStart+batchSize]
+
+        # Model images of the injected sources, as they would be added to each map by preprocessing
+        modelStack=np.zeros([len(batch), len(filterObj.unfilteredMapsDictList)]+list(shape))
+        for i in range(len(batch)):
+            injectSources=batch[i]
+            if 'GNFWParams' in injectSources.keys():
+                GNFWParams=injectSources['GNFWParams']
+            else:
+                GNFWParams=None
+            for j in range(len(filterObj.unfilteredMapsDictList)):
+                mapDict=filterObj.unfilteredMapsDictList[j]
+                if GNFWParams is not None:
+                    obsFreqGHz=mapDict['obsFreqGHz']
+                else:
+                    obsFreqGHz=None
+                validAreaSection=mapDict.tileCoordsDict[tileName]['areaMaskInClipSection']
+                modelMap=maps.makeModelImage(shape, mapDict['wcs'], injectSources['catalog'],
+                                             mapDict['beamFileName'], obsFreqGHz = obsFreqGHz,
+                                             GNFWParams = GNFWParams, profile = injectSources['profile'],
+                                             validAreaSection = validAreaSection,
+                                             override = injectSources['override'])
+                if modelMap is None:
+                    continue
+                modelMap[mapDict['weights'] == 0]=0
+                # Linear preprocessing steps, in the same order as in MapDict.preprocess
+                if 'applyBeamConvolution' in mapDict.keys() and mapDict['applyBeamConvolution'] == True:
+                    modelMap=maps.convolveMapWithBeam(modelMap, mapDict['wcs'], mapDict['beamFileName'],
+                                                      maxDistDegrees = 1.0)
+                if 'smoothKernel' in mapDict.keys():
+                    if 'smoothAttenuationFactor' in mapDict.keys():
+                        modelMap=modelMap*mapDict['smoothAttenuationFactor']
+                    modelMap=maps.convolveMapWithBeam(modelMap, mapDict['wcs'], mapDict['smoothKernel'],
+                                                      maxDistDegrees = 1.0)
+                modelStack[i, j]=modelMap
+        filteredModels=filterObj.applyFilterToStack(modelStack)*dataMask
+        del modelStack
+        filteredModelsData=enmap.apply_window(filteredModels, pow=-1.0)*dataMask
+
+        for i in range(len(batch)):
+            # Made over the whole tile in the same way as in _filterTile, so that ring flagging and
+            # segmentation are the same as when the sources are injected before filtering
+            SNMap=np.zeros(shape)+realFilteredMap+filteredModels[i]
+            SNMap[validMask]=SNMap[validMask]/RMSMap[validMask]
+
+            injFilteredMapDict=dict(filteredMapDict)
+            injFilteredMapDict['SNMap']=SNMap
+            injFilteredMapDict['data']=realData+filteredModelsData[i]
+            catalog=photometry.findObjects(injFilteredMapDict, threshold = config.parDict['thresholdSigma'],
+                                           minObjPix = config.parDict['minObjPix'],
+                                           findCenterOfMass = config.parDict['findCenterOfMass'],
+                                           flagRings = config.parDict['flagRings'],
+                                           ringFlagDistArcmin = config.parDict['ringFlagDistArcmin'],
+                                           ringFlagMinRingerSNR = config.parDict['ringFlagMinRingerSNR'],
+                                           ringThresholdSigma = config.parDict['ringThresholdSigma'],
+                                           rejectBorder = config.parDict['rejectBorder'],
+                                           objIdent = config.parDict['objIdent'],
+                                           longNames = config.parDict['longNames'],
+                                           useInterpolator = config.parDict['useInterpolator'],
+                                           measureShapes = config.parDict['measureShapes'])
+            photometry.measureFluxes(catalog, injFilteredMapDict, config.diagnosticsDir,
+                                     photFilteredMapDict = injFilteredMapDict,
+                                     useInterpolator = config.parDict['useInterpolator'])
+            tileCatalogs.append(catalog)
+        del filteredModels, filteredModelsData
+
+    return tileCatalogs
+
+#------------------------------------------------------------------------------------------------------------
+@profiling.stage('makeRMSTables')
 def makeRMSTables(config):
     """Makes a collection of selection function dictionaries (one per footprint specified in selFnFootprints
     in the config file, plus the full survey mask), that contain information on noise levels and area covered,
@@ -418,7 +777,9 @@ def makeRMSTables(config):
             if config.parDict['selFnOptions']['maxFlags'] is not None:
                 label=label+"_maxFlags%d" % (config.parDict['selFnOptions']['maxFlags'])
             outFileName=config.selFnDir+os.path.sep+"RMSTab"+label+".fits"
-            if os.path.exists(outFileName) == True:
+            if os.path.exists(outFileName) == True and \
+                completeness.checkRMSTabQuantizationStep(atpy.Table().read(outFileName),
+                                                         config.parDict['selFnOptions']['RMSQuantizationStep']) == True:
                 print("... intersection mask and RMS table already exist for %s footprint with maxFlags = %s - skipping" % (footprintDict['label'], config.parDict['selFnOptions']['maxFlags']))
                 continue
             else:
@@ -427,27 +788,30 @@ def makeRMSTables(config):
 
     # Run the selection function calculation on each tile in turn
     for tileName in config.tileNames:
-        RMSTab=completeness.getRMSTab(tileName, photFilterLabel, config.selFnDir,
-                                      maxFlags = config.parDict['selFnOptions']['maxFlags'])
-        selFnDict={'tileName': tileName,
-                   'RMSTab': RMSTab,
-                   'tileAreaDeg2': RMSTab['areaDeg2'].sum()}
-        selFnCollection['full'].append(selFnDict)
-
-        # Generate footprint intersection masks (e.g., with HSC) and RMS tables, which are cached
-        # May as well do this bit here (in parallel) and assemble output later
-        for footprintDict in footprintsToUpdate:
-            completeness.makeIntersectionMask(tileName, config.selFnDir, footprintDict['label'], masksList = footprintDict['maskList'])
-            tileAreaDeg2=completeness.getTileTotalAreaDeg2(tileName, config.selFnDir, footprintLabel = footprintDict['label'])
-            # Life is easier if we just generate empty tables when there is no intersection
-            # if tileAreaDeg2 > 0:
+        with profiling.stage('makeRMSTab', tileName = tileName):
             RMSTab=completeness.getRMSTab(tileName, photFilterLabel, config.selFnDir,
-                                            footprintLabel = footprintDict['label'],
-                                            maxFlags = config.parDict['selFnOptions']['maxFlags'])
+                                          maxFlags = config.parDict['selFnOptions']['maxFlags'],
+                                          quantizationStep = config.parDict['selFnOptions']['RMSQuantizationStep'])
             selFnDict={'tileName': tileName,
-                        'RMSTab': RMSTab,
-                        'tileAreaDeg2': RMSTab['areaDeg2'].sum()}
-            selFnCollection[footprintDict['label']].append(selFnDict)
+                       'RMSTab': RMSTab,
+                       'tileAreaDeg2': RMSTab['areaDeg2'].sum()}
+            selFnCollection['full'].append(selFnDict)
+
+            # Generate footprint intersection masks (e.g., with HSC) and RMS tables, which are cached
+            # May as well do this bit here (in parallel) and assemble output later
+            for footprintDict in footprintsToUpdate:
+                completeness.makeIntersectionMask(tileName, config.selFnDir, footprintDict['label'], masksList = footprintDict['maskList'])
+                tileAreaDeg2=completeness.getTileTotalAreaDeg2(tileName, config.selFnDir, footprintLabel = footprintDict['label'])
+                # Life is easier if we just generate empty tables when there is no intersection
+                # if tileAreaDeg2 > 0:
+                RMSTab=completeness.getRMSTab(tileName, photFilterLabel, config.selFnDir,
+                                                footprintLabel = footprintDict['label'],
+                                                maxFlags = config.parDict['selFnOptions']['maxFlags'],
+                                                quantizationStep = config.parDict['selFnOptions']['RMSQuantizationStep'])
+                selFnDict={'tileName': tileName,
+                            'RMSTab': RMSTab,
+                            'tileAreaDeg2': RMSTab['areaDeg2'].sum()}
+                selFnCollection[footprintDict['label']].append(selFnDict)
 
     if config.MPIEnabled == True:
         gathered_selFnCollections=config.comm.gather(selFnCollection, root = 0)
@@ -488,6 +852,7 @@ def makeRMSTables(config):
                 tab=atpy.vstack(tabList)
                 tab.sort('y0RMS')
                 tab.meta['NEMOVER']=nemo.__version__
+                tab.meta['QSTEP']=tabList[0].meta.get('QSTEP', 0.0)
                 tab.write(outFileName, overwrite = True)
 
         # Add footprint columns to object catalog
@@ -1038,16 +1403,14 @@ def _extractSpecCAP(config, tab, kernelDict, method = 'CAP', diskRadiusArcmin =
             tileTab['diskT_uKArcmin2_%s' % (label)]=np.zeros(len(tileTab))
             tileTab['err_diskT_uKArcmin2_%s' % (label)]=np.zeros(len(tileTab))
             tileTab['diskSNR_%s' % (label)]=np.zeros(len(tileTab))
-        for row in tileTab:
-            degreesMap=np.ones(shape, dtype = float)*1e6 # NOTE: never move this
-            degreesMap, xBounds, yBounds=maps.makeDegreesDistanceMap(degreesMap, wcs,
-                                                                     row['RADeg'], row['decDeg'],
-                                                                     maxSizeDeg)
+        cutouts=maps.makeDegreesDistanceCutouts(shape, wcs, tileTab['RADeg'], tileTab['decDeg'], maxSizeDeg)
+        for row, (degreesMap, slices) in zip(tileTab, cutouts):
             innerMask=degreesMap < innerRadiusArcmin/60
             outerMask=np.logical_and(degreesMap >= innerRadiusArcmin/60, degreesMap < outerRadiusArcmin/60)
+            pixArea=pixAreaMap[slices]
             for mapDict, label in zip(mapDictList, freqLabels):
-                d=mapDict['data'] 
-                diskFlux=(d[innerMask]*pixAreaMap[innerMask]).sum()-(d[outerMask]*pixAreaMap[outerMask]).sum()
+                d=mapDict['data'][slices]
+                diskFlux=(d[innerMask]*pixArea[innerMask]).sum()-(d[outerMask]*pixArea[outerMask]).sum()
                 row['diskT_uKArcmin2_%s' % (label)]=diskFlux
             
         # Estimate noise in every measurement (on average) from spatting down on random positions
@@ -1057,16 +1420,14 @@ def _extractSpecCAP(config, tab, kernelDict, method = 'CAP', diskRadiusArcmin =
             randTab=catalogs.generateRandomSourcesCatalog(mapDict['surveyMask'], wcs, 1000)
             for label in freqLabels:
                 randTab['diskT_uKArcmin2_%s' % (label)]=np.zeros(len(randTab))
-            for row in randTab:
-                degreesMap=np.ones(shape, dtype = float)*1e6 # NOTE: never move this
-                degreesMap, xBounds, yBounds=maps.makeDegreesDistanceMap(degreesMap, wcs,
-                                                                         row['RADeg'], row['decDeg'],
-                                                                         maxSizeDeg)
+            cutouts=maps.makeDegreesDistanceCutouts(shape, wcs, randTab['RADeg'], randTab['decDeg'], maxSizeDeg)
+            for row, (degreesMap, slices) in zip(randTab, cutouts):
                 innerMask=degreesMap < innerRadiusArcmin/60
                 outerMask=np.logical_and(degreesMap >= innerRadiusArcmin/60, degreesMap < outerRadiusArcmin/60)
+                pixArea=pixAreaMap[slices]
                 for mapDict, label in zip(mapDictList, freqLabels):
-                    d=mapDict['data'] 
-                    diskFlux=(d[innerMask]*pixAreaMap[innerMask]).sum()-(d[outerMask]*pixAreaMap[outerMask]).sum()
+                    d=mapDict['data'][slices]
+                    diskFlux=(d[innerMask]*pixArea[innerMask]).sum()-(d[outerMask]*pixArea[outerMask]).sum()
                     row['diskT_uKArcmin2_%s' % (label)]=diskFlux
             noiseLevels={}
             for label in freqLabels:
@@ -6,7 +6,6 @@ For any routine that makes a plot using matplotlib, call plotSettings.update_rcP
 
 """
 
-import pylab as plt
 import matplotlib as mpl
 from cycler import cycler
 
@@ -33,14 +32,14 @@ def update_rcParams(dict={}):
     default['lines.linewidth'] = 2
 
     for key in default:
-        plt.rcParams[key] = default[key]
+        mpl.rcParams[key] = default[key]
     # if any parameters are specified, overwrite anything previously
     # defined
     for key in dict:
-        plt.rcParams[key] = dict[key]
+        mpl.rcParams[key] = dict[key]
 
     # From https://github.com/mhasself/rg_friendly
-    plt.rcParams['axes.prop_cycle']=cycler(color=['#2424f0','#df6f0e','#3cc03c','#d62728','#b467bd','#ac866b','#e397d9','#9f9f9f','#ecdd72','#77becf'])
+    mpl.rcParams['axes.prop_cycle']=cycler(color=['#2424f0','#df6f0e','#3cc03c','#d62728','#b467bd','#ac866b','#e397d9','#9f9f9f','#ecdd72','#77becf'])
 
 # Let's just do this whenever it's imported
 update_rcParams()
@@ -0,0 +1,280 @@
+"""
+
+This module contains tools for recording where the time and memory go when running nemo.
+
+Stages of the pipeline are wrapped with :func:`stage`, which can be used either as a context manager or as
+a function decorator. Each time a stage runs, its wall time, CPU time, and the peak memory use (resident set
+size, RSS) of the process are recorded, together with any context given (e.g., the tile and filter being
+worked on). Stages may be nested - context given to an outer stage (e.g., `tileName`) is inherited by the
+stages inside it. For example::
+
+    with profiling.stage('filterTile', tileName = tileName):
+        ...
+
+    @profiling.stage('findObjects')
+    def findObjects(...):
+        ...
+
+When used as a decorator, the values of the function's arguments can be recorded as context, e.g.::
+
+    @profiling.stage('filterTile', contextArgs = {'tileName': 'tileName'})
+    def _filterTile(config, tileName, ...):
+        ...
+
+The records from all processes can be merged into a JSON format report using :func:`writeReport` (this is
+done at the end of a :ref:`nemoCommand` run, which writes the report to `diagnostics/profile.json`).
+Records are kept in memory until :func:`reset` is called (this is done when a
+:class:`startUp.NemoConfig` object is created, i.e., at the start of each run). Recording can be switched
+off with :func:`setEnabled`.
+
+"""
+
+import os
+import sys
+import time
+import json
+import inspect
+import functools
+import contextlib
+try:
+    import resource
+except ImportError:
+    resource=None
+import nemo
+
+# Records made by this process, and the stack of stages currently running (with their context)
+_records=[]
+_stack=[]
+_enabled=True
+
+#------------------------------------------------------------------------------------------------------------
+def reset():
+    """Discards all of the stage records made by this process so far.
+
+    """
+
+    del _records[:]
+
+
+def setEnabled(enabled):
+    """Switches recording of stages on or off (it is on by default). Stages that are already running when
+    this is called are not affected.
+
+    Args:
+        enabled (:obj:`bool`): If True, record stages. If False, :class:`stage` does nothing.
+
+    """
+
+    global _enabled
+    _enabled=enabled
+
+#------------------------------------------------------------------------------------------------------------
+def getPeakRSSMB():
+    """Returns the peak resident set size (RSS) of this process so far, in MB.
+
+    Returns:
+        Peak RSS in MB (:obj:`float`), or None if this can't be measured on this platform.
+
+    """
+
+    if resource is None:
+        return None
+    maxRSS=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxRSS=maxRSS/1024.0   # bytes on macOS, kB elsewhere
+
+    return maxRSS/1024.0
+
+#------------------------------------------------------------------------------------------------------------
+class stage(contextlib.ContextDecorator):
+    """Records the wall time, CPU time, and peak memory use of a pipeline stage. This can be used either as
+    a context manager or as a function decorator.
+
+    Args:
+        name (:obj:`str`): Name of the stage.
+        contextArgs (:obj:`dict`, optional): Only used when decorating a function. Maps the names of extra
+            information to record with the stage to either the name of an argument of the function (e.g.,
+            ``{'tileName': 'tileName'}``), or to a function that takes a dictionary of the argument values
+            and returns the value to record.
+        **context: Extra information to record with the stage (e.g., `tileName`, `filterLabel`). This is
+            also inherited by any stages run inside this one.
+
+    Note:
+        The peak RSS recorded is the peak for the whole process up to the end of the stage. The increase in
+        the peak RSS over the course of the stage is also recorded - this is non-zero only if the stage
+        pushed the memory use of the process to a new high.
+
+    """
+
+    def __init__(self, name, contextArgs = None, **context):
+        self.name=name
+        self.contextArgs=contextArgs
+        self.context=context
+
+
+    def __call__(self, func):
+        if self.contextArgs is None:
+            return super().__call__(func)
+
+        signature=inspect.signature(func)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            boundArgs=signature.bind(*args, **kwargs)
+            boundArgs.apply_defaults()
+            context=dict(self.context)
+            for key, arg in self.contextArgs.items():
+                if callable(arg):
+                    context[key]=arg(boundArgs.arguments)
+                else:
+                    context[key]=boundArgs.arguments[arg]
+            with stage(self.name, **context):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+    def _recreate_cm(self):
+        # Each call of a decorated function gets its own instance (state is kept between enter and exit)
+        return stage(self.name, **self.context)
+
+
+    def __enter__(self):
+        self.recording=_enabled
+        if self.recording == False:
+            return self
+        if len(_stack) > 0:
+            context=dict(_stack[-1]['context'])
+            parent=_stack[-1]['name']
+        else:
+            context={}
+            parent=None
+        context.update(self.context)
+        _stack.append({'name': self.name, 'parent': parent, 'context': context,
+                       'startTime': time.time(), 'wall0': time.perf_counter(),
+                       'CPU0': time.process_time(), 'peakRSS0': getPeakRSSMB()})
+
+        return self
+
+
+    def __exit__(self, *exc):
+        if self.recording == False:
+            return False
+        state=_stack.pop()
+        peakRSSMB=getPeakRSSMB()
+        record={'stage': state['name'], 'parent': state['parent'], 'pid': os.getpid(),
+                'startTime': state['startTime'],
+                'wallTime': time.perf_counter()-state['wall0'],
+                'CPUTime': time.process_time()-state['CPU0'],
+                'peakRSSMB': peakRSSMB}
+        if peakRSSMB is not None:
+            record['peakRSSIncreaseMB']=peakRSSMB-state['peakRSS0']
+        else:
+            record['peakRSSIncreaseMB']=None
+        record.update(state['context'])
+        _records.append(record)
+
+        return False
+
+#------------------------------------------------------------------------------------------------------------
+def getRecords():
+    """Returns the list of stage records made by this process so far.
+
+    Returns:
+        A list of dictionaries, one per stage run.
+
+    """
+
+    return _records
+
+
+def addRecords(records):
+    """Adds stage records (e.g., made by a worker process) to those kept by this process.
+
+    Args:
+        records (:obj:`list`): List of records, as returned by :func:`getRecords`.
+
+    """
+
+    _records.extend(records)
+
+#------------------------------------------------------------------------------------------------------------
+def summarizeRecords(records):
+    """Summarizes the given stage records, by stage name.
+
+    Args:
+        records (:obj:`list`): List of records, as returned by :func:`getRecords`.
+
+    Returns:
+        A dictionary, indexed by stage name, of dictionaries containing the number of times the stage was run
+        (`count`), the total and maximum wall time (`wallTime`, `maxWallTime`), the total CPU time
+        (`CPUTime`), and the maximum peak RSS (`peakRSSMB`).
+
+    """
+
+    summary={}
+    for record in records:
+        if record['stage'] not in summary.keys():
+            summary[record['stage']]={'count': 0, 'wallTime': 0.0, 'maxWallTime': 0.0, 'CPUTime': 0.0,
+                                      'peakRSSMB': None}
+        s=summary[record['stage']]
+        s['count']=s['count']+1
+        s['wallTime']=s['wallTime']+record['wallTime']
+        s['maxWallTime']=max(s['maxWallTime'], record['wallTime'])
+        s['CPUTime']=s['CPUTime']+record['CPUTime']
+        if record['peakRSSMB'] is not None:
+            if s['peakRSSMB'] is None or record['peakRSSMB'] > s['peakRSSMB']:
+                s['peakRSSMB']=record['peakRSSMB']
+
+    return summary
+
+#------------------------------------------------------------------------------------------------------------
+def writeReport(config, outFileName = None):
+    """Gathers the stage records from all MPI processes and writes them, together with a summary by stage,
+    to a JSON format file (written by rank 0). This must be called by all processes.
+
+    Args:
+        config (:obj:`startUp.NemoConfig`): Nemo configuration object.
+        outFileName (:obj:`str`, optional): Path to the output file. If None, the report is written to
+            `profile.json` in the `diagnostics` directory.
+
+    Returns:
+        The report (:obj:`dict`) on rank 0, None on other processes.
+
+    """
+
+    if config.MPIEnabled == True:
+        gatheredRecords=config.comm.gather(_records, root = 0)
+    else:
+        gatheredRecords=[_records]
+    if config.rank != 0:
+        return None
+
+    records=[]
+    for rank, rankRecords in enumerate(gatheredRecords):
+        for record in rankRecords:
+            record=dict(record)
+            record['rank']=rank
+            records.append(record)
+    records.sort(key = lambda r: r['startTime'])
+    peakRSSByRank={}
+    for record in records:
+        if record['peakRSSMB'] is not None:
+            key=str(record['rank'])
+            if key not in peakRSSByRank.keys() or record['peakRSSMB'] > peakRSSByRank[key]:
+                peakRSSByRank[key]=record['peakRSSMB']
+    report={'nemoVersion': nemo.__version__,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'numRanks': len(gatheredRecords),
+            'numProcesses': config.numProcesses,
+            'totalWallTime': time.time()-config._timeStarted,
+            'peakRSSMBByRank': peakRSSByRank,
+            'stages': summarizeRecords(records),
+            'records': records}
+
+    if outFileName is None:
+        outFileName=config.diagnosticsDir+os.path.sep+"profile.json"
+    os.makedirs(os.path.split(os.path.abspath(outFileName))[0], exist_ok = True)
+    with open(outFileName, "w") as outFile:
+        json.dump(report, outFile, indent = 1, default = str)
+
+    return report
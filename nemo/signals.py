@@ -14,10 +14,13 @@ import astropy.constants as constants
 from astLib import *
 from scipy import ndimage
 from scipy import interpolate
+from scipy import integrate
 from scipy import stats
 import time
+import multiprocessing
 import astropy.table as atpy
 import nemo
+from ._lazy import lazyImport
 from . import maps
 from . import catalogs
 from . import photometry
@@ -25,10 +28,10 @@ from . import filters
 from . import gnfw
 from . import completeness
 from . import plotSettings
+from . import profiling
 import numpy as np
 import numpy.fft as fft
 import math
-import pylab as plt
 import pickle
 import operator
 import nemo
@@ -36,6 +39,7 @@ import glob
 import shutil
 import yaml
 import warnings
+plt=lazyImport('pylab')
 np.random.seed()
 
 #------------------------------------------------------------------------------------------------------------
@@ -57,19 +61,56 @@ ns=0.95
 transferFunction="boltzmann_camb"
 on_rtd=os.environ.get('READTHEDOCS', None)
 if on_rtd is None:
-    import pyccl as ccl
-    fiducialCosmoModel=ccl.Cosmology(Omega_c=Om0-Ob0, Omega_b=Ob0, h=0.01*H0, sigma8=sigma8, n_s=ns,
-                                    transfer_function=transferFunction)
-
-    # For CCL-based mass conversions
-    M200mDef=ccl.halos.MassDef(200, "matter")
-    M200cDef=ccl.halos.MassDef(200, "critical")
-    M500cDef=ccl.halos.MassDef(500, "critical")
-else:
-    fiducialCosmoModel=None
-    M200mDef=None
-    M200cDef=None
-    M500cDef=None
+    ccl=lazyImport('pyccl')
+
+# For CCL-based mass conversions
+_MASS_DEFS={'M200mDef': (200, "matter"), 'M200cDef': (200, "critical"), 'M500cDef': (500, "critical")}
+
+# The fiducial cosmology and mass definitions are made on first use (see getFiducialCosmoModel), so that
+# importing nemo doesn't need to import pyccl
+_fiducialObjects={}
+
+#------------------------------------------------------------------------------------------------------------
+def getFiducialCosmoModel():
+    """Returns the default (fiducial) cosmology (e.g., used by fitQ), which is made on first use. This is
+    also available as `signals.fiducialCosmoModel`.
+
+    Returns:
+        Cosmology object (:obj:`pyccl.Cosmology`), or None if building the documentation.
+
+    """
+
+    if on_rtd is not None:
+        return None
+    if 'fiducialCosmoModel' not in _fiducialObjects.keys():
+        _fiducialObjects['fiducialCosmoModel']=ccl.Cosmology(Omega_c=Om0-Ob0, Omega_b=Ob0, h=0.01*H0,
+                                                             sigma8=sigma8, n_s=ns,
+                                                             transfer_function=transferFunction)
+
+    return _fiducialObjects['fiducialCosmoModel']
+
+
+def _getMassDef(name):
+    """Returns the CCL mass definition with the given name (one of the keys of _MASS_DEFS), which is made on
+    first use.
+
+    """
+
+    if on_rtd is not None:
+        return None
+    if name not in _fiducialObjects.keys():
+        _fiducialObjects[name]=ccl.halos.MassDef(*_MASS_DEFS[name])
+
+    return _fiducialObjects[name]
+
+
+def __getattr__(name):
+    # Module attributes made on first use: fiducialCosmoModel, M200mDef, M200cDef, M500cDef
+    if name == 'fiducialCosmoModel':
+        return getFiducialCosmoModel()
+    if name in _MASS_DEFS.keys():
+        return _getMassDef(name)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
 
 #------------------------------------------------------------------------------------------------------------
 class BeamProfile(object):
@@ -478,7 +519,7 @@ def makeArnaudModelProfile(z, M500, GNFWParams = 'default', cosmoModel = None, b
     """
 
     if cosmoModel is None:
-        cosmoModel=fiducialCosmoModel
+        cosmoModel=getFiducialCosmoModel()
 
     if GNFWParams == 'default':
         GNFWParams=gnfw._default_params
@@ -536,7 +577,7 @@ def makeBattagliaModelProfile(z, M500c, GNFWParams = 'default', cosmoModel = Non
     """
 
     if cosmoModel is None:
-        cosmoModel=fiducialCosmoModel
+        cosmoModel=getFiducialCosmoModel()
     
     if GNFWParams == 'default':
         # NOTE: These are Table 1 values from Battaglia+2012 for M500c
@@ -557,7 +598,7 @@ def makeBattagliaModelProfile(z, M500c, GNFWParams = 'default', cosmoModel = Non
     beta_alpha_m=0.0480
     beta_alpha_z=0.615
 
-    M200c=M500cToMdef(M500c, z, M200cDef, cosmoModel)
+    M200c=M500cToMdef(M500c, z, _getMassDef('M200cDef'), cosmoModel)
 
     P0z=P0*np.power(M200c/1e14, P0_alpha_m)*np.power(1+z, P0_alpha_z)
     xcz=xc*np.power(M200c/1e14, xc_alpha_m)*np.power(1+z, xc_alpha_z)
@@ -645,6 +686,12 @@ def _paintSignalMap(shape, wcs, tckP, beam = None, RADeg = None, decDeg = None,
         Setting vmin arbitrarily small seems the best way to avoid unwanted behavior (e.g., cutting off
         clusters before they are painted in properly).
 
+    Notes:
+        If arrays of coordinates are given together with omap, all of the objects are painted directly
+        into omap with a single call to the object painter (see :func:`maps.makeModelImage`). In that
+        case, omap must be a float32 :obj:`pixell.enmap.ndmap`, or else the objects are painted into a new
+        map which is then added to omap.
+
     """
 
     # Now allowing arrays of sky coords and amplitudes (but one profile shape)
@@ -681,7 +728,24 @@ def _paintSignalMap(shape, wcs, tckP, beam = None, RADeg = None, decDeg = None,
     else:
         amps=np.array([amp], dtype = dtype)
 
-    if omap is not None:
+    if omap is not None and type(RADeg) == np.ndarray:
+        # Many objects with the same profile - no clipping, as the painter only touches pixels within rmax
+        if obsFrequencyGHz is not None:
+            amps=np.array(maps.convertToDeltaT(amps, obsFrequencyGHz = obsFrequencyGHz,
+                                               TCMBAlpha = TCMBAlpha, z = z), dtype = dtype)
+        if rprof[0] < 0:
+            amps=amps*-1
+        # The painter works on blocks of pixels, so rmax is not a hard limit - here the profile itself is
+        # truncated at maxSizeDeg (for single objects, clipping the map does this job)
+        tprof=np.where(r <= np.radians(maxSizeDeg), abs(rprof), 0)
+        if isinstance(omap, enmap.ndmap) and omap.dtype == dtype and omap.flags['C_CONTIGUOUS'] == True:
+            pointsrcs.sim_objects(shape, wcs.AWCS, poss, amps, (r, tprof), vmin = vmin,
+                                  rmax = np.radians(maxSizeDeg), pixwin = False, omap = omap)
+        else:
+            omap+=pointsrcs.sim_objects(shape, wcs.AWCS, poss, amps, (r, tprof), vmin = vmin,
+                                        rmax = np.radians(maxSizeDeg), pixwin = False)
+        return omap
+    elif omap is not None:
         ra1=RADeg-(maxSizeDeg/1.0)/np.cos(np.radians(decDeg))
         ra0=RADeg+(maxSizeDeg/1.0)/np.cos(np.radians(decDeg))
         dec1=decDeg-maxSizeDeg/1.0
@@ -904,6 +968,168 @@ def loadFRelWeights(fRelWeightsFileName):
     return fRelWeightsDict
 
 #------------------------------------------------------------------------------------------------------------
+@profiling.stage('fitQTile', contextArgs = {'tileName': 'tileName'})
+def _fitQTile(config, tileName, makeSignalModelMap, zRange, MRange, zDepQ):
+    """Calculates the filter mismatch function *Q* for a single tile (used by :func:`fitQ`). Model signal
+    maps for all of the given (z, M500) scales are painted into a stack, which is filtered in batches of
+    `QBatchSize` scales at a time (see :meth:`filters.MapFilter.applyFilterToStack`).
+
+    Args:
+        config (:obj:`startUp.NemoConfig`): A NemoConfig object.
+        tileName (:obj:`str`): Name of the tile.
+        makeSignalModelMap (:obj:`function`): Function used to paint model signal maps (e.g.,
+            :func:`makeArnaudModelSignalMap`).
+        zRange (:obj:`list`): Redshifts of the scales at which Q is calculated - the first entry must
+            correspond to the reference filter.
+        MRange (:obj:`list`): Masses (M500c, in MSun) of the scales at which Q is calculated.
+        zDepQ (:obj:`int`): 1 if Q depends on redshift, 0 otherwise.
+
+    Returns:
+        Table of Q (:obj:`astropy.table.Table`) for the tile, sorted by theta500Arcmin.
+
+    """
+
+    t0=time.time()
+    print("... fitting Q in tile %s" % (tileName))
+
+    # Load reference scale filter (it may be in memory already)
+    if tileName in config.cachedFilters.keys():
+        filterObj=config.cachedFilters[tileName]
+    else:
+        # Otherwise, can still get from disk
+        foundFilt=False
+        for filt in config.parDict['mapFilters']:
+            if filt['label'] == config.parDict['photFilter']:
+                foundFilt=True
+                break
+        if foundFilt == False:
+            raise Exception("couldn't find filter that matches photFilter")
+        filterClass=eval('filters.%s' % (filt['class']))
+        filterObj=filterClass(filt['label'], config.unfilteredMapsDictList, filt['params'], \
+                            tileName = tileName,
+                            diagnosticsDir = config.diagnosticsDir)
+        filterObj.loadFilter()
+
+    # Real space kernel or Fourier space filter?
+    if issubclass(filterObj.__class__, filters.RealSpaceMatchedFilter) == True:
+        realSpace=True
+    else:
+        realSpace=False
+
+    # Set-up the beams
+    beamsDict={}
+    for mapDict in config.parDict['unfilteredMaps']:
+        obsFreqGHz=mapDict['obsFreqGHz']
+        beamsDict[obsFreqGHz]=mapDict['beamFileName']
+
+    # Set centre coords
+    shape=filterObj.shape
+    wcs=filterObj.wcs
+    RADeg, decDeg=wcs.getCentreWCSCoords()
+    x, y=wcs.wcs2pix(RADeg, decDeg)
+
+    # Input signal maps to which we will apply the filter are painted into a stack, and filtered in batches
+    # NOTE: CCL can blow up for some of the extreme masses we try to feed in here
+    y0=2e-04
+    Q=[]
+    QTheta500Arcmin=[]
+    Qz=[]
+    scales=list(zip(zRange, MRange))
+    batchSize=config.parDict['QBatchSize']
+    for i in range(0, len(scales), batchSize):
+        batch=scales[i:i+batchSize]
+        signalMaps=np.zeros([len(batch), len(beamsDict), shape[0], shape[1]])
+        for j in range(len(batch)):
+            z, M500MSun=batch[j]
+            for k in range(len(beamsDict)):
+                obsFreqGHz=list(beamsDict.keys())[k]
+                if mapDict['obsFreqGHz'] is not None:   # Normal case
+                    amplitude=maps.convertToDeltaT(y0, obsFreqGHz)
+                else:                                   # TILe-C case
+                    amplitude=y0
+                # NOTE: Q is to adjust for mismatched filter shape
+                # Yes, this should have the beam in it (certainly for TILe-C)
+                signalMap=makeSignalModelMap(z, M500MSun, shape, wcs, beam = beamsDict[obsFreqGHz],
+                                             amplitude = amplitude, convolveWithBeam = True,
+                                             GNFWParams = config.parDict['GNFWParams'])
+                signalMaps[j, k]=enmap.apply_window(signalMap, pow = 1.0)
+        if realSpace == False:
+            signalMaps=enmap.fft(signalMaps)
+
+        # Filter maps with ref kernel
+        filteredSignals=filterObj.applyFilterToStack(signalMaps)
+        del signalMaps
+        for (z, M500MSun), filteredSignal in zip(batch, filteredSignals):
+            # Only the region around the centre is needed (fitting a spline to the whole map is slow)
+            peakFilteredSignal=photometry.MapInterpolator(filteredSignal)(y, x)
+            if peakFilteredSignal not in Q:
+                Q.append(peakFilteredSignal)
+                QTheta500Arcmin.append(calcTheta500Arcmin(z, M500MSun, getFiducialCosmoModel()))
+                Qz.append(z)
+        del filteredSignals
+    Q=np.array(Q)
+    if abs(1-Q[0]/y0) > 1e-6:
+        raise Exception("Q[0]/y0 outside tolerance")
+    Q=Q/y0
+
+    # Sort and make FITS table
+    QTab=atpy.Table()
+    QTab.add_column(atpy.Column(Q, 'Q'))
+    QTab.add_column(atpy.Column(QTheta500Arcmin, 'theta500Arcmin'))
+    QTab.add_column(atpy.Column(Qz, 'z'))
+    QTab.sort('theta500Arcmin')
+    QTab.meta['NEMOVER']=nemo.__version__
+    QTab.meta['ZDEPQ']=zDepQ
+    QTab.meta['TILENAME']=tileName
+    del Q, filterObj
+
+    return QTab
+
+#------------------------------------------------------------------------------------------------------------
+# Used to hand the config and options to worker processes in _fitQTilesInPool (inherited when forked)
+_QPoolState={}
+
+def _fitQTileInWorker(tileName):
+    """Worker process function used by :func:`_fitQTilesInPool`.
+
+    """
+    numRecords=len(profiling.getRecords())
+    QTab=_fitQTile(_QPoolState['config'], tileName, **_QPoolState['QOptions'])
+
+    return tileName, QTab, profiling.getRecords()[numRecords:]
+
+
+def _fitQTilesInPool(config, QOptions):
+    """Fits Q for each tile in a pool of `config.numProcesses` worker processes, for running in parallel on
+    a single machine without MPI.
+
+    Args:
+        config (:obj:`startUp.NemoConfig`): A NemoConfig object.
+        QOptions (:obj:`dict`): Keyword arguments for :func:`_fitQTile`.
+
+    Returns:
+        Dictionary of Q tables, indexed by tileName.
+
+    """
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise Exception("Running with numProcesses > 1 requires the 'fork' multiprocessing start method, which is not available on this platform.")
+    QTabDict={}
+    _QPoolState['config']=config
+    _QPoolState['QOptions']=QOptions
+    try:
+        context=multiprocessing.get_context('fork')
+        with context.Pool(processes = min(config.numProcesses, len(config.tileNames))) as pool:
+            for tileName, QTab, records in pool.imap_unordered(_fitQTileInWorker, config.tileNames, chunksize = 1):
+                QTabDict[tileName]=QTab
+                profiling.addRecords(records)
+    finally:
+        _QPoolState.clear()
+
+    return QTabDict
+
+#------------------------------------------------------------------------------------------------------------
+@profiling.stage('fitQ')
 def fitQ(config):
     """Calculates the filter mismatch function *Q* on a grid of scale sizes for each tile in the map. The
     results are combined into a single file written under the `selFn` directory.
@@ -918,7 +1144,7 @@ def fitQ(config):
         
     """
     
-    cosmoModel=fiducialCosmoModel
+    cosmoModel=getFiducialCosmoModel()
         
     # Spin through the filter kernels
     photFilterLabel=config.parDict['photFilter']
@@ -1007,143 +1233,14 @@ def fitQ(config):
     else:
         raise Exception("valid values for zDepQ are 0 or 1")
             
-    # Here we save the fit for each tile separately... 
-    QTabDict={}
-    for tileName in config.tileNames:
-        t0=time.time()
-        print("... fitting Q in tile %s" % (tileName))
-
-        # Load reference scale filter (it may be in memory already)
-        if tileName in config.cachedFilters.keys():
-            filterObj=config.cachedFilters[tileName]
-        else:
-            # Otherwise, can still get from disk
-            foundFilt=False
-            for filt in config.parDict['mapFilters']:
-                if filt['label'] == config.parDict['photFilter']:
-                    foundFilt=True
-                    break
-            if foundFilt == False:
-                raise Exception("couldn't find filter that matches photFilter")
-            filterClass=eval('filters.%s' % (filt['class']))
-            filterObj=filterClass(filt['label'], config.unfilteredMapsDictList, filt['params'], \
-                                tileName = tileName,
-                                diagnosticsDir = config.diagnosticsDir)
-            filterObj.loadFilter()
-        
-        # Real space kernel or Fourier space filter?
-        if issubclass(filterObj.__class__, filters.RealSpaceMatchedFilter) == True:
-            realSpace=True
-        else:
-            realSpace=False
-        
-        # Set-up the beams
-        beamsDict={}
-        for mapDict in config.parDict['unfilteredMaps']:
-            obsFreqGHz=mapDict['obsFreqGHz']
-            beamsDict[obsFreqGHz]=mapDict['beamFileName']
-
-        # Uncomment if debugging large scale Q business
-        #MRange=[MRange[-3]]
-        #zRange=[zRange[-3]]
-
-        # Actually measuring Q...
-        extMap=np.zeros(filterObj.shape, dtype = np.float32)
-        wcs=filterObj.wcs
-        nativeNPix=extMap.shape[0]*extMap.shape[1]
-        # Uncomment to pad signal maps [but then need to adjust normalization]
-        #extMap=enmap.enmap(extMap, wcs = wcs.AWCS)
-        #yZoom=signalMapSizeDeg/wcs.getFullSizeSkyDeg()[1]
-        #xZoom=signalMapSizeDeg/wcs.getFullSizeSkyDeg()[0]
-        #yPad=int(extMap.shape[0]*yZoom-extMap.shape[0])
-        #xPad=int(extMap.shape[1]*xZoom-extMap.shape[1])
-        #extMap=enmap.pad(extMap, (yPad, xPad))
-        #h=extMap.wcs.to_header()
-        #h.insert(0, ('NAXIS2', extMap.shape[0]))
-        #h.insert('NAXIS2', ('NAXIS1', extMap.shape[1]))
-        #wcs=astWCS.WCS(h, mode = 'pyfits')
-        #paddedNPix=extMap.shape[0]*extMap.shape[1]
-        # Set centre coords
-        shape=extMap.shape
-        RADeg, decDeg=wcs.getCentreWCSCoords()
-        x, y=wcs.wcs2pix(RADeg, decDeg)
-
-        # For testing effects of adding CMB + noise
-        #simCMBDict={}
-        #seed=1234
-        #noiseLevel=120.0
-        #for obsFreqGHz in list(beamsDict.keys()):
-            #simCMBDict[obsFreqGHz]=maps.simCMBMap(shape, wcs, noiseLevel = noiseLevel, beam = beamsDict[obsFreqGHz], seed = seed)
-        #print("... adding CMB and noise = %.3f in Q models" % (noiseLevel))
-
-        # Input signal maps to which we will apply filter(s)
-        # We do this once and store in a dictionary for speed
-        theta500ArcminDict={}
-        signalMap=np.zeros(shape, dtype = np.float32)
-        Q=[]
-        QTheta500Arcmin=[]
-        Qz=[]
-        cubeStore={} # For debugging object painting
-        for obsFreqGHz in list(beamsDict.keys()):
-            cubeStore[obsFreqGHz]=[]
-        for z, M500MSun in zip(zRange, MRange):
-            key='%.2f_%.2f' % (z, np.log10(M500MSun))
-            signalMaps=[]
-            fSignalMaps=[]
-            y0=2e-04
-            for obsFreqGHz in list(beamsDict.keys()):
-                if mapDict['obsFreqGHz'] is not None:   # Normal case
-                    amplitude=maps.convertToDeltaT(y0, obsFreqGHz)
-                else:                                   # TILe-C case
-                    amplitude=y0
-                # NOTE: Q is to adjust for mismatched filter shape
-                # Yes, this should have the beam in it (certainly for TILe-C)
-                # NOTE: CCL can blow up for some of the extreme masses we try to feed in here
-                # (so we just skip those if it happens)
-                # try:
-                signalMap=makeSignalModelMap(z, M500MSun, shape, wcs, beam = beamsDict[obsFreqGHz],
-                                             amplitude = amplitude, convolveWithBeam = True,
-                                             GNFWParams = config.parDict['GNFWParams'])
-                signalMap=enmap.apply_window(signalMap, pow = 1.0)
-                # except:
-                #     continue
-                #signalMap=signalMap+simCMBDict[obsFreqGHz]
-                #signalMap=signalMap+np.random.normal(0, noiseLevel, signalMap.shape)
-                #cubeStore[obsFreqGHz].append(signalMap)
-                if realSpace == True:
-                    signalMaps.append(signalMap)
-                else:
-                    signalMaps.append(enmap.fft(signalMap))
-            signalMaps=np.array(signalMaps)
-            # Filter maps with ref kernel
-            if len(signalMaps) == len(list(beamsDict.keys())):
-                filteredSignal=filterObj.applyFilter(signalMaps)
-                mapInterpolator=interpolate.RectBivariateSpline(np.arange(filteredSignal.shape[0]),
-                                                                np.arange(filteredSignal.shape[1]),
-                                                                filteredSignal, kx = 3, ky = 3)
-                peakFilteredSignal=mapInterpolator(y, x)[0][0]
-                # Below is if we wanted to simulate object-finding here
-                #peakFilteredSignal=filteredSignal[int(y)-10:int(y)+10, int(x)-10:int(x)+10].max() # Avoids mess at edges
-                if peakFilteredSignal not in Q:
-                    Q.append(peakFilteredSignal)
-                    QTheta500Arcmin.append(calcTheta500Arcmin(z, M500MSun, fiducialCosmoModel))
-                    Qz.append(z)
-        Q=np.array(Q)
-        if abs(1-Q[0]/y0) > 1e-6:
-            raise Exception("Q[0]/y0 outside tolerance")
-        Q=Q/y0
-
-        # Sort and make FITS table
-        QTab=atpy.Table()
-        QTab.add_column(atpy.Column(Q, 'Q'))
-        QTab.add_column(atpy.Column(QTheta500Arcmin, 'theta500Arcmin'))
-        QTab.add_column(atpy.Column(Qz, 'z'))
-        QTab.sort('theta500Arcmin')
-        QTab.meta['NEMOVER']=nemo.__version__
-        QTab.meta['ZDEPQ']=zDepQ
-        QTab.meta['TILENAME']=tileName
-        QTabDict[tileName]=QTab
-        del Q, filterObj #, clipDict
+    # Here we save the fit for each tile separately...
+    QOptions={'makeSignalModelMap': makeSignalModelMap, 'zRange': zRange, 'MRange': MRange, 'zDepQ': zDepQ}
+    if config.numProcesses > 1 and len(config.tileNames) > 1:
+        QTabDict=_fitQTilesInPool(config, QOptions)
+    else:
+        QTabDict={}
+        for tileName in config.tileNames:
+            QTabDict[tileName]=_fitQTile(config, tileName, **QOptions)
 
     if config.MPIEnabled == True:
         QTabDictList=config.comm.gather(QTabDict, root = 0)
@@ -1554,6 +1651,209 @@ def calcPMass(y0, y0Err, z, zErr, QFit, mockSurvey, tenToA0 = 4.95e-5, B0 = 0.08
     # else:
     return P
 
+#------------------------------------------------------------------------------------------------------------
+def calcPMassBatch(y0, y0Err, z, zErr, QFit, mockSurvey, tenToA0 = 4.95e-5, B0 = 0.08, Mpivot = 3e14,
+                   sigma_int = 0.2, Ez_gamma = 2, onePlusRedshift_power = 0.0, applyMFDebiasCorrection = True,
+                   applyRelativisticCorrection = True, tileNames = None):
+    """Batched version of :func:`calcPMass`, which calculates P(M) for many objects at once (e.g., whole
+    catalog columns).
+
+    Objects (and, for objects with redshift errors, the points on the redshift grid used to marginalise
+    over the redshift uncertainty) are grouped by the nearest point in the mockSurvey redshift grid, and by
+    tile. The mass function prior, *Q*, and relativistic correction are evaluated once per group, and the
+    likelihoods for all objects in the group are evaluated together as 2d arrays.
+
+    Args:
+        y0 (:obj:`np.ndarray`): Measured ỹ\ :sub:`0` values (not in units of 1e-4).
+        y0Err (:obj:`np.ndarray`): Uncertainties on `y0`.
+        z (:obj:`np.ndarray`): Redshifts.
+        zErr (:obj:`np.ndarray`): Redshift uncertainties. Values < 0.01 are treated as zero.
+        QFit (:obj:`nemo.signals.QFit`): Object that handles the filter mismatch function, *Q*.
+        mockSurvey (:obj:`nemo.MockSurvey.MockSurvey`): Used for the mass function and cosmology.
+        tileNames (:obj:`np.ndarray`, optional): Names of the tiles in which objects are found, used for *Q*.
+
+    Returns:
+        2d array of P(log10M), with one row per object, on the mockSurvey log10M grid.
+
+    Note:
+        Unlike :func:`calcPMass`, which uses the exact redshift of objects without redshift errors for the
+        mass function prior and *Q*, these are evaluated at the nearest point in the mockSurvey redshift
+        grid here. The other redshift-dependent quantities already use that grid in :func:`calcPMass`.
+
+    """
+
+    y0=np.atleast_1d(np.array(y0, dtype = np.float64))
+    y0Err=np.atleast_1d(np.array(y0Err, dtype = np.float64))
+    z=np.atleast_1d(np.array(z, dtype = np.float64))
+    zErr=np.atleast_1d(np.array(zErr, dtype = np.float64))
+    zErr[zErr < 0.01]=0.0 # Ignore tiny z errors, unless we really want to use very fine z binning
+    numObjects=len(y0)
+    if tileNames is None:
+        tileNames=np.array([None]*numObjects, dtype = object)
+    else:
+        tileNames=np.array(tileNames, dtype = object)
+    log10Ms=mockSurvey.log10M
+    zGrid=mockSurvey.z
+
+    # Redshift points: either the object redshift, or grid points within +/- 5 sigma for photo-zs
+    objIndices=[]
+    zPoints=[]
+    zWeights=[]
+    specZ=np.where(zErr == 0)[0]
+    objIndices.append(specZ)
+    zPoints.append(z[specZ])
+    zWeights.append(np.ones(len(specZ)))
+    photZ=np.where(zErr > 0)[0]
+    if len(photZ) > 0:
+        first=np.searchsorted(zGrid, z[photZ]-zErr[photZ]*5, side = 'left')
+        last=np.searchsorted(zGrid, z[photZ]+zErr[photZ]*5, side = 'left')
+        counts=last-first
+        pointObj=np.repeat(photZ, counts)
+        pointGrid=np.repeat(first-np.cumsum(np.concatenate([[0], counts[:-1]])), counts)+np.arange(counts.sum())
+        zRange=zGrid[pointGrid]
+        Pz=np.exp(-np.power(z[pointObj]-zRange, 2)/(2*(np.power(zErr[pointObj], 2))))
+        # Trapezoid rule normalisation for each object, over its own points
+        sameObj=pointObj[1:] == pointObj[:-1]
+        trapTerms=np.where(sameObj, (Pz[1:]+Pz[:-1])/2*(zRange[1:]-zRange[:-1]), 0)
+        norm=np.zeros(numObjects)
+        np.add.at(norm, pointObj[:-1], trapTerms)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            Pz=Pz/norm[pointObj]
+        objIndices.append(pointObj)
+        zPoints.append(zRange)
+        zWeights.append(Pz)
+    objIndices=np.concatenate(objIndices)
+    zPoints=np.concatenate(zPoints)
+    zWeights=np.concatenate(zWeights)
+
+    # Nearest point in the z grid (lower one on ties, as np.argmin would give)
+    zIndices=np.clip(np.searchsorted(zGrid, zPoints), 1, len(zGrid)-1)
+    zIndices=zIndices-(abs(zPoints-zGrid[zIndices-1]) <= abs(zPoints-zGrid[zIndices]))
+
+    log_y0=np.log(y0)
+    log_y0Err=y0Err/y0
+    P=np.zeros([numObjects, len(log10Ms)])
+    for zIndex in np.unique(zIndices):
+        zk=zGrid[zIndex]
+        zMask=zIndices == zIndex
+        if mockSurvey.delta != 500 or mockSurvey.rhoType != "critical":
+            log10M500c_zk=np.log10(mockSurvey._transToM500c(mockSurvey.cosmoModel, np.power(10, log10Ms), 1/(1+zk)))
+        else:
+            log10M500c_zk=log10Ms
+        theta500s=interpolate.splev(log10M500c_zk, mockSurvey.theta500Splines[zIndex], ext = 3)
+        fRels=interpolate.splev(log10M500c_zk, mockSurvey.fRelSplines[zIndex], ext = 3)
+        fRels[np.less_equal(fRels, 0)]=1e-4   # For extreme masses (> 10^16 MSun) at high-z, this can dip -ve
+        if applyMFDebiasCorrection == True:
+            PLog10M=mockSurvey.getPLog10M(zk)
+            PLog10M=PLog10M/integrate.trapezoid(PLog10M, log10Ms)
+        else:
+            PLog10M=np.ones(len(log10Ms))
+        for tileName in np.unique(tileNames[objIndices[zMask]]):
+            groupMask=np.logical_and(zMask, tileNames[objIndices] == tileName)
+            Qs=QFit.getQ(theta500s, zk, tileName = tileName)
+            y0predBase=tenToA0*np.power(mockSurvey.Ez[zIndex], Ez_gamma)*np.power(np.power(10, log10Ms)/Mpivot, 1+B0)*Qs
+            if applyRelativisticCorrection == True:
+                y0predBase=y0predBase*fRels
+            valid=y0predBase > 0
+            if valid.sum() == 0:
+                continue
+            objs=objIndices[groupMask]
+            y0pred=y0predBase[valid][np.newaxis, :]*np.power(1+zPoints[groupMask], onePlusRedshift_power)[:, np.newaxis]
+            Py0GivenM=np.exp(-np.power(log_y0[objs][:, np.newaxis]-np.log(y0pred), 2)/(2*(np.power(log_y0Err[objs][:, np.newaxis], 2)+np.power(sigma_int, 2))))
+            Py0GivenM=Py0GivenM/integrate.trapezoid(Py0GivenM, log10Ms[valid], axis = 1)[:, np.newaxis]
+            # Each object appears at most once per group, so this is safe without np.add.at
+            P[objs[:, np.newaxis], np.where(valid)[0][np.newaxis, :]]+=Py0GivenM*PLog10M[valid]*zWeights[groupMask][:, np.newaxis]
+
+    # Marginalised over z uncertainty
+    P=P/integrate.trapezoid(P, log10Ms, axis = 1)[:, np.newaxis]
+
+    return P
+
+#------------------------------------------------------------------------------------------------------------
+def getMassFromPBatch(P, log10M, calcErrors = True, numFinePoints = 10000, maxChunkSize = 2**18):
+    """Batched version of :func:`getMassFromP`. Returns MDelta as the maximum likelihood value from each row of
+    the given 2d P(log10M) array, together with 1-sigma error bars, using the same fine grid and error bar
+    definition, but finding the credible intervals with cumulative sums rather than a loop.
+
+    Args:
+        P (:obj:`np.ndarray`): 2d array of P(log10M), one row per object (as from :func:`calcPMassBatch`).
+        log10M (:obj:`np.ndarray`): The log10 mass grid corresponding to the columns of `P`.
+        calcErrors (:obj:`bool`, optional): If False, error bars are set to zero.
+        numFinePoints (:obj:`int`, optional): Number of points in the fine mass grid used for finding the
+            maximum likelihood mass and error bars.
+        maxChunkSize (:obj:`int`, optional): Maximum number of array elements to process at once, used to
+            bound memory usage. Objects are processed in chunks of ``maxChunkSize // numFinePoints`` rows
+            (at least one), so that no intermediate array is larger than this (the default corresponds to
+            2 MB per array).
+
+    Returns:
+        Arrays of MDelta, -MDeltaErr, +MDeltaErr (units of 1e14 MSun).
+
+    """
+
+    P=np.atleast_2d(P)
+    numObjects=P.shape[0]
+    MDelta=np.zeros(numObjects)
+    errMinus=np.zeros(numObjects)
+    errPlus=np.zeros(numObjects)
+    fineLog10M=np.linspace(log10M.min(), log10M.max(), numFinePoints)
+    chunkSize=max(1, maxChunkSize // numFinePoints)
+    for start in range(0, numObjects, chunkSize):
+        end=min(start+chunkSize, numObjects)
+        fineP=interpolate.make_interp_spline(log10M, P[start:end], k = 3, axis = 1)(fineLog10M)
+        fineP=fineP/integrate.trapezoid(fineP, fineLog10M, axis = 1)[:, np.newaxis]
+        index=np.argmax(fineP, axis = 1)
+        logM=fineLog10M[index]
+        MDelta[start:end]=np.power(10, logM)/1e14
+        if calcErrors == False:
+            continue
+        # Probability within fineLog10M[index-n:index+n] is cumP[index+n-1]-cumP[index-n] for n > 0
+        cumP=integrate.cumulative_trapezoid(fineP, fineLog10M, axis = 1, initial = 0)
+        del fineP
+        maxN=np.minimum(index, numFinePoints-index)
+        n=np.arange(1, numFinePoints//2+2)
+        p=np.take_along_axis(cumP, np.clip(index[:, np.newaxis]+n[np.newaxis, :]-1, 0, numFinePoints-1), axis = 1)
+        p-=np.take_along_axis(cumP, np.clip(index[:, np.newaxis]-n[np.newaxis, :], 0, numFinePoints-1), axis = 1)
+        found=np.logical_and(n[np.newaxis, :] <= maxN[:, np.newaxis], p >= 0.6827)
+        del cumP, p
+        hasErrors=found.any(axis = 1)
+        nFound=n[np.argmax(found, axis = 1)]
+        logMMin=fineLog10M[np.clip(index-nFound, 0, numFinePoints-1)]
+        logMMax=fineLog10M[np.clip(index+nFound, 0, numFinePoints-1)]
+        errMinus[start:end]=np.where(hasErrors, (np.power(10, logM)-np.power(10, logMMin))/1e14, 0.)
+        errPlus[start:end]=np.where(hasErrors, (np.power(10, logMMax)-np.power(10, logM))/1e14, 0.)
+
+    return MDelta, errMinus, errPlus
+
+#------------------------------------------------------------------------------------------------------------
+def inferClusterMassesBatch(y0, y0Err, z, zErr, QFit, mockSurvey, tenToA0 = 4.95e-5, B0 = 0.08, Mpivot = 3e14,
+                            sigma_int = 0.2, Ez_gamma = 2, onePlusRedshift_power = 0.0,
+                            applyMFDebiasCorrection = True, applyRelativisticCorrection = True,
+                            calcErrors = True, tileNames = None):
+    """Batched version of the mass inference done by :func:`inferClusterProperties`, for whole catalog
+    columns (see :func:`calcPMassBatch` and :func:`getMassFromPBatch`). SZ properties are not inferred.
+
+    Returns:
+        Dictionary with keys MDelta, MDelta_errPlus, MDelta_errMinus (where e.g., MDelta = M500c,
+        following the mass definition of `mockSurvey`), each containing an array with one entry per object.
+
+    """
+
+    y0=np.atleast_1d(np.array(y0, dtype = np.float64))
+    if np.any(y0 < 0):
+        raise Exception('y0 cannot be negative')
+    if np.any(y0 > 1e-2):
+        raise Exception('y0 is suspiciously large - probably you need to multiply by 1e-4')
+
+    P=calcPMassBatch(y0, y0Err, z, zErr, QFit, mockSurvey, tenToA0 = tenToA0, B0 = B0, Mpivot = Mpivot,
+                     sigma_int = sigma_int, Ez_gamma = Ez_gamma, onePlusRedshift_power = onePlusRedshift_power,
+                     applyMFDebiasCorrection = applyMFDebiasCorrection,
+                     applyRelativisticCorrection = applyRelativisticCorrection, tileNames = tileNames)
+    MDelta, errMDeltaMinus, errMDeltaPlus=getMassFromPBatch(P, mockSurvey.log10M, calcErrors = calcErrors)
+    label=mockSurvey.mdefLabel
+
+    return {'%s' % (label): MDelta, '%s_errPlus' % (label): errMDeltaPlus, '%s_errMinus' % (label): errMDeltaMinus}
+
 #------------------------------------------------------------------------------------------------------------
 def getMLValueFromP(P, x, calcErrors = True):
     """Returns the maximum likelihood value from the given P(x) distribution, together with
@@ -8,6 +8,7 @@ in bin/ (nemo, nemoMass, nemoSelFn etc.).
 import os
 import sys
 import yaml
+import json
 import copy
 import astropy.io.fits as pyfits
 import astropy.table as atpy
@@ -17,6 +18,7 @@ import numpy as np
 import pickle
 import time
 from . import maps
+from . import profiling
 
 #------------------------------------------------------------------------------------------------------------
 def parseConfigFile(parDictFileName, verbose = False):
@@ -122,8 +124,26 @@ def parseConfigFile(parDictFileName, verbose = False):
         # By default, undo the pixel window function
         if 'undoPixelWindow' not in parDict.keys():
             parDict['undoPixelWindow']=True
+        # On-disk cache of filters keyed by their inputs (disabled by default)
+        if 'filterCacheDir' not in parDict.keys():
+            parDict['filterCacheDir']=None
+        if parDict['filterCacheDir'] is not None:
+            parDict['filterCacheDir']=os.path.abspath(parDict['filterCacheDir'])
+        # Number of worker processes to use for filtering tiles when not running under MPI
+        if 'numProcesses' not in parDict.keys():
+            parDict['numProcesses']=1
+        # How tiles are shared out among MPI processes
+        if 'tileScheduler' not in parDict.keys():
+            parDict['tileScheduler']='static'
+        if parDict['tileScheduler'] not in ['static', 'dynamic']:
+            raise Exception("Valid tile schedulers are 'static' or 'dynamic' - edit tileScheduler in config.")
         if 'fitQ' not in parDict.keys():
             parDict['fitQ']=False
+        # Number of model signal maps filtered at once when fitting Q (higher is faster, but uses more memory)
+        if 'QBatchSize' not in parDict.keys():
+            parDict['QBatchSize']=16
+        if parDict['QBatchSize'] < 1:
+            raise Exception("QBatchSize must be >= 1")
         if 'calcSelFn' not in parDict.keys():
             parDict['calcSelFn']=False
         # We need a better way of giving defaults than this...
@@ -138,6 +158,8 @@ def parseConfigFile(parDictFileName, verbose = False):
                 parDict['selFnOptions']['QSource']='injection'
         if 'selFnOptions' in parDict.keys() and 'maxFlags' not in parDict['selFnOptions'].keys():
             parDict['selFnOptions']['maxFlags']=None
+        if 'selFnOptions' in parDict.keys() and 'RMSQuantizationStep' not in parDict['selFnOptions'].keys():
+            parDict['selFnOptions']['RMSQuantizationStep']=None
         # Check of tile definitions
         if 'useTiling' not in list(parDict.keys()):
             parDict['useTiling']=False
@@ -173,6 +195,11 @@ def parseConfigFile(parDictFileName, verbose = False):
         # Applies to source injection recover sims only (whether print message or trigger exception)
         if 'haltOnPositionRecoveryProblem' not in parDict.keys():
             parDict['haltOnPositionRecoveryProblem']=False
+        # Source injection sims: filter only the injected sources and add to the filtered real maps
+        if 'sourceInjectionIncremental' not in parDict.keys():
+            parDict['sourceInjectionIncremental']=False
+        if 'sourceInjectionBatchSize' not in parDict.keys():
+            parDict['sourceInjectionBatchSize']=8
         # Mass/scaling relation/cosmology options - set fiducial values here if not chosen in config
         # NOTE: We SHOULD use M200c not M500c here (to avoid CCL Tinker08 problem)
         # But we don't, currently, as old runs/tests used M500c and Arnaud-like scaling relation
@@ -228,12 +255,14 @@ class NemoConfig(object):
         comm (:obj:`MPI.COMM_WORLD`): Used by MPI.
         rank (:obj:`int`): Used by MPI.
         size (:obj:`int`): Used by MPI.
+        numProcesses (:obj:`int`): Number of worker processes used for filtering tiles when not using MPI.
     
     """
     
     def __init__(self, config, makeOutputDirs = True, setUpMaps = True, writeTileInfo = False,
                  selFnDir = None, calcSelFn = False, sourceInjectionTest = False, MPIEnabled = False,
-                 divideTilesByProcesses = True, verbose = True, strictMPIExceptions = True):
+                 divideTilesByProcesses = True, verbose = True, strictMPIExceptions = True,
+                 numProcesses = None):
         """Creates an object that manages Nemo's configuration (paths to maps, output directories,
         filter settings etc.).
         
@@ -263,6 +292,9 @@ class NemoConfig(object):
                 are a compromise due to how mpi4py handles MPI errors (the default handling for mpi4py 
                 corresponds to strictMPIExceptions = False).
             verbose (:obj:`bool`): If True, print some info to the terminal while we set-up the config file.
+            numProcesses (:obj:`int`, optional): If greater than 1, filter tiles in a pool of this many worker
+                processes on the local machine (this cannot be used together with MPI). This overrides the
+                value of `numProcesses` given in the config file.
     
         """
         self.MPIEnabled=MPIEnabled
@@ -296,6 +328,7 @@ class NemoConfig(object):
         # Timekeeping for benchmarking
         if self.rank == 0:
             self._timeStarted=time.time()
+        profiling.reset()
 
         if type(config) == str:
             self.parDict=parseConfigFile(config, verbose = self.verbose)
@@ -312,6 +345,18 @@ class NemoConfig(object):
         if sourceInjectionTest == True:
             self.parDict['sourceInjectionTest']=True
 
+        # Optional pool of worker processes (for running in parallel on one machine without MPI)
+        if numProcesses is None:
+            if 'numProcesses' in self.parDict.keys() and self.MPIEnabled == False:
+                numProcesses=self.parDict['numProcesses']
+            else:
+                numProcesses=1
+        self.numProcesses=int(numProcesses)
+        if self.numProcesses < 1:
+            raise Exception("numProcesses must be >= 1")
+        if self.numProcesses > 1 and self.MPIEnabled == True:
+            raise Exception("numProcesses > 1 cannot be used together with MPI - use one or the other")
+
         # We want the original map WCS and shape (for using stitchMaps later)
         try:
             with pyfits.open(self.parDict['unfilteredMaps'][0]['mapFileName']) as img:
@@ -430,6 +475,22 @@ class NemoConfig(object):
             if self.rank == 0 and verbose == True:
                 print(">>> Total tiles = %d ; total processes = %d ; balanced number of processes = %d" % (len(self.allTileNames), self.size, balancedNumProcesses))
 
+        # MPI: Optionally hand out tiles to processes as they become free (see iterTileNames), rather than
+        # using the static division above - which is kept for any stages that don't use the scheduler
+        self.tileScheduler='static'
+        if 'tileScheduler' in self.parDict.keys():
+            self.tileScheduler=self.parDict['tileScheduler']
+        self._scheduleTiles=False
+        self._tilesScheduled=False
+        if self.MPIEnabled == True and divideTilesByProcesses == True and self.tileScheduler == 'dynamic':
+            self._scheduleTiles=True
+            if self.rank == 0 and verbose == True:
+                print(">>> Using dynamic tile scheduler")
+
+        # Time taken to process each tile, by filter - used to order the queue in the dynamic scheduler
+        self.tileTimings={}
+        self.tileTimingsPath=self.diagnosticsDir+os.path.sep+"tileTimings.json"
+
         # # MPI: just divide up tiles pointed at by tileNames among processes
         # if self.MPIEnabled == True and divideTilesByProcesses == True:
         #     # New - bit clunky but distributes more evenly
@@ -452,7 +513,11 @@ class NemoConfig(object):
         # We're now writing items per tile into their own dir (friendlier for Lustre)
         # NOTE: No longer writing individual tile filtered maps - only stitched versions
         if makeOutputDirs == True:
-            for tileName in self.tileNames:
+            if self._scheduleTiles == True:
+                dirTileNames=self.allTileNames
+            else:
+                dirTileNames=self.tileNames
+            for tileName in dirTileNames:
                 for d in [self.diagnosticsDir, self.selFnDir]:
                     os.makedirs(d+os.path.sep+tileName, exist_ok = True)
 
@@ -468,6 +533,131 @@ class NemoConfig(object):
             print((">>> rank = %d [PID = %d]: tileNames = %s" % (self.rank, os.getpid(), str(self.tileNames))))
   
   
+    def iterTileNames(self):
+        """Iterates over the tiles that this process should work on.
+
+        If the dynamic tile scheduler is enabled (`tileScheduler: 'dynamic'` in the config file, when
+        running under MPI), tiles are handed out one at a time from a queue shared by all processes, as each
+        process becomes free. The queue is held in an MPI window on rank 0, so rank 0 also processes tiles,
+        and is ordered by decreasing expected cost (see :meth:`getTileQueue`). Once the queue is exhausted,
+        `tileNames` is set to the list of tiles processed by this process, so that later stages run on
+        the same tiles (and can use, e.g., `cachedFilters`). Tiles are only scheduled like this on the first
+        call - later calls (e.g., in source injection or multi-pass runs) re-use the same assignment of tiles
+        to processes. This must be called by all processes.
+
+        Otherwise, this simply iterates over `tileNames`.
+
+        Yields:
+            Tile names (:obj:`str`).
+
+        """
+
+        if self._scheduleTiles == False or self._tilesScheduled == True:
+            for tileName in self.tileNames:
+                yield tileName
+            return
+
+        from mpi4py import MPI
+        queue=self.getTileQueue()
+        if self.rank == 0:
+            counter=np.zeros(1, dtype = np.int64)
+        else:
+            counter=np.zeros(0, dtype = np.int64)
+        win=MPI.Win.Create(counter, disp_unit = counter.itemsize, comm = self.comm)
+        increment=np.ones(1, dtype = np.int64)
+        index=np.zeros(1, dtype = np.int64)
+        processed=[]
+        try:
+            while True:
+                win.Lock(0)
+                win.Fetch_and_op(increment, index, 0, 0, MPI.SUM)
+                win.Unlock(0)
+                if index[0] >= len(queue):
+                    break
+                processed.append(queue[index[0]])
+                yield queue[index[0]]
+        finally:
+            win.Free()
+        self.tileNames=processed
+        self._tilesScheduled=True
+
+
+    def getTileQueue(self):
+        """Returns the list of all tiles to be processed, sorted in order of decreasing expected cost, so
+        that the most expensive tiles are started first when using the dynamic tile scheduler.
+
+        Costs are taken from the timings recorded in previous runs (see :meth:`saveTileTimings`) where
+        available. Otherwise, costs are estimated from the number of pixels in each tile (scaled by the
+        median time taken per pixel for the tiles that do have timings).
+
+        Returns:
+            List of tile names.
+
+        """
+
+        if self.rank == 0:
+            tileNames=list(self.allTileNames)
+            numPix=np.array([max(self.tileCoordsDict[tileName]['numPix'], 1) for tileName in tileNames], dtype = float)
+            costs=numPix.copy()
+            timings=self.loadTileTimings()
+            timed=np.array([tileName in timings.keys() for tileName in tileNames], dtype = bool)
+            if timed.sum() > 0:
+                timedCosts=np.array([sum(timings[tileName].values()) for tileName in np.array(tileNames)[timed]])
+                costs=numPix*np.median(timedCosts/numPix[timed])
+                costs[timed]=timedCosts
+            queue=[tileNames[i] for i in np.argsort(-costs, kind = 'stable')]
+        else:
+            queue=None
+        if self.MPIEnabled == True:
+            queue=self.comm.bcast(queue, root = 0)
+
+        return queue
+
+
+    def loadTileTimings(self):
+        """Loads the per-tile, per-filter timings (in seconds) saved by previous runs.
+
+        Returns:
+            Dictionary of timings, indexed by tileName and then filter label (empty if none were found).
+
+        """
+
+        if os.path.exists(self.tileTimingsPath) == False:
+            return {}
+        try:
+            with open(self.tileTimingsPath, "r") as inFile:
+                timings=json.load(inFile)
+        except ValueError:
+            timings={}
+
+        return timings
+
+
+    def saveTileTimings(self):
+        """Gathers the per-tile, per-filter timings in `tileTimings` from all processes and merges them into
+        the file at `tileTimingsPath` (written by rank 0), for ordering the dynamic tile scheduler queue in
+        later runs. This must be called by all processes.
+
+        """
+
+        if self.MPIEnabled == True:
+            gatheredTimings=self.comm.gather(self.tileTimings, root = 0)
+        else:
+            gatheredTimings=[self.tileTimings]
+        if self.rank == 0:
+            timings=self.loadTileTimings()
+            for rankTimings in gatheredTimings:
+                for tileName in rankTimings.keys():
+                    if tileName not in timings.keys():
+                        timings[tileName]={}
+                    timings[tileName].update(rankTimings[tileName])
+            os.makedirs(self.diagnosticsDir, exist_ok = True)
+            tmpPath=self.tileTimingsPath+".tmp"
+            with open(tmpPath, "w") as outFile:
+                json.dump(timings, outFile, indent = 1, sort_keys = True)
+            os.replace(tmpPath, self.tileTimingsPath)
+
+
     def _identifyFilterSets(self):
         """Inspect the config dictionary to identify filter sets, which are used in multi-pass map filtering
         and object detection.
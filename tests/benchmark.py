@@ -0,0 +1,373 @@
+"""
+
+Performance benchmarks for nemo, run on synthetic maps that are generated offline.
+
+This times the main stages of a nemo run (filtering with the filters built from scratch, filtering with the
+filters loaded from the cache, object finding, making the optimal catalog, and making the RMS tables), using
+a point source search with a beam matched filter. Results are written in JSON format, so that they can be
+compared between commits, e.g.,
+
+.. code-block::
+
+   python benchmark.py -s small -o before.json
+   git checkout <some other commit>
+   python benchmark.py -s small -o after.json -c before.json
+
+The pipeline stage timings are taken from the profile report written by the nemo command (see
+nemo.profiling). The synthetic maps (CMB + white noise + point sources) are cached in the work directory,
+and only re-made if the map settings change.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import argparse
+import yaml
+import numpy as np
+import astropy.io.fits as pyfits
+import astropy.table as atpy
+from astLib import *
+
+thisDir=os.path.dirname(os.path.abspath(__file__))
+rootDir=os.path.dirname(thisDir)
+sys.path.insert(0, rootDir)
+
+import nemo
+from nemo import maps
+
+# Preset map sizes (width, height in degrees; number of tiles)
+# NOTE: The autotiler ignores regions less than 1000 pixels tall, so tiled maps must be > 8.5 deg tall
+sizesDict={'small': {'widthDeg': 9.0, 'heightDeg': 9.0, 'numTiles': 4},
+           'medium': {'widthDeg': 18.0, 'heightDeg': 9.0, 'numTiles': 8},
+           'large': {'widthDeg': 36.0, 'heightDeg': 18.0, 'numTiles': 32}}
+
+pixScaleDeg=0.5/60.0
+borderDeg=0.1
+obsFreqGHz=149.6
+beamFWHMArcmin=1.4
+
+#------------------------------------------------------------------------------------------------------------
+def makeSyntheticSurvey(workDir, widthDeg, heightDeg, numSources, noiseLevel = 20.0, seed = 1234):
+    """Makes a synthetic survey in workDir - a map (CMB + white noise + point sources, in uK), a survey
+    mask, a Gaussian beam profile, and a catalog of the input point sources.
+
+    """
+
+    # CAR projection, with RA increasing from 10 deg and dec centred on the equator
+    RAMin=10.0
+    shape=(int(round(heightDeg/pixScaleDeg)), int(round(widthDeg/pixScaleDeg)))
+    header=pyfits.Header()
+    header['NAXIS']=2
+    header['NAXIS1']=shape[1]
+    header['NAXIS2']=shape[0]
+    header['CTYPE1']='RA---CAR'
+    header['CTYPE2']='DEC--CAR'
+    header['CRVAL1']=0.0
+    header['CRVAL2']=0.0
+    header['CDELT1']=-pixScaleDeg
+    header['CDELT2']=pixScaleDeg
+    header['CRPIX1']=1+(RAMin+widthDeg)/pixScaleDeg
+    header['CRPIX2']=1+(heightDeg/2.0)/pixScaleDeg
+    header['CUNIT1']='deg'
+    header['CUNIT2']='deg'
+    wcs=astWCS.WCS(header, mode = 'pyfits')
+
+    # Survey mask - with a border, so that objects aren't found at the map edges
+    borderPix=int(round(borderDeg/pixScaleDeg))
+    mask=np.zeros(shape, dtype = np.uint8)
+    mask[borderPix:-borderPix, borderPix:-borderPix]=1
+    maps.saveFITS(workDir+os.path.sep+"mask.fits", mask, wcs, compressionType = 'PLIO_1')
+
+    # Gaussian beam
+    beamFileName=workDir+os.path.sep+"beam_f150.txt"
+    rDeg=np.linspace(0, 0.5, 2000)
+    sigmaDeg=(beamFWHMArcmin/60.0)/np.sqrt(8*np.log(2))
+    np.savetxt(beamFileName, np.array([rDeg, np.exp(-rDeg**2/(2*sigmaDeg**2))]).transpose())
+
+    # Point sources
+    rng=np.random.default_rng(seed)
+    marginDeg=0.5
+    RADeg, decDeg=[], []
+    while len(RADeg) < numSources:
+        RA=rng.uniform(RAMin+marginDeg, RAMin+widthDeg-marginDeg)
+        dec=rng.uniform(-heightDeg/2.0+marginDeg, heightDeg/2.0-marginDeg)
+        x, y=wcs.wcs2pix(RA, dec)
+        if mask[int(round(y)), int(round(x))] == 1:
+            RADeg.append(RA)
+            decDeg.append(dec)
+    tab=atpy.Table()
+    tab['name']=['BENCH-S %04d' % (i) for i in range(numSources)]
+    tab['RADeg']=RADeg
+    tab['decDeg']=decDeg
+    tab['deltaT_c']=np.round(rng.uniform(200.0, 2000.0, numSources), 1)
+    tab.write(workDir+os.path.sep+"inputSources.fits", overwrite = True)
+
+    # Sky
+    skyMap=maps.simCMBMap(shape, wcs, beam = beamFileName, seed = seed)
+    skyMap=skyMap+maps.simNoiseMap(shape, noiseLevel, seed = seed+1)
+    modelMap=maps.makeModelImage(shape, wcs, tab, beamFileName, obsFreqGHz = obsFreqGHz)
+    if modelMap is not None:
+        skyMap=skyMap+modelMap
+    skyMap[mask == 0]=0
+    maps.saveFITS(workDir+os.path.sep+"sim_f150.fits", np.array(skyMap, dtype = np.float32), wcs)
+
+#------------------------------------------------------------------------------------------------------------
+def writeConfig(workDir, widthDeg, heightDeg, numTiles):
+    """Writes the benchmark config file into workDir, with tiling set-up to give (approximately) the
+    requested number of tiles.
+
+    Returns:
+        Path to the config file.
+
+    """
+
+    with open(thisDir+os.path.sep+"configs"+os.path.sep+"benchmark.yml", "r") as inFile:
+        parDict=yaml.safe_load(inFile)
+    if numTiles > 1:
+        if (heightDeg-2*borderDeg)/pixScaleDeg < 1000:
+            raise Exception("Maps must be at least 8.5 deg tall to be broken into tiles.")
+        numX=int(np.ceil(np.sqrt(numTiles*widthDeg/heightDeg)))
+        numY=int(np.ceil(numTiles/numX))
+        # Slightly smaller than needed, as the autotiler rounds down the number of rows and columns (and
+        # stretches tiles in RA according to dec)
+        parDict['useTiling']=True
+        parDict['tileDefinitions']={'mask': "mask.fits",
+                                    'targetTileWidthDeg': 0.98*(widthDeg-2*borderDeg)/numX,
+                                    'targetTileHeightDeg': 0.98*(heightDeg-2*borderDeg)/numY}
+    else:
+        parDict['useTiling']=False
+    configFileName=workDir+os.path.sep+"benchmark.yml"
+    with open(configFileName, "w") as outFile:
+        yaml.safe_dump(parDict, outFile, sort_keys = False)
+
+    return configFileName
+
+#------------------------------------------------------------------------------------------------------------
+def runScript(scriptName, args, workDir, numProcesses = 1):
+    """Runs one of the scripts in bin/ (from this source tree) in workDir.
+
+    Returns:
+        Wall time taken (sec).
+
+    """
+
+    env=dict(os.environ)
+    env['PYTHONPATH']=rootDir+os.pathsep+env.get('PYTHONPATH', '')
+    cmd=[sys.executable, rootDir+os.path.sep+"bin"+os.path.sep+scriptName]+args
+    if numProcesses > 1:
+        cmd=cmd+['-P', str(numProcesses)]
+    t0=time.perf_counter()
+    with open(workDir+os.path.sep+scriptName+".log", "w") as logFile:
+        result=subprocess.run(cmd, cwd = workDir, env = env, stdout = logFile, stderr = subprocess.STDOUT)
+    t1=time.perf_counter()
+    if result.returncode != 0:
+        raise Exception("%s failed - see %s" % (scriptName, workDir+os.path.sep+scriptName+".log"))
+
+    return t1-t0
+
+#------------------------------------------------------------------------------------------------------------
+def runBenchmark(workDir, configFileName, repeats = 3, numProcesses = 1):
+    """Runs the benchmark, returning a dictionary of timings (sec) for each stage, with one entry per
+    repeat.
+
+    """
+
+    outDir=workDir+os.path.sep+"benchmark"
+    filterCacheDir=workDir+os.path.sep+"filterCache"
+    profilePath=outDir+os.path.sep+"diagnostics"+os.path.sep+"profile.json"
+    timings={}
+    def addTiming(key, value):
+        if key not in timings.keys():
+            timings[key]=[]
+        timings[key].append(value)
+
+    for i in range(repeats):
+        print(">>> Repeat %d/%d" % (i+1, repeats))
+
+        # Cold run - filters are built from scratch
+        for d in [outDir, filterCacheDir]:
+            if os.path.exists(d) == True:
+                shutil.rmtree(d)
+        print("... nemo (building filters)")
+        runScript("nemo", [configFileName], workDir, numProcesses = numProcesses)
+        with open(profilePath, "r") as inFile:
+            stages=json.load(inFile)['stages']
+        addTiming('filterMapsCold', stages['filterMaps']['wallTime'])
+
+        # Warm run - filters are loaded from the cache, so this times the filtering itself
+        shutil.rmtree(outDir)
+        print("... nemo (cached filters)")
+        runScript("nemo", [configFileName], workDir, numProcesses = numProcesses)
+        with open(profilePath, "r") as inFile:
+            report=json.load(inFile)
+        stages=report['stages']
+        addTiming('filterMapsWarm', stages['filterMaps']['wallTime'])
+        addTiming('objectFinding', stages['findObjects']['wallTime'])
+        addTiming('optimalCatalog', stages['makeOptimalCatalog']['wallTime'])
+        addTiming('RMSTables', stages['makeRMSTables']['wallTime'])
+        addTiming('nemo', report['totalWallTime'])
+        addTiming('nemoPeakRSSMB', max(report['peakRSSMBByRank'].values()))
+
+    return timings
+
+#------------------------------------------------------------------------------------------------------------
+def getGitCommit():
+    """Returns the hash of the current git commit of this source tree (or None if this can't be found).
+
+    """
+
+    try:
+        result=subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = rootDir, capture_output = True, text = True)
+        commit=result.stdout.strip()
+        result=subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = rootDir,
+                              capture_output = True, text = True)
+        if result.stdout.strip() != "":
+            commit=commit+"-dirty"
+    except:
+        commit=None
+    if commit == "":
+        commit=None
+
+    return commit
+
+#------------------------------------------------------------------------------------------------------------
+def compareResults(results, baseline, tolerance = 0.2):
+    """Prints a comparison of the median timings for each stage against a baseline set of results.
+
+    Returns:
+        List of the stages that are slower than the baseline by more than the given fractional tolerance.
+
+    """
+
+    if results['settings'] != baseline['settings']:
+        print("... WARNING: benchmark settings differ from the baseline")
+    print(">>> Comparison with %s:" % (baseline['gitCommit']))
+    print("    %-16s %10s %10s %8s" % ("stage", "baseline", "this", "ratio"))
+    slower=[]
+    for key in results['stages'].keys():
+        if key not in baseline['stages'].keys():
+            continue
+        old=baseline['stages'][key]['median']
+        new=results['stages'][key]['median']
+        if old > 0:
+            ratio=new/old
+        else:
+            ratio=np.nan
+        flag=""
+        if ratio > 1+tolerance:
+            flag="<- SLOWER"
+            slower.append(key)
+        elif ratio < 1-tolerance:
+            flag="<- faster"
+        print("    %-16s %10.3f %10.3f %8.2f %s" % (key, old, new, ratio, flag))
+
+    return slower
+
+#------------------------------------------------------------------------------------------------------------
+def makeParser():
+
+    parser=argparse.ArgumentParser("benchmark.py")
+    parser.add_argument("-s", "--size", dest = "size", default = "small", choices = list(sizesDict.keys()),
+                        help = "Preset synthetic survey size (default: small).")
+    parser.add_argument("-W", "--width-deg", dest = "widthDeg", type = float, default = None,
+                        help = "Map width in degrees (overrides the preset given by --size).")
+    parser.add_argument("-H", "--height-deg", dest = "heightDeg", type = float, default = None,
+                        help = "Map height in degrees (overrides the preset given by --size).")
+    parser.add_argument("-t", "--tiles", dest = "numTiles", type = int, default = None,
+                        help = "Number of tiles to break the map into (approximately; overrides the preset\
+                        given by --size).")
+    parser.add_argument("-n", "--sources-per-deg2", dest = "sourcesPerDeg2", type = float, default = 1.0,
+                        help = "Number of point sources per square degree to insert into the map.")
+    parser.add_argument("-r", "--repeats", dest = "repeats", type = int, default = 3,
+                        help = "Number of times to repeat each stage (the median time is reported).")
+    parser.add_argument("-P", "--processes", dest = "numProcesses", type = int, default = 1,
+                        help = "Number of worker processes used by nemo for filtering tiles.")
+    parser.add_argument("-S", "--seed", dest = "seed", type = int, default = 1234,
+                        help = "Random seed used for generating the synthetic maps.")
+    parser.add_argument("-w", "--work-dir", dest = "workDir", default = None,
+                        help = "Directory where synthetic maps and nemo output are written (default:\
+                        testsCache/benchmark_<size>).")
+    parser.add_argument("-o", "--output", dest = "outFileName", default = "benchmark.json",
+                        help = "Output file name for the results (JSON format).")
+    parser.add_argument("-c", "--compare", dest = "baselineFileName", default = None,
+                        help = "Results from a previous run (JSON format) to compare against.")
+    parser.add_argument("-T", "--tolerance", dest = "tolerance", type = float, default = 0.2,
+                        help = "Fractional slow down relative to the baseline that is flagged as a\
+                        regression when using --compare.")
+
+    return parser
+
+#------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser=makeParser()
+    args=parser.parse_args()
+
+    settings=dict(sizesDict[args.size])
+    if args.widthDeg is not None:
+        settings['widthDeg']=args.widthDeg
+    if args.heightDeg is not None:
+        settings['heightDeg']=args.heightDeg
+    if args.numTiles is not None:
+        settings['numTiles']=args.numTiles
+    settings['numSources']=int(round(args.sourcesPerDeg2*settings['widthDeg']*settings['heightDeg']))
+    settings['seed']=args.seed
+    settings['numProcesses']=args.numProcesses
+
+    workDir=args.workDir
+    if workDir is None:
+        workDir=thisDir+os.path.sep+"testsCache"+os.path.sep+"benchmark_%s" % (args.size)
+    workDir=os.path.abspath(workDir)
+    os.makedirs(workDir, exist_ok = True)
+
+    # Only re-make the synthetic maps if needed
+    mapSettings={'widthDeg': settings['widthDeg'], 'heightDeg': settings['heightDeg'],
+                 'numSources': settings['numSources'], 'seed': settings['seed']}
+    mapSettingsPath=workDir+os.path.sep+"mapSettings.json"
+    if os.path.exists(mapSettingsPath) == True:
+        with open(mapSettingsPath, "r") as inFile:
+            cachedMapSettings=json.load(inFile)
+    else:
+        cachedMapSettings=None
+    if cachedMapSettings != mapSettings:
+        print(">>> Making synthetic maps [%.1f x %.1f deg, %d point sources]" % (settings['widthDeg'],
+              settings['heightDeg'], settings['numSources']))
+        t0=time.perf_counter()
+        makeSyntheticSurvey(workDir, settings['widthDeg'], settings['heightDeg'], settings['numSources'],
+                            seed = settings['seed'])
+        print("... took %.3f sec" % (time.perf_counter()-t0))
+        with open(mapSettingsPath, "w") as outFile:
+            json.dump(mapSettings, outFile)
+    configFileName=writeConfig(workDir, settings['widthDeg'], settings['heightDeg'], settings['numTiles'])
+
+    timings=runBenchmark(workDir, configFileName, repeats = args.repeats, numProcesses = args.numProcesses)
+
+    results={'nemoVersion': nemo.__version__,
+             'gitCommit': getGitCommit(),
+             'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+             'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                      'numpy': np.__version__, 'cpuCount': os.cpu_count()},
+             'settings': settings,
+             'stages': {}}
+    for key in timings.keys():
+        results['stages'][key]={'median': float(np.median(timings[key])), 'min': float(np.min(timings[key])),
+                                'values': timings[key]}
+    with open(args.outFileName, "w") as outFile:
+        json.dump(results, outFile, indent = 1)
+
+    print(">>> Results [median of %d; sec, except where noted]:" % (args.repeats))
+    for key in results['stages'].keys():
+        print("    %-16s %10.3f" % (key, results['stages'][key]['median']))
+    print("... written to %s" % (args.outFileName))
+
+    if args.baselineFileName is not None:
+        with open(args.baselineFileName, "r") as inFile:
+            baseline=json.load(inFile)
+        slower=compareResults(results, baseline, tolerance = args.tolerance)
+        if len(slower) > 0:
+            sys.exit(1)
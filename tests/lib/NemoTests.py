@@ -9,7 +9,7 @@ import sys
 import subprocess
 import shutil
 import numpy as np
-from nemo import catalogs, maps, plotSettings
+from nemo import catalogs, maps, pipelines, completeness, startUp, plotSettings
 from astLib import *
 import astropy.io.fits as pyfits
 import astropy.table as atpy
@@ -170,6 +170,10 @@ class NemoTests(object):
         self._run_command(args)
 
 
+    def run_nemo_in_pool(self, numProcesses = 2):
+        self._run_command(["nemo", self.configFileName, "-P", str(numProcesses)])
+
+
     def run_nemo_injection_test(self):
         self._run_command(["nemo", self.configFileName, "-I"])
 
@@ -386,6 +390,93 @@ class NemoTests(object):
             self._status="SUCCESS"
     
             
+    def check_tile_reload(self, mapFileName):
+        """Checks that modifying a map tile loaded by MapDict.loadTile (in place) does not change what is
+        returned when the tile (or the whole map) is loaded again.
+        
+        """
+        
+        mapFileName=self.runDir+os.path.sep+mapFileName
+        with pyfits.open(mapFileName) as img:
+            origData=np.array(img[0].data)
+        if origData.ndim > 2:
+            origData=origData[0]
+        height, width=origData.shape
+        # Whole map, a full width section (contiguous in the file), and a section in one corner
+        tileCoordsDict={'all': {'clippedSection': [0, width, 0, height]},
+                        'rows': {'clippedSection': [0, width, height//4, height//2]},
+                        'corner': {'clippedSection': [width//4, width//2, height//4, height//2]}}
+        mapDict=maps.MapDict({'mapFileName': mapFileName, 'reprojectToTan': False},
+                             tileCoordsDict = tileCoordsDict)
+        self._status="SUCCESS"
+        for tileName in tileCoordsDict.keys():
+            minX, maxX, minY, maxY=tileCoordsDict[tileName]['clippedSection']
+            data=mapDict.loadTile('mapFileName', tileName)
+            data[:]=-1
+            for checkTileName in tileCoordsDict.keys():
+                minX, maxX, minY, maxY=tileCoordsDict[checkTileName]['clippedSection']
+                reloaded=mapDict.loadTile('mapFileName', checkTileName)
+                if np.array_equal(reloaded, origData[minY:maxY, minX:maxX]) == False:
+                    print("... tile %s changed after modifying tile %s" % (checkTileName, tileName))
+                    self._status="FAILED"
+
+
+    def compare_incremental_source_injection(self, numIterations = 3, tolerance = 1e-3):
+        """Checks that source injection in incremental mode (see pipelines.injectAndRecoverSources) recovers
+        the same catalogs as injecting the sources into the maps before filtering (the default mode). The
+        config must set photFilter, and nemo must have been run on it first (so that the reference filter
+        and RMS map are cached).
+        
+        """
+        
+        numIterations=int(numIterations)
+        tolerance=float(tolerance)
+        thisDir=os.getcwd()
+        os.chdir(self.runDir)
+        config=startUp.NemoConfig(self.configFileName, makeOutputDirs = False, verbose = False)
+        selFn=completeness.SelFn(config.selFnDir, 4.0, configFileName = config.configFileName,
+                                 enableCompletenessCalc = False, setUpAreaMask = True,
+                                 tileNames = config.allTileNames)
+        catFileName=config.rootOutDir+os.path.sep+"%s_optimalCatalog.fits" % (os.path.split(config.rootOutDir)[-1])
+        realCatalog=atpy.Table().read(catFileName)
+        for filtDict in config.parDict['mapFilters']:
+            if filtDict['label'] == config.parDict['photFilter']:
+                break
+        config.parDict['mapFilters']=[filtDict]
+        for key in ['saveFilteredMaps', 'savePlots']:
+            filtDict['params'][key]=False
+        np.random.seed(1234)
+        injectSourcesList=[]
+        for i in range(numIterations):
+            injectSourcesList.append(maps._makeInjectSources(config, filtDict, {'label': 'pointSource'}, 
+                                                             realCatalog, selFn, config.parDict['sourcesPerTile'],
+                                                             'deltaT_c'))
+        incrementalCatalogs=pipelines.injectAndRecoverSources(config, injectSourcesList, batchSize = 2,
+                                                              verbose = False)
+        self._status="SUCCESS"
+        for injectSources, incrementalCatalog in zip(injectSourcesList, incrementalCatalogs):
+            for mapDict in config.unfilteredMapsDictList:
+                mapDict['injectSources']=injectSources
+            defaultCatalog=pipelines.filterMapsAndMakeCatalogs(config, useCachedFilters = True,
+                                                               useCachedRMSMap = True, verbose = False)
+            print("... default mode = %d objects; incremental mode = %d objects" % (len(defaultCatalog), len(incrementalCatalog)))
+            if len(defaultCatalog) != len(incrementalCatalog):
+                self._status="FAILED"
+                continue
+            if len(defaultCatalog) == 0:
+                continue
+            xDefault, xIncremental, rDeg=catalogs.crossMatch(defaultCatalog, incrementalCatalog, radiusArcmin = 0.05)
+            if len(xDefault) != len(defaultCatalog):
+                self._status="FAILED"
+                continue
+            for key in ['SNR', 'deltaT_c']:
+                maxDiff=np.max(abs(xIncremental[key]/xDefault[key]-1))
+                print("... max fractional difference in %s = %.3e" % (key, maxDiff))
+                if maxDiff > tolerance:
+                    self._status="FAILED"
+        os.chdir(thisDir)
+
+
     def status_should_be(self, expected_status):
         if expected_status != self._status:
             raise AssertionError("Expected status to be '%s' but was '%s'."